@@ -13,5 +13,27 @@ redis_conn = os.getenv('REDIS_CONN')
 github_token = os.getenv('GITHUB_TOKEN')
 clash_yaml_gist_id = os.getenv('CLASH_YAML_GIST_ID')
 proxy_pool_start_port = int(os.getenv('PROXY_POOL_START_PORT', 42001))
+redis_max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+# 代理属性的序列化格式: json / msgpack / zstd, zstd 需要用 proxy_db/migrate.py 训练的字典
+redis_codec = os.getenv('REDIS_CODEC', 'json')
+redis_zstd_dict = os.getenv('REDIS_ZSTD_DICT')
+# 写入时记录变更流的表, 逗号分隔, 下游任务可以只处理变更, 例如 subscription,sub_proxy
+# 记录变更流的表每次写入都多一次 XADD, 默认不启用
+redis_change_feed_tables = [t for t in os.getenv('REDIS_CHANGE_FEED_TABLES', '').split(',') if t]
+redis_change_feed_maxlen = int(os.getenv('REDIS_CHANGE_FEED_MAXLEN', 100000))
+# ip 纯净度结果的有效期, 秒, 查询失败的结果使用较短的有效期, 避免反复启动浏览器
+ip_risk_ttl = int(os.getenv('IP_RISK_TTL', 7 * 24 * 3600))
+ip_risk_negative_ttl = int(os.getenv('IP_RISK_NEGATIVE_TTL', 6 * 3600))
+# 过期超过这个时间的 ip 纯净度结果不再使用, 并由定时任务删除
+ip_risk_max_stale = int(os.getenv('IP_RISK_MAX_STALE', 30 * 24 * 3600))
+# 启动 mihomo 检测前先用 tcp 连接过滤端口不通的代理
+tcp_prefilter = os.getenv('TCP_PREFILTER', 'false').lower() in ('1', 'true', 'yes')
+tcp_prefilter_concurrency = int(os.getenv('TCP_PREFILTER_CONCURRENCY', 500))
+# 生成配置和上传订阅时, 按综合延迟排到最前面的代理数, 0 为不排序
+rank_top_n = int(os.getenv('RANK_TOP_N', 20))
+# 分布式检测: 定时任务只把到期的代理放入 redis 工作队列, 由 submanager/check_worker.py 检测
+check_workers = os.getenv('CHECK_WORKERS', 'false').lower() in ('1', 'true', 'yes')
+# 检测成功的代理再通过本地 listener 做一次分阶段测试, 保存各阶段耗时并按首字节时间 (ttfb) 排序
+phase_probe = os.getenv('PHASE_PROBE', 'false').lower() in ('1', 'true', 'yes')
 
 proxy_server = "192.168.50.88"
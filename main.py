@@ -9,7 +9,8 @@ from apscheduler.schedulers.background import BackgroundScheduler, BlockingSched
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
-from submanager.subproxy_checker import run_sub_proxy_check_task
+from config import check_workers
+from submanager.subproxy_checker import run_sub_proxy_check_task, run_enqueue_check_task
 from submanager.xui_scan.fofa_get_xui import FofaClient
 from submanager.xui_scan.xui_sublink_checker import XuiSubLinkChecker
 from submanager.xui_scan.xui_scan import fetch_xui_sublink_task
@@ -17,6 +18,7 @@ from submanager.sub_merger import SubMerger
 from submanager.merge_sub_upload import SubUploader
 from submanager.mihomo_proxy_pool import generate_proxy_pool_run_task, check_subscripts_task
 from submanager.subscribe_fetcher import run_fetch_proxy_task
+from tools.ping0cc import purge_stale_ip_risk_task
 
 task_scheduler = BackgroundScheduler()
 main_scheduler = BlockingScheduler()
@@ -69,8 +71,10 @@ def airport_collect_task():
 
 
 def main():
-    # 检测代理
-    task_scheduler.add_job(run_sub_proxy_check_task, trigger=IntervalTrigger(minutes=30))
+    # 检测代理, 每次只检测到期的代理, 稳定的代理检测间隔逐渐变长
+    # 启用分布式检测时只放入工作队列, 由各机器上的 check_worker 检测
+    check_task = run_enqueue_check_task if check_workers else run_sub_proxy_check_task
+    task_scheduler.add_job(check_task, trigger=IntervalTrigger(minutes=10))
 
     # 拉取 xui 网站
     task_scheduler.add_job(fetch_xui_task, trigger=IntervalTrigger(minutes=3), max_instances=10)
@@ -91,6 +95,9 @@ def main():
 
     task_scheduler.add_job(run_fetch_proxy_task, trigger=IntervalTrigger(hours=1, minutes=10))
 
+    # 删除过期太久的 ip 纯净度结果
+    task_scheduler.add_job(purge_stale_ip_risk_task, trigger=IntervalTrigger(days=1))
+
     task_scheduler.start()
 
     print(task_scheduler.get_jobs())
@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import aiohttp
+from loguru import logger
+
+from proxy_check.ping import percentile
+
+# 默认的测速文件, 可以换成任意能返回足够数据的地址
+BANDWIDTH_URL = 'https://speed.cloudflare.com/__down?bytes=52428800'
+
+
+async def download_speed(session: aiohttp.ClientSession, url: str = BANDWIDTH_URL, proxy: str = None,
+                         max_bytes: int = 10 * 1024 * 1024, max_time: float = 10, window: float = 0.5,
+                         chunk_size: int = 64 * 1024) -> dict:
+    """
+    通过代理下载 url, 达到 max_bytes 或 max_time 后停止, 计算下载速度
+    :param session: aiohttp session
+    :param proxy: http 代理地址, None 时直连
+    :param max_bytes: 最多下载的字节数
+    :param max_time: 最长下载时间, 秒, 不包括建立连接和等待响应头
+    :param window: 计算峰值和持续速度的时间窗口, 秒
+    :return: bytes, seconds, avg / sustained / peak (字节每秒), ok, error
+             sustained 为各窗口速度的中位数, 不受开始时的慢启动影响, peak 为最大的窗口速度
+    """
+    ret = {'url': url, 'ok': False, 'error': None, 'bytes': 0, 'seconds': 0, 'avg': 0, 'sustained': 0, 'peak': 0}
+    rates = []
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=10)
+    try:
+        async with session.get(url, proxy=proxy, timeout=timeout) as resp:
+            if resp.status != 200:
+                ret['error'] = f'status {resp.status}'
+                return ret
+
+            start = window_start = time.perf_counter()
+            deadline = start + max_time
+            window_bytes = 0
+            while ret['bytes'] < max_bytes:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    chunk = await asyncio.wait_for(resp.content.read(chunk_size), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if not chunk:
+                    break
+                ret['bytes'] += len(chunk)
+                window_bytes += len(chunk)
+
+                now = time.perf_counter()
+                if now - window_start >= window:
+                    rates.append(window_bytes / (now - window_start))
+                    window_start, window_bytes = now, 0
+
+            now = time.perf_counter()
+            ret['seconds'] = now - start
+            # 最后不足一个窗口的数据只计入平均速度
+            if not rates and ret['seconds'] > 0:
+                rates.append(window_bytes / ret['seconds'])
+    except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+        ret['error'] = str(e) or type(e).__name__
+        return ret
+
+    ret['ok'] = ret['bytes'] > 0
+    ret['avg'] = ret['bytes'] / ret['seconds'] if ret['seconds'] else 0
+    ret['sustained'] = percentile(sorted(rates), 50)
+    ret['peak'] = max(rates) if rates else 0
+    return ret
+
+
+def format_speed(rate):
+    for unit in ('B/s', 'KB/s', 'MB/s'):
+        if rate < 1024:
+            return f'{rate:.1f} {unit}'
+        rate /= 1024
+    return f'{rate:.1f} GB/s'
+
+
+if __name__ == '__main__':
+    from aiohttp import web
+
+    async def serve_bytes(request):
+        """
+        本地的测速文件服务, 按 rate 限速返回 size 字节
+        """
+        size = int(request.query.get('bytes', 10 * 1024 * 1024))
+        rate = int(request.query.get('rate', 0))
+        resp = web.StreamResponse(headers={'Content-Length': str(size)})
+        await resp.prepare(request)
+        chunk = b'\0' * 64 * 1024
+        sent = 0
+        try:
+            while sent < size:
+                data = chunk[:size - sent]
+                await resp.write(data)
+                sent += len(data)
+                if rate:
+                    await asyncio.sleep(len(data) / rate)
+        except ConnectionError:
+            # 客户端达到字节数或时间上限后主动断开
+            pass
+        return resp
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/down', serve_bytes)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 18080).start()
+
+        async with aiohttp.ClientSession() as session:
+            for query in ('bytes=52428800', 'bytes=52428800&rate=1048576'):
+                ret = await download_speed(session, f'http://127.0.0.1:18080/down?{query}', max_time=3)
+                logger.info(f"{query}: {ret['bytes']} bytes in {ret['seconds']:.2f}s, avg {format_speed(ret['avg'])}, "
+                            f"sustained {format_speed(ret['sustained'])}, peak {format_speed(ret['peak'])}")
+        await runner.cleanup()
+
+    asyncio.run(main())
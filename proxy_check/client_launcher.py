@@ -1,11 +1,17 @@
 import os
+import json
+import time
 import yaml
 import signal
+import asyncio
+import secrets
 import subprocess
 import platform
+import aiohttp
 import aiofiles
 
 from typing import Any, Dict, List, Optional
+from urllib.parse import quote
 from loguru import logger
 
 operating_system = platform.system().lower()
@@ -67,7 +73,7 @@ class BaseClient:
                 logger.info(f'Starting {self._clients["linux"]} with config: {self._config_file}')
 
     def check_alive(self) -> bool:
-        return self._process.poll() is None  # type: ignore[union-attr]
+        return self._process is not None and self._process.poll() is None
 
     def stop_client(self):
         if self._process is not None:
@@ -80,9 +86,16 @@ class BaseClient:
 
 
 class MiHoMoClient(BaseClient):
-    def __init__(self, file: str):
+    def __init__(self, file: str, controller_port: Optional[int] = None):
         super().__init__(client_dir, {"win": "mihomo-windows.exe", "linux": "mihomo-linux"}, file)
 
+        # external-controller 只监听本地, 用于热加载配置和就绪检测
+        self._controller_port: Optional[int] = controller_port
+        self._secret: str = secrets.token_hex(16)
+        # 控制接口的请求共用一个 session, 绑定创建它的事件循环
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
         self._cmd: dict = {
             "win_debug": [
                 os.path.join(self._clients_dir, "mihomo-windows.exe"),
@@ -106,6 +119,151 @@ class MiHoMoClient(BaseClient):
             ],
         }
 
+    @property
+    def controller(self) -> str:
+        return f"http://127.0.0.1:{self._controller_port}"
+
+    def _with_controller(self, config: Dict[str, Any]) -> Dict[str, Any]:
+        if self._controller_port is None:
+            return config
+        return {**config, "external-controller": f"127.0.0.1:{self._controller_port}", "secret": self._secret}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        返回共用的 session, 调用方在新的事件循环中使用时 (多次 asyncio.run) 重新创建
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(headers={"Authorization": f"Bearer {self._secret}"})
+            self._session_loop = loop
+        return self._session
+
+    async def close_session(self):
+        """
+        关闭共用的 session, 只能在创建它的事件循环中关闭, 其他循环中的 session 直接丢弃
+        """
+        session, self._session = self._session, None
+        if session is not None and not session.closed and self._session_loop is asyncio.get_running_loop():
+            await session.close()
+        self._session_loop = None
+
+    def close_session_nowait(self):
+        """
+        在协程之外关闭共用的 session (Checker.close / __exit__)
+        创建它的事件循环仍在运行时交给该循环关闭, 未运行时在该循环中关闭, 已关闭时无法关闭, 只记录警告
+        """
+        session, loop = self._session, self._session_loop
+        self._session = self._session_loop = None
+        if session is None or session.closed or loop is None:
+            return
+        if loop.is_closed():
+            logger.warning("Controller session left open, its event loop is closed, use 'async with Checker()'")
+        elif loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        else:
+            loop.run_until_complete(session.close())
+
+    async def _request(self, method: str, path: str, timeout: float = 5, **kwargs):
+        session = self._get_session()
+        async with session.request(method, f"{self.controller}{path}",
+                                   timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as resp:
+            return resp.status, await resp.read()
+
+    async def start_client(self, config: Dict[str, Any], debug: bool = False):
+        await super().start_client(self._with_controller(config), debug)
+
+    async def wait_ready(self, timeout: float = 10, interval: float = 0.05) -> bool:
+        """
+        轮询 external-controller 直到可以访问, 代替固定的等待时间
+        :param timeout: 最长等待时间, 秒
+        :param interval: 轮询间隔, 秒
+        :return: 是否就绪, 进程退出时立即返回 False
+        """
+        if self._controller_port is None:
+            await asyncio.sleep(timeout)
+            return self.check_alive()
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.check_alive():
+                return False
+            try:
+                status, _ = await self._request("GET", "/version", timeout=1)
+                if status == 200:
+                    return True
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                pass
+            await asyncio.sleep(interval)
+        return False
+
+    async def reload_config(self, config: Dict[str, Any]) -> bool:
+        """
+        通过 PUT /configs 替换运行中的配置, 不重启进程
+        :return: 是否加载成功, 失败时调用方应重启进程
+        """
+        if not self.check_alive() or self._controller_port is None:
+            return False
+
+        self._config_str = yaml.dump(self._with_controller(config), indent=2, allow_unicode=True)
+        async with aiofiles.open(self._config_file, "w+", encoding="utf-8") as f:
+            await f.write(self._config_str)
+
+        try:
+            status, body = await self._request(
+                "PUT", "/configs?force=true", timeout=30, json={"path": "", "payload": self._config_str}
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.error(f"Reload config failed: {e}")
+            return False
+
+        if status != 204:
+            logger.error(f"Reload config failed, status: {status}, body: {body[:200]}")
+            return False
+        return True
+
+    async def proxy_delay(self, name: str, url: str, timeout: int = 5000, raise_local: bool = False) -> Optional[int]:
+        """
+        在 mihomo 内测试单个代理的延迟 (GET /proxies/{name}/delay)
+        :param name: 代理名
+        :param url: 测试地址
+        :param timeout: 超时时间, 毫秒
+        :param raise_local: 控制接口本身连接失败或超时 (本机饱和, 不是代理失效) 时抛出异常
+        :return: 延迟, 毫秒, 失败时为 None
+        """
+        try:
+            status, body = await self._request(
+                "GET", f"/proxies/{quote(name, safe='')}/delay",
+                timeout=timeout / 1000 + 2, params={"url": url, "timeout": str(timeout)}
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            if raise_local:
+                raise
+            return None
+        if status != 200:
+            return None
+        return json.loads(body).get("delay") or None
+
+    async def group_delay(self, group: str, url: str, timeout: int = 5000) -> Dict[str, int]:
+        """
+        在 mihomo 内测试策略组中所有代理的延迟 (GET /group/{name}/delay)
+        :param group: 策略组名
+        :param url: 测试地址
+        :param timeout: 单个代理的超时时间, 毫秒
+        :return: {代理名: 延迟}, 只包含测试成功的代理
+        """
+        try:
+            status, body = await self._request(
+                "GET", f"/group/{quote(group, safe='')}/delay",
+                timeout=timeout / 1000 * 4 + 10, params={"url": url, "timeout": str(timeout)}
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.error(f"Group delay test failed: {e}")
+            return {}
+        if status != 200:
+            logger.error(f"Group delay test failed, status: {status}, body: {body[:200]}")
+            return {}
+        return {name: delay for name, delay in json.loads(body).items() if delay}
+
 
 if __name__ == '__main__':
     m = MiHoMoClient('tmp/config.yaml')
@@ -0,0 +1,214 @@
+import time
+import asyncio
+import threading
+import functools
+from collections import deque
+
+from loguru import logger
+
+from proxy_check.ping import percentile
+
+
+class AimdController:
+    """
+    AIMD 并发控制, 根据本机饱和信号调整同时进行的检测数
+
+    每完成 window 个检测评估一次:
+    超时比例超过 timeout_threshold, 或成功检测的延迟中位数超过基线的 latency_inflation 倍时, limit 乘以 decrease
+    否则 limit 加 increase
+    基线为最近 baseline_windows 次评估中最低的延迟中位数, 本机或上行带宽饱和时延迟整体变大, 此时收窄并发,
+    避免把正常的代理判为失败; 基线只看最近的评估, 某次代理组成恰好都很快时不会一直压住并发
+    这里的超时只指本机的问题 (连不上本地的 mihomo, 控制接口超时等), 失效代理的失败无论多慢都只记为普通失败,
+    否则失效代理多时并发会一直收窄到 min_limit
+
+    线程和协程可以共用一个控制器:
+        with controller.slot() as slot: ...            # 线程
+        async with controller.async_slot() as slot: ...  # 协程
+        slot.timeout = True                          # 标记本次检测遇到本机饱和
+    也可以不限制并发, 只用 record 记录结果, 由调用方按 limit 决定批次大小
+    """
+
+    def __init__(self, initial=50, min_limit=4, max_limit=500, increase=2, decrease=0.7,
+                 timeout_threshold=0.2, latency_inflation=2.0, window=20, baseline_windows=10, name='check'):
+        """
+        init
+        :param initial: 初始并发数
+        :param min_limit: 最小并发数
+        :param max_limit: 最大并发数
+        :param increase: 每次评估正常时增加的并发数
+        :param decrease: 每次评估异常时并发数乘以的系数
+        :param timeout_threshold: 本机超时比例阈值
+        :param latency_inflation: 延迟中位数相对基线的膨胀阈值
+        :param window: 每次评估的检测数
+        :param baseline_windows: 基线取最近多少次评估的最低延迟中位数
+        :param name: 日志中的名字
+        :return:
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.timeout_threshold = timeout_threshold
+        self.latency_inflation = latency_inflation
+        self.window = window
+        self.name = name
+
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._inflight = 0
+        self._latencies = []
+        self._timeouts = 0
+        self._count = 0
+        self._baseline = None
+        self._p50s = deque(maxlen=baseline_windows)
+
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def _try_acquire(self):
+        if self._inflight < int(self._limit):
+            self._inflight += 1
+            return True
+        return False
+
+    def _wake(self):
+        self._cond.notify_all()
+        while self._async_waiters:
+            loop, fut = self._async_waiters.popleft()
+            loop.call_soon_threadsafe(_set_pending, fut)
+
+    def acquire(self):
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                fut = loop.create_future()
+                self._async_waiters.append((loop, fut))
+            await fut
+
+    def release(self, latency=None, timeout=False):
+        """
+        释放一个并发数并记录结果
+        :param latency: 检测耗时, 秒, None 表示不参与延迟统计 (例如快速失败)
+        :param timeout: 是否超时
+        """
+        with self._cond:
+            self._inflight -= 1
+            self._record(latency, timeout)
+            self._wake()
+
+    def record(self, latency=None, timeout=False):
+        """
+        只记录结果, 不占用并发数
+        """
+        with self._cond:
+            self._record(latency, timeout)
+            self._wake()
+
+    def _record(self, latency, timeout):
+        self._count += 1
+        if timeout:
+            self._timeouts += 1
+        elif latency is not None:
+            self._latencies.append(latency)
+
+        if self._count < self.window:
+            return
+
+        timeout_rate = self._timeouts / self._count
+        p50 = percentile(sorted(self._latencies), 50) if self._latencies else None
+        if p50 is not None:
+            self._p50s.append(p50)
+            self._baseline = min(self._p50s)
+        inflated = p50 is not None and self._baseline and p50 > self._baseline * self.latency_inflation
+
+        old = self.limit
+        if timeout_rate > self.timeout_threshold or inflated:
+            self._limit = max(self.min_limit, self._limit * self.decrease)
+        else:
+            self._limit = min(self.max_limit, self._limit + self.increase)
+        if self.limit != old:
+            logger.debug(f'[{self.name}] concurrency {old} -> {self.limit}, timeout rate: {timeout_rate:.2f}, '
+                         f'p50: {p50}, baseline: {self._baseline}')
+
+        self._count = self._timeouts = 0
+        self._latencies = []
+
+    def slot(self):
+        return _Slot(self)
+
+    def async_slot(self):
+        return _Slot(self)
+
+    def wrap(self, func, local_errors=(OSError,)):
+        """
+        包装同步检测函数, 调用时占用一个并发数
+        只有返回真值的检测耗时参与延迟统计, 返回假值视为代理失效, 不影响并发数
+        :param local_errors: 视为本机饱和的异常 (本地连接失败或超时), 计入超时比例
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.slot() as slot:
+                slot.measure = False
+                try:
+                    result = func(*args, **kwargs)
+                except local_errors:
+                    slot.timeout = True
+                    raise
+                slot.measure = bool(result)
+                return result
+
+        return wrapper
+
+    def stats(self):
+        return {'limit': self.limit, 'inflight': self._inflight, 'baseline': self._baseline}
+
+
+class _Slot:
+    def __init__(self, controller):
+        self.controller = controller
+        self.timeout = False
+        # 设置为 False 时耗时不参与延迟统计
+        self.measure = True
+        self.start = None
+
+    def __enter__(self):
+        self.controller.acquire()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._release(exc_type)
+
+    async def __aenter__(self):
+        await self.controller.acquire_async()
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._release(exc_type)
+
+    def _release(self, exc_type):
+        if exc_type is not None and issubclass(exc_type, (TimeoutError, asyncio.TimeoutError)):
+            self.timeout = True
+        latency = time.perf_counter() - self.start if self.measure else None
+        self.controller.release(latency, self.timeout)
+
+
+def _set_pending(fut):
+    if not fut.done():
+        fut.set_result(None)
@@ -1,10 +1,28 @@
 # Author: ranwen NyanChan
 import asyncio
 import socket
+import ssl
 import time
+from urllib.parse import urlparse
 
 from loguru import logger
 
+# 基于 udp 的协议, tcp 端口不通不代表不可用, 不参与 tcp 预过滤
+UDP_PROXY_TYPES = {'hysteria', 'hysteria2', 'tuic', 'wireguard'}
+
+# 分阶段测试的默认目标
+PROBE_URL = 'http://www.google.com/generate_204'
+PROBE_PHASES = ('connect', 'handshake', 'upstream', 'tls', 'ttfb')
+
+# 测试请求不校验证书, 共用一个 SSL context, 避免每次重新加载证书
+ssl_context = ssl.create_default_context()
+ssl_context.check_hostname = False
+ssl_context.verify_mode = ssl.CERT_NONE
+
+
+class ProbeError(Exception):
+    pass
+
 
 def domain2ip(domain: str) -> str:
     logger.info(f"Translating {domain} to ipv4.")
@@ -46,83 +64,303 @@ def sync_tcp_ping(host, port):
     return (alt / suc, suc / (suc + fac), _list)
 
 
-async def tcp_ping_task(loop, _list, address, port):
-    alt = fac = suc = 0
+def percentile(values, q):
+    """
+    线性插值的百分位数
+    :param values: 已排序的数值
+    :param q: 0-100
+    """
+    if not values:
+        return 0
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def ping_stats(samples, attempts):
+    """
+    :param samples: 成功的连接耗时, 毫秒, 按测试顺序
+    :param attempts: 测试次数
+    :return: 统计结果, 耗时单位为毫秒, jitter 为相邻两次耗时差的平均值
+    """
+    ordered = sorted(samples)
+    jitter = (sum(abs(b - a) for a, b in zip(samples, samples[1:])) / (len(samples) - 1)
+              if len(samples) > 1 else 0)
+    return {
+        'attempts': attempts,
+        'success': len(samples),
+        'loss': 1 - len(samples) / attempts if attempts else 1,
+        'avg': sum(samples) / len(samples) if samples else 0,
+        'min': ordered[0] if ordered else 0,
+        'max': ordered[-1] if ordered else 0,
+        'p50': percentile(ordered, 50),
+        'p90': percentile(ordered, 90),
+        'jitter': jitter,
+        'samples': samples,
+    }
+
+
+async def tcp_connect_time(addr, timeout=3):
+    """
+    测试一次 tcp 连接的耗时
+    :param addr: getaddrinfo 返回的 (family, sockaddr)
+    :param timeout: 超时时间, 秒, 用 wait_for 实现, 非阻塞 socket 的 settimeout 不生效
+    :return: 耗时, 毫秒, 失败时为 None
+    """
+    loop = asyncio.get_running_loop()
+    family, sockaddr = addr
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
     try:
-        sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_STREAM)
-        sock.settimeout(3)
-        current_time = time.time()
-        await loop.sock_connect(sock, (address, port))
+        start = time.perf_counter_ns()
+        await asyncio.wait_for(loop.sock_connect(sock, sockaddr), timeout)
+        return (time.perf_counter_ns() - start) / 1e6
+    except asyncio.TimeoutError:
+        logger.debug(f"TCP Ping {sockaddr} Timeout.")
+    except OSError as e:
+        logger.debug(f"TCP Ping {sockaddr} Exception: {e}")
+    finally:
         sock.close()
-        delta_time = time.time() - current_time
-        alt += delta_time
-        suc += 1
-        _list.append(delta_time)
-    except socket.timeout:
-        fac += 1
-        _list.append(0)
-        logger.error(f"TCP Ping ({address},{port}) Timeout {fac} times.")
-    except ConnectionResetError:
-        logger.error("TCP Ping Reset")
-        _list.append(0)
-        fac += 1
-    except ConnectionRefusedError:
-        logger.error("TCP Ping RefusedError")
-        _list.append(0)
-        fac += 1
-    except Exception as e:
-        logger.error(f"TCP Ping Exception: err: {e}")
-        _list.append(0)
-        fac += 1
-    return {"alt": alt, "fac": fac, "suc": suc}
+    return None
 
 
-async def google_ping_task(loop, _list, address, port):
-    alt = fac = suc = 0
+async def resolve_addr(address, port):
+    """
+    解析地址, 只解析一次, 不计入连接耗时
+    :return: (family, sockaddr), 失败时为 None
+    """
+    loop = asyncio.get_running_loop()
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(3)
-        await loop.sock_connect(sock, (address, port))
-        current_time = time.time()
-        await loop.sock_sendall(sock, b"\x05\x01\x00")
-        await loop.sock_recv(sock, 2)
-        await loop.sock_sendall(sock, b"\x05\x01\x00\x03\x0agoogle.com\x00\x50")
-        await loop.sock_recv(sock, 10)
-        await loop.sock_sendall(
-            sock,
-            b"GET / HTTP/1.1\r\nHost: google.com\r\nUser-Agent: curl/11.45.14\r\n\r\n",
+        infos = await loop.getaddrinfo(address, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError) as e:
+        logger.debug(f"Resolve {address} failed: {e}")
+        return None
+    family, _, _, _, sockaddr = infos[0]
+    return family, sockaddr
+
+
+async def tcp_ping_stats(address: str, port: int, attempts: int = 3, interval: float = 0.2,
+                         timeout: float = 3, sem: asyncio.Semaphore = None) -> dict:
+    """
+    依次测试 attempts 次 tcp 连接
+    :param attempts: 测试次数
+    :param interval: 两次测试之间的间隔, 秒
+    :param timeout: 单次测试的超时时间, 秒
+    :param sem: 限制同时进行的连接数, 只在连接期间占用
+    :return: ping_stats 的结果, 并带有 address 和 port
+    """
+    addr = await resolve_addr(address, port)
+    samples = []
+    if addr is not None:
+        for i in range(attempts):
+            if i and interval:
+                await asyncio.sleep(interval)
+            if sem is None:
+                delay = await tcp_connect_time(addr, timeout)
+            else:
+                async with sem:
+                    delay = await tcp_connect_time(addr, timeout)
+            if delay is not None:
+                samples.append(delay)
+
+    ret = ping_stats(samples, attempts)
+    ret['address'], ret['port'] = address, port
+    return ret
+
+
+async def batch_tcp_ping(targets, concurrency: int = 500, **kwargs) -> list:
+    """
+    批量 tcp ping
+    :param targets: [(address, port), ...]
+    :param concurrency: 所有目标共用的最大同时连接数
+    :param kwargs: 传给 tcp_ping_stats 的参数
+    :return: 与 targets 顺序相同的统计结果
+    """
+    sem = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[
+        tcp_ping_stats(address, int(port), sem=sem, **kwargs) for address, port in targets
+    ])
+
+
+async def filter_reachable_proxies(proxies, concurrency: int = 500, attempts: int = 1, timeout: float = 2):
+    """
+    tcp 预过滤, 对所有代理去重后的 server:port 做一次连接测试, 去掉端口不通的代理
+    udp 协议和缺少 server/port 的代理直接保留, 交给后续的完整检测
+    :param concurrency: 最大同时连接数
+    :param attempts: 每个地址的测试次数, 任一次成功即视为可达
+    :param timeout: 单次测试的超时时间, 秒
+    :return: (可达的代理, 不可达的代理)
+    """
+    targets = {}
+    for proxy in proxies:
+        if proxy.get('type') in UDP_PROXY_TYPES or not proxy.get('server') or not proxy.get('port'):
+            continue
+        targets.setdefault((proxy['server'], int(proxy['port'])), None)
+
+    stats = await batch_tcp_ping(list(targets), concurrency=concurrency, attempts=attempts, interval=0,
+                                 timeout=timeout)
+    reachable = {(stat['address'], stat['port']) for stat in stats if stat['success']}
+
+    kept, dropped = [], []
+    for proxy in proxies:
+        if proxy.get('type') in UDP_PROXY_TYPES or not proxy.get('server') or not proxy.get('port'):
+            kept.append(proxy)
+        elif (proxy['server'], int(proxy['port'])) in reachable:
+            kept.append(proxy)
+        else:
+            dropped.append(proxy)
+
+    logger.info(f"TCP prefilter: {len(targets)} endpoints, {len(reachable)} reachable, "
+                f"{len(dropped)}/{len(proxies)} proxies dropped.")
+    return kept, dropped
+
+
+def sync_filter_reachable_proxies(proxies, **kwargs):
+    """
+    filter_reachable_proxies 的同步版本, 不能在事件循环中调用
+    """
+    return asyncio.run(filter_reachable_proxies(proxies, **kwargs))
+
+
+async def _socks5_connect(reader, writer, host, port, phases, start):
+    writer.write(b"\x05\x01\x00")
+    await writer.drain()
+    ver, method = await reader.readexactly(2)
+    if ver != 5 or method != 0:
+        raise ProbeError(f"socks5 auth rejected: {ver} {method}")
+    start = _mark(phases, 'handshake', start)
+
+    host_bytes = host.encode('idna')
+    writer.write(b"\x05\x01\x00\x03" + bytes([len(host_bytes)]) + host_bytes + port.to_bytes(2, 'big'))
+    await writer.drain()
+    reply = await reader.readexactly(4)
+    if reply[1] != 0:
+        raise ProbeError(f"socks5 connect failed: {reply[1]}")
+    atyp = reply[3]
+    size = 4 if atyp == 1 else 16 if atyp == 4 else (await reader.readexactly(1))[0]
+    await reader.readexactly(size + 2)
+    return _mark(phases, 'upstream', start)
+
+
+async def _http_connect(reader, writer, host, port, phases, start):
+    phases['handshake'] = 0
+    writer.write(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+    await writer.drain()
+    status = await reader.readline()
+    if len(status.split()) < 2 or status.split()[1] != b"200":
+        raise ProbeError(f"http connect failed: {status.strip()[:50]}")
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+    return _mark(phases, 'upstream', start)
+
+
+def _mark(phases, name, start):
+    now = time.perf_counter_ns()
+    phases[name] = (now - start) / 1e6
+    return now
+
+
+async def phase_probe(address: str, port: int, url: str = PROBE_URL, proxy_type: str = 'socks5',
+                      timeout: float = 5) -> dict:
+    """
+    通过本地代理端口请求 url, 分阶段记录耗时, 用于区分核心慢还是上游慢
+    connect: 连接本地端口; handshake: socks5 握手 (http 代理为 0); upstream: 建立到目标的隧道;
+    tls: https 的 tls 握手 (http 为 0); ttfb: 发送请求到收到第一个字节
+    mihomo 等核心在连接上游之前就回复隧道建立, 此时上游的连接耗时计入 ttfb
+    :param url: 测试地址, 支持 http 和 https
+    :param proxy_type: 本地端口的协议, socks5 或 http
+    :param timeout: 整个测试的超时时间, 秒
+    :return: 各阶段耗时 (毫秒, 未完成的阶段为 None), total, ok, error
+    """
+    target = urlparse(url)
+    host = target.hostname
+    https = target.scheme == 'https'
+    target_port = target.port or (443 if https else 80)
+    path = (target.path or '/') + (f'?{target.query}' if target.query else '')
+
+    ret = {'url': url, 'ok': False, 'error': None, 'total': None, **{phase: None for phase in PROBE_PHASES}}
+    writer = None
+
+    async def run():
+        nonlocal writer
+        start = time.perf_counter_ns()
+        reader, writer = await asyncio.open_connection(address, port)
+        start = _mark(ret, 'connect', start)
+        connect = _socks5_connect if proxy_type == 'socks5' else _http_connect
+        start = await connect(reader, writer, host, target_port, ret, start)
+
+        if https:
+            await writer.start_tls(ssl_context, server_hostname=host)
+            start = _mark(ret, 'tls', start)
+        else:
+            ret['tls'] = 0
+
+        writer.write(
+            f"GET {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: curl/8.5.0\r\nConnection: close\r\n\r\n".encode()
         )
-        await loop.sock_recv(sock, 1)
-        sock.close()
-        delta_time = time.time() - current_time
+        await writer.drain()
+        await reader.readexactly(1)
+        _mark(ret, 'ttfb', start)
+
+    try:
+        await asyncio.wait_for(run(), timeout)
+        ret['ok'] = True
+        ret['total'] = sum(ret[phase] for phase in PROBE_PHASES)
+    except asyncio.TimeoutError:
+        ret['error'] = 'timeout'
+    except (OSError, asyncio.IncompleteReadError, ssl.SSLError, ProbeError) as e:
+        ret['error'] = str(e) or type(e).__name__
+    finally:
+        if writer is not None:
+            writer.close()
+    return ret
+
+
+async def phase_ping(address: str, port: int, url: str = PROBE_URL, proxy_type: str = 'socks5',
+                     attempts: int = 3, interval: float = 0.2, timeout: float = 5) -> dict:
+    """
+    依次进行 attempts 次分阶段测试
+    :return: 各阶段耗时的中位数 (毫秒), 成功次数和丢失率, samples 为每次的 phase_probe 结果
+    """
+    samples = []
+    for i in range(attempts):
+        if i and interval:
+            await asyncio.sleep(interval)
+        samples.append(await phase_probe(address, port, url, proxy_type, timeout))
+
+    ok = [sample for sample in samples if sample['ok']]
+    ret = {'url': url, 'success': len(ok), 'loss': 1 - len(ok) / attempts if attempts else 1, 'samples': samples}
+    for phase in PROBE_PHASES + ('total',):
+        ret[phase] = percentile(sorted(sample[phase] for sample in ok), 50) if ok else None
+    return ret
+
+
+async def google_ping_task(loop, _list, address, port, timeout=3):
+    alt = fac = suc = 0
+    ret = await phase_probe(address, port, 'http://google.com/', timeout=timeout)
+    if ret['ok']:
+        # 与之前一致, 不包含连接本地端口的耗时
+        delta_time = (ret['total'] - ret['connect']) / 1000
         alt += delta_time
         suc += 1
         _list.append(delta_time)
-    except socket.timeout:
+    else:
         fac += 1
         _list.append(0)
-        logger.error(f"Google Ping Timeout {fac} times.")
-    except Exception:
-        logger.exception("Google Ping Exception:")
-        _list.append(0)
-        fac += 1
+        logger.error(f"Google Ping failed: {ret['error']}")
     return {"alt": alt, "fac": fac, "suc": suc}
 
 
-async def tcp_ping(address: str, port: int) -> tuple:
-    alt = fac = suc = 0
-    loop = asyncio.get_running_loop()
-    _list: list = []
-    test_ping = [
-        asyncio.create_task(tcp_ping_task(loop, _list, address, port)) for _ in range(3)
-    ]
-    done, _ = await asyncio.wait(test_ping, timeout=5)
-    for each in done:
-        result = each.result()
-        alt += result["alt"]
-        fac += result["fac"]
-        suc += result["suc"]
-    return (0, 0, _list) if suc == 0 else (alt / suc, suc / (suc + fac), _list)
+async def tcp_ping(address: str, port: int, attempts: int = 3, interval: float = 0, timeout: float = 3) -> tuple:
+    """
+    :return: (平均耗时, 成功率, 每次耗时), 耗时单位为秒, 失败的测试记为 0
+    """
+    stats = await tcp_ping_stats(address, port, attempts, interval, timeout)
+    if not stats['success']:
+        return 0, 0, [0] * attempts
+    _list = [delay / 1000 for delay in stats['samples']] + [0] * (attempts - stats['success'])
+    return stats['avg'] / 1000, stats['success'] / attempts, _list
 
 
 async def google_ping(address: str, port: int) -> tuple:
@@ -0,0 +1,164 @@
+import socket
+import asyncio
+import threading
+
+from typing import List, Optional, Set
+from loguru import logger
+
+PROC_NET_TCP = ('/proc/net/tcp', '/proc/net/tcp6')
+
+
+def scan_proc_ports(paths=PROC_NET_TCP) -> Optional[Set[int]]:
+    """
+    读取 /proc/net/tcp{,6} 中所有 socket 的本地端口
+    :return: 已占用的端口, 无法读取时 (非 Linux) 返回 None
+    """
+    ports = set()
+    found = False
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        found = True
+        for line in lines:
+            # sl local_address rem_address st ..., local_address 为 ip:port (十六进制)
+            fields = line.split()
+            if len(fields) > 1:
+                ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+    return ports if found else None
+
+
+def bind_scan_ports(start: int, end: int, host: str = '127.0.0.1') -> Set[int]:
+    """
+    依次 bind [start, end) 中的端口, 返回无法 bind 的端口, 用于无法读取 /proc 的平台
+    """
+    used = set()
+    for port in range(start, end):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                sock.bind((host, port))
+            except OSError:
+                used.add(port)
+    return used
+
+
+class PortBlock:
+    """
+    一段连续的本地端口, 在 release 之前不会再分配给其他任务
+    """
+
+    def __init__(self, start: int, count: int):
+        self.start = start
+        self.count = count
+
+    @property
+    def end(self) -> int:
+        return self.start + self.count
+
+    @property
+    def ports(self) -> List[int]:
+        return list(range(self.start, self.end))
+
+    def __contains__(self, port) -> bool:
+        return self.start <= port < self.end
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __repr__(self):
+        return f'PortBlock({self.start}-{self.end - 1})'
+
+
+class PortAllocator:
+    """
+    批量分配本地端口
+
+    一次扫描 /proc/net/tcp{,6} (或一次 bind 整个范围) 得到已占用的端口, 再找出连续的空闲区间
+    已分配的区间在 release 之前保留, 同一进程中并发的 checker 任务不会拿到相同的端口
+    """
+
+    def __init__(self, start: int = 20001, end: int = 65000, host: str = '127.0.0.1'):
+        """
+        init
+        :param start: 可分配的第一个端口
+        :param end: 可分配的最后一个端口 + 1
+        :param host: bind 扫描使用的地址
+        :return:
+        """
+        self.start = start
+        self.end = end
+        self.host = host
+        self._blocks: List[PortBlock] = []
+        self._lock = threading.Lock()
+
+    def _used_ports(self) -> Set[int]:
+        used = scan_proc_ports()
+        if used is None:
+            used = bind_scan_ports(self.start, self.end, self.host)
+        return used
+
+    def allocate(self, count: int, replace: Optional[PortBlock] = None) -> PortBlock:
+        """
+        分配 count 个连续端口
+        :param count: 端口数
+        :param replace: 被新区间替换的区间, 分配成功时在同一次加锁中释放
+                        其端口视为空闲, 例如即将被热加载替换的 listener 仍然占用的端口
+        :return: PortBlock
+        """
+        if count <= 0:
+            return PortBlock(self.start, 0)
+
+        used = self._used_ports()
+        with self._lock:
+            replaced = replace if replace is not None and replace in self._blocks else None
+            if replaced is not None:
+                used.difference_update(replaced.ports)
+            for block in self._blocks:
+                if block is not replaced:
+                    used.update(range(block.start, block.end))
+
+            run_start, run_len = self.start, 0
+            for port in range(self.start, self.end):
+                if port in used:
+                    run_start, run_len = port + 1, 0
+                    continue
+                run_len += 1
+                if run_len == count:
+                    block = PortBlock(run_start, count)
+                    if replaced is not None:
+                        self._blocks.remove(replaced)
+                    self._blocks.append(block)
+                    logger.info(f'allocate ports {block} for {count} proxies')
+                    return block
+
+        raise RuntimeError(f'no {count} contiguous free ports in [{self.start}, {self.end})')
+
+    async def async_allocate(self, count: int, replace: Optional[PortBlock] = None) -> PortBlock:
+        """
+        在默认线程池中执行 allocate, 整个批次只切换一次线程
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.allocate, count, replace)
+
+    def release(self, block: Optional[PortBlock]):
+        if block is None:
+            return
+        with self._lock:
+            if block in self._blocks:
+                self._blocks.remove(block)
+
+    def reserved(self) -> List[PortBlock]:
+        with self._lock:
+            return list(self._blocks)
+
+
+if __name__ == '__main__':
+    allocator = PortAllocator()
+    a = allocator.allocate(5000)
+    b = allocator.allocate(100)
+    print(a, b, allocator.reserved())
+    allocator.release(a)
+    allocator.release(b)
@@ -6,12 +6,25 @@ import asyncio
 import aiohttp
 from loguru import logger
 from proxy_check.client_launcher import MiHoMoClient
-from proxy_check.ping import tcp_ping, google_ping
+from proxy_check.port_allocator import PortAllocator
+from proxy_check.bandwidth import download_speed
+from proxy_check.concurrency import AimdController
+from proxy_check.ping import tcp_ping, google_ping, filter_reachable_proxies, phase_ping, ssl_context
 from aiohttp_socks import ProxyConnector
 
 current_dir = os.path.abspath(os.path.dirname(__file__))
 
 LOCAL_PORT = 20001
+# listener 模式下单个 http 检测的超时时间, 秒
+CHECK_TIMEOUT = 10
+CONTROLLER_PORT = 19090
+
+# delay 模式下包含整批代理的策略组, 用于 /group/{name}/delay
+DELAY_GROUP = 'CHECK'
+DELAY_TEST_URLS = ['https://www.gstatic.com/generate_204']
+
+# 同一进程中的所有 Checker 共用, 保证并发的批次分到不同的端口
+port_allocator = PortAllocator(LOCAL_PORT)
 
 mihomo_config_base = {
     'allow-lan': True,
@@ -82,6 +95,27 @@ async def async_connect_port(port):
         await asyncio.sleep(1)
 
 
+async def wait_port_open(port, timeout=5, interval=0.05, host='127.0.0.1'):
+    """
+    轮询直到端口可以连接
+    :param timeout: 最长等待时间, 秒
+    :param interval: 轮询间隔, 秒
+    :return: 是否可以连接
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=1)
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            pass
+        if loop.time() + interval >= deadline:
+            return False
+        await asyncio.sleep(interval)
+
+
 def sync_check_port(port: int):
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -99,24 +133,161 @@ def sync_check_port(port: int):
 
 
 class Checker:
-    def __init__(self):
+    def __init__(self, mode='listener', test_urls=None, delay_concurrency=32, delay_timeout=5000,
+                 delay_method='proxy', prefilter=False, prefilter_concurrency=500, phase_probe=False,
+                 phase_attempts=1, bandwidth_url=None, bandwidth_bytes=10 * 1024 * 1024, bandwidth_time=10,
+                 bandwidth_concurrency=4, controller=None):
+        """
+        init
+        :param mode: listener: 每个代理一个本地端口, 通过端口发送 http 请求
+                     delay: 不创建 listener, 通过 external-controller 在 mihomo 内测试延迟
+        :param test_urls: delay 模式的测试地址, 任一地址测试成功即视为可用
+        :param delay_concurrency: delay 模式同时测试的初始代理数, 只对 delay_method='proxy' 生效
+        :param delay_timeout: delay 模式单次测试的超时时间, 毫秒
+        :param delay_method: proxy: 逐个调用 /proxies/{name}/delay; group: 调用 /group/{name}/delay 一次测试整批
+        :param prefilter: 加载配置前先用 tcp 连接过滤端口不通的代理, 被过滤的代理记为不可用
+        :param prefilter_concurrency: tcp 预过滤的最大同时连接数
+        :param phase_probe: listener 模式下对可用的代理再做一次分阶段测试, 结果记录在 phases 和 ttfb 中
+        :param phase_attempts: 分阶段测试的次数, 取各阶段的中位数
+        :param bandwidth_url: listener 模式下对可用的代理测试下载速度的地址, None 时不测速
+        :param bandwidth_bytes: 每个代理最多下载的字节数
+        :param bandwidth_time: 每个代理最长的下载时间, 秒
+        :param bandwidth_concurrency: 同时测速的代理数, 避免互相抢占带宽
+        :param controller: AimdController, 根据超时比例和延迟调整同时检测的代理数, 可以和其他任务共用
+                           默认以 _connection (delay 模式为 delay_concurrency) 为初始值新建一个
+        :return:
+        """
         self.tmp_dir = os.path.join(current_dir, 'tmp')
         self._debug = True
         self._results = []
         self._connection = 50
 
+        self.mode = mode
+        self.test_urls = test_urls or DELAY_TEST_URLS
+        self.delay_concurrency = delay_concurrency
+        self.delay_timeout = delay_timeout
+        self.delay_method = delay_method
+        self.prefilter = prefilter
+        self.prefilter_concurrency = prefilter_concurrency
+        self.phase_probe = phase_probe
+        self.phase_attempts = phase_attempts
+        self.bandwidth_url = bandwidth_url
+        self.bandwidth_bytes = bandwidth_bytes
+        self.bandwidth_time = bandwidth_time
+        self.bandwidth_concurrency = bandwidth_concurrency
+        self._bandwidth_sem = None
+
+        initial = delay_concurrency if mode == 'delay' else self._connection
+        self.controller = controller or AimdController(initial=initial, name='checker')
+
+        # 常驻的 mihomo 进程, 每批代理通过 external-controller 热加载配置
+        self._client = None
+        self._client_lock = None
+        # 当前批次保留的端口区间, 常驻进程的 listener 占用, 下一批可以复用
+        self._port_block = None
+        # 每批测试共用的 http session, 通过本地 listener 的连接可以复用
+        self._session = None
+
     @staticmethod
-    def _get_client(confile_file):
-        client = MiHoMoClient(confile_file)
+    def _get_client(confile_file, controller_port=None):
+        client = MiHoMoClient(confile_file, controller_port)
         return client
 
-    async def _async_start_client(self):
-        pass
+    async def _allocate_controller_port(self):
+        port = CONTROLLER_PORT
+        while not await is_port_available(port):
+            port += 1
+        return port
+
+    async def _async_start_client(self, cfg):
+        """
+        启动新的 mihomo 进程并等待 external-controller 就绪, 失败时重试 3 次
+        """
+        await self._async_stop_client()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        for _ in range(4):
+            controller_port = await self._allocate_controller_port()
+            client = self._get_client(os.path.join(self.tmp_dir, f"mihomo_{id(self)}.yml"), controller_port)
+            await client.start_client(cfg, self._debug)
+            if await client.wait_ready():
+                self._client = client
+                return True
+            await client.close_session()
+            client.stop_client()
+        logger.error("Failed to start clients.")
+        return False
 
-    def get_mihomo_config(self, proxies):
+    async def _apply_config(self, cfg):
+        """
+        进程存活时热加载配置, 否则 (或加载失败时) 重新启动进程
+        """
+        if self._client is not None and self._client.check_alive():
+            if await self._client.reload_config(cfg):
+                return True
+            logger.warning("Reload config failed, restarting client.")
+        return await self._async_start_client(cfg)
+
+    async def _wait_listeners(self, proxies, timeout=5):
+        """
+        等待所有 listener 端口可以连接
+        :return: 未就绪的端口
+        """
+        ports = [proxy['local_port'] for proxy in proxies]
+        ready = await asyncio.gather(*[wait_port_open(port, timeout) for port in ports])
+        return [port for port, ok in zip(ports, ready) if not ok]
+
+    def _stop_client(self):
+        if self._client is not None:
+            # 异步路径已先关闭, 这里只处理同步的 close / __exit__
+            self._client.close_session_nowait()
+            self._client.stop_client()
+            self._client = None
+
+    async def _async_stop_client(self):
+        """
+        先在当前事件循环中关闭控制接口的 session, 再停止进程
+        """
+        if self._client is not None:
+            await self._client.close_session()
+        self._stop_client()
+
+    def close(self):
+        """
+        关闭控制接口的 session, 停止常驻的 mihomo 进程并释放保留的端口
+        同步使用时 (with Checker()) 需要在创建 session 的事件循环关闭之前调用, 否则只能记录警告
+        """
+        self._stop_client()
+        port_allocator.release(self._port_block)
+        self._port_block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._close_session()
+        await self._async_stop_client()
+        self.close()
+
+    def get_mihomo_config(self, proxies, listener=True):
         config = copy.deepcopy(mihomo_config_base)
         listeners = []
 
+        if not listener:
+            config['proxies'] = proxies
+            if proxies:
+                config['proxy-groups'] = [{
+                    'name': DELAY_GROUP,
+                    'type': 'select',
+                    'proxies': [proxy['name'] for proxy in proxies],
+                }]
+            return config
+
         for proxy in proxies:
             port = proxy.get('local_port')
             listeners.append({
@@ -138,25 +309,20 @@ class Checker:
             )
 
         port = proxy['local_port']
-        if not await async_connect_port(port):
-            for _ in range(3):
-                if await async_connect_port(port):
-                    break
-            else:
-                logger.error(f"Port {port} closed.")
-                return False
+        if not await wait_port_open(port, timeout=3):
+            logger.error(f"Port {port} closed.")
+            return False
 
         await test_method(proxy)
 
     async def allocate_proxies_ports(self, proxies):
-        port = LOCAL_PORT
-        for proxy in proxies:
-            while not await is_port_available(port):
-                logger.info(f'port: {port} is not available now.')
-                port += 1
+        block = self._port_block
+        if block is None or len(block) < len(proxies):
+            # 上一批的 listener 由常驻进程占用, 热加载时会被替换, 由 allocate 释放并视为空闲
+            self._port_block = await port_allocator.async_allocate(len(proxies), replace=block)
+
+        for proxy, port in zip(proxies, self._port_block.ports):
             proxy['local_port'] = port
-            logger.info(f'allocate port:{port} to proxy: {proxy.get("name")}')
-            port += 1
 
     @staticmethod
     def start_tcp_ping(server, port):
@@ -166,63 +332,160 @@ class Checker:
     def start_google_ping(address, port):
         return google_ping(address, port)
 
-    async def check_http_proxy_valiable(self, proxy, test_url="https://www.qq.com"):
+    def _new_session(self, limit=None):
+        connector = aiohttp.TCPConnector(
+            limit=limit or self.controller.max_limit,
+            # 每个本地 listener 是一个 host, 同一代理的请求复用少量连接
+            limit_per_host=4,
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+            ssl=ssl_context,
+        )
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=CHECK_TIMEOUT))
+
+    async def _open_session(self, limit=None):
+        await self._close_session()
+        self._session = self._new_session(limit)
+        return self._session
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def check_http_proxy_valiable(self, proxy, test_url="https://www.qq.com", raise_local=False):
+        """
+        :param raise_local: 连不上代理地址 (本地 listener) 时抛出 aiohttp.ClientProxyConnectionError
+        """
+        session = self._session
         try:
-            timeout = aiohttp.ClientTimeout(total=10)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.head(test_url, headers=headers, proxy=proxy, ssl=False) as resp:
-                    return resp.status == 200
+            if session is None:
+                async with self._new_session(1) as session:
+                    async with session.head(test_url, headers=headers, proxy=proxy) as resp:
+                        return resp.status == 200
+            async with session.head(test_url, headers=headers, proxy=proxy) as resp:
+                return resp.status == 200
+        except aiohttp.ClientProxyConnectionError:
+            if raise_local:
+                raise
+            return False
         except Exception as e:
             return False
 
     async def check_socks_proxy_valiable(self, proxy, test_url="https://www.qq.com"):
         try:
-            connector = ProxyConnector.from_url(proxy)
+            # socks 代理只能在 connector 上指定, 每个代理一个 connector, 共用 SSL context
+            connector = ProxyConnector.from_url(proxy, ssl=ssl_context, ttl_dns_cache=300)
             async with aiohttp.ClientSession(
                     connector=connector,
                     timeout=aiohttp.ClientTimeout(connect=10, sock_connect=10, sock_read=10)
-            ) as session, session.head(test_url, headers=headers, ssl=False) as resp:
+            ) as session, session.head(test_url, headers=headers) as resp:
                 return resp.status == 200
         except Exception as e:
             # logger.exception(f'socksTimeOutValidator error: {e}')
             return False
 
+    async def _prefilter(self, proxies):
+        """
+        tcp 预过滤, 不可达的代理直接记录为不可用
+        :return: 需要继续检测的代理
+        """
+        kept, dropped = await filter_reachable_proxies(proxies, concurrency=self.prefilter_concurrency)
+        for proxy in dropped:
+            self._results.append({
+                'name': proxy['name'],
+                'server': proxy['server'],
+                'port': proxy['port'],
+                'valid': False,
+                'unreachable': True,
+            })
+        return kept
+
     async def _run(self, proxies):
-        lock = asyncio.Lock()
-        dic = {"done_nodes": 0, "total_nodes": len(proxies)}
+        if self._client_lock is None:
+            self._client_lock = asyncio.Lock()
 
-        await self.allocate_proxies_ports(proxies)
+        if self.prefilter:
+            proxies = await self._prefilter(proxies)
 
-        name = asyncio.current_task().get_name()
-        config_file_path = os.path.join(self.tmp_dir, f"{name}.yml")
-        client = self._get_client(config_file_path)
-        if not client:
-            return False
+        if self.mode == 'delay':
+            async with self._client_lock:
+                return await self._run_delay(proxies)
 
-        cfg = self.get_mihomo_config(proxies)
-        await client.start_client(cfg, self._debug)
-        if not client.check_alive():
-            for _ in range(3):
-                await client.start_client(cfg, self._debug)
-                if client.check_alive():
-                    break
-            else:
-                logger.error("Failed to start clients.")
+        # 多个批次共用一个进程, 依次加载配置并测试
+        async with self._client_lock:
+            lock = asyncio.Lock()
+            dic = {"done_nodes": 0, "total_nodes": len(proxies)}
+
+            await self.allocate_proxies_ports(proxies)
+
+            cfg = self.get_mihomo_config(proxies)
+            if not await self._apply_config(cfg):
                 return False
 
-        await asyncio.sleep(10)
+            not_ready = await self._wait_listeners(proxies)
+            if not_ready:
+                logger.warning(f"Listeners not ready: {not_ready}")
 
-        # 布置异步任务
-        task_list = [
-            asyncio.create_task(self._async__start_test(dic, lock, proxy, self.start_test))
-            for proxy in proxies
-        ]
+            await self._open_session(min(len(proxies), self.controller.max_limit) or None)
+            try:
+                # 布置异步任务
+                task_list = [
+                    asyncio.create_task(self._async__start_test(dic, lock, proxy, self.start_test))
+                    for proxy in proxies
+                ]
 
-        await asyncio.wait(task_list)
+                if task_list:
+                    await asyncio.wait(task_list)
+            finally:
+                await self._close_session()
 
-        if client:
-            client.stop_client()
+        return self._results
 
+    async def _run_delay(self, proxies):
+        """
+        delay 模式: 加载不含 listener 的配置, 整批代理在 mihomo 内测试
+        """
+        cfg = self.get_mihomo_config(proxies, listener=False)
+        if not await self._apply_config(cfg):
+            return False
+        port_allocator.release(self._port_block)
+        self._port_block = None
+
+        delays = {proxy['name']: {} for proxy in proxies}
+        for url in self.test_urls:
+            if self.delay_method == 'group':
+                ret = await self._client.group_delay(DELAY_GROUP, url, self.delay_timeout) if proxies else {}
+                for name in delays:
+                    delays[name][url] = ret.get(name)
+            else:
+                async def test(name):
+                    async with self.controller.async_slot() as slot:
+                        try:
+                            delay = await self._client.proxy_delay(name, url, self.delay_timeout, raise_local=True)
+                        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+                            # 控制接口没有响应是本机饱和, 失效代理由 mihomo 返回失败, 不影响并发数
+                            delay = None
+                            slot.timeout = True
+                        delays[name][url] = delay
+                        # 失败的测试不参与延迟统计
+                        slot.measure = delay is not None
+
+                await asyncio.gather(*[test(name) for name in delays])
+
+        available = 0
+        for proxy in proxies:
+            ok = [delay for delay in delays[proxy['name']].values() if delay]
+            available += bool(ok)
+            self._results.append({
+                'name': proxy['name'],
+                'server': proxy['server'],
+                'port': proxy['port'],
+                'delays': delays[proxy['name']],
+                'delay': min(ok) if ok else None,
+                'valid': bool(ok),
+            })
+        logger.info(f"Delay test finished, {available}/{len(proxies)} available.")
         return self._results
 
     def get_test_url(self, proxy):
@@ -232,15 +495,43 @@ class Checker:
 
     async def start_test(self, proxy):
         res = {
+            'name': proxy['name'],
             'server': proxy['server'],
             'port': proxy['port'],
             'local_port': proxy['local_port'],
         }
         address, port = '127.0.0.1', int(proxy['local_port'])
         proxy_str = f'http://{address}:{port}'
-        res['valid'] = await self.check_http_proxy_valiable(proxy_str)
+        async with self.controller.async_slot() as slot:
+            try:
+                res['valid'] = await self.check_http_proxy_valiable(proxy_str, raise_local=True)
+            except aiohttp.ClientProxyConnectionError:
+                # 连不上本地的 listener 是本机饱和, 失效代理的失败不影响并发数
+                res['valid'] = False
+                slot.timeout = True
+            # 失败的检测不参与延迟统计
+            slot.measure = res['valid']
+        if res['valid'] and self.phase_probe:
+            # mixed listener 同时支持 socks5, 按阶段区分核心和上游的耗时
+            phases = await phase_ping(address, port, self.get_test_url(proxy), attempts=self.phase_attempts)
+            phases.pop('samples')
+            res['phases'] = phases
+            res['ttfb'] = phases['ttfb']
+        if res['valid'] and self.bandwidth_url:
+            res['bandwidth'] = await self.start_bandwidth_test(proxy_str)
         self._results.append(res)
 
+    async def start_bandwidth_test(self, proxy_str):
+        if self._bandwidth_sem is None:
+            self._bandwidth_sem = asyncio.Semaphore(self.bandwidth_concurrency)
+        async with self._bandwidth_sem:
+            if self._session is not None:
+                return await download_speed(self._session, self.bandwidth_url, proxy_str, self.bandwidth_bytes,
+                                            self.bandwidth_time)
+            async with self._new_session(1) as session:
+                return await download_speed(session, self.bandwidth_url, proxy_str, self.bandwidth_bytes,
+                                            self.bandwidth_time)
+
     async def start_test_back(self, proxy):
         res = {
             'server': proxy['server'],
@@ -276,8 +567,17 @@ class Checker:
     def get_result(self):
         return self._results
 
+    async def check(self, proxies):
+        """
+        检测一批代理, 可以多次调用, 共用常驻的 mihomo 进程
+        :return: 本批的检测结果, 每项包含 name / valid, 开启时还有 phases / ttfb / bandwidth
+        """
+        self._results = []
+        return await self._run(proxies) or []
+
     async def main(self):
-        await self.allocate_proxies_ports([{} for _ in range(self._connection)])
+        async with self:
+            await self.allocate_proxies_ports([{} for _ in range(self._connection)])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,93 @@
+from config import redis_conn
+from proxy_db.db_client import DbClient
+
+
+class _Unsupported:
+    """
+    async client 没有实现的 DbClient 方法, 访问时抛出 AttributeError, hasattr 返回 False
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        raise AttributeError(f'{self.name} is not supported by AsyncDbClient, use DbClient')
+
+
+class AsyncDbClient(DbClient):
+    """
+    DbClient 的 asyncio 版本, 表切换方式与 DbClient 相同, 所有读写方法都需要 await
+    目前只支持 redis, 变更流和工作队列只能使用 DbClient
+
+    没有额外逻辑的方法直接复用 DbClient, 返回 client 的协程
+    """
+    client_prefix = 'async_'
+
+    # 读缓存只支持同步 client
+    cache_size = 0
+
+    warm_cache = _Unsupported()
+    change_group_create = _Unsupported()
+    change_read = _Unsupported()
+    change_ack = _Unsupported()
+    change_lost = _Unsupported()
+    queue_push = _Unsupported()
+    queue_claim = _Unsupported()
+    queue_ack = _Unsupported()
+    queue_dead = _Unsupported()
+    queue_retry_dead = _Unsupported()
+    queue_reclaim = _Unsupported()
+    queue_length = _Unsupported()
+
+    async def purge_expired(self, grace=0):
+        return await self.client.purge_expired(grace)
+
+    async def put(self, key, val, **kwargs):
+        if self.indexers:
+            return await self.put_many({key: val}, **kwargs)
+        return await self.client.put(key, val, **kwargs)
+
+    async def put_many(self, items, **kwargs):
+        if self.indexers:
+            await self.update_indexes(items)
+        return await self.client.put_many(items, **kwargs)
+
+    async def update_indexes(self, items, check_old=True):
+        keys = list(items.keys())
+        olds = await self.client.get_many(keys) if check_old else [None] * len(keys)
+        adds, removes = {}, {}
+        for key, old in zip(keys, olds):
+            new_indexes = self.get_index_values(items[key])
+            old_indexes = self.get_index_values(old) if old is not None else set()
+            for index in new_indexes - old_indexes:
+                adds.setdefault(index, []).append(key)
+            for index in old_indexes - new_indexes:
+                removes.setdefault(index, []).append(key)
+        await self.client.index_update(adds, removes)
+
+    async def reindex(self):
+        chunk = {}
+        async for key, item in self.iter_items():
+            chunk[key] = item
+            if len(chunk) >= self.client.batch_size:
+                await self.update_indexes(chunk, check_old=False)
+                chunk = {}
+        if chunk:
+            await self.update_indexes(chunk, check_old=False)
+
+    async def close(self):
+        await self.client.close()
+
+
+if __name__ == '__main__':
+    import asyncio
+
+
+    async def main():
+        client = AsyncDbClient(redis_conn)
+        client.change_table('sub_proxy')
+        print(await client.get_count())
+        await client.close()
+
+
+    asyncio.run(main())
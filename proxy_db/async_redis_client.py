@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+import time
+import uuid
+import weakref
+from datetime import datetime
+
+from redis.asyncio import Redis
+from redis.asyncio.connection import BlockingConnectionPool
+from redis.exceptions import TimeoutError, ConnectionError, ResponseError
+from loguru import logger
+
+from redis_client import RedisTableMixin, RECORD_CHECK_RESULTS_SCRIPT, PUT_WITH_CHANGES_SCRIPT, UPDATE_EWMA_SCRIPT
+
+
+# 异步连接池绑定事件循环, 按事件循环分别共享
+_connection_pools = weakref.WeakKeyDictionary()
+
+
+def get_connection_pool(**kwargs):
+    """
+    返回当前事件循环中连接参数对应的共享连接池, 不在事件循环中时创建独立的连接池
+    :param kwargs: BlockingConnectionPool 参数
+    :return: BlockingConnectionPool
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return BlockingConnectionPool(**kwargs)
+
+    pools = _connection_pools.setdefault(loop, {})
+    key = tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+    if key not in pools:
+        pools[key] = BlockingConnectionPool(**kwargs)
+    return pools[key]
+
+
+class AsyncRedisClient(RedisTableMixin):
+    """
+    基于 redis.asyncio 的 Redis client, 供 asyncio 检测任务使用, 不阻塞事件循环
+
+    存储结构与 RedisClient 相同, 两者可以同时读写同一张表
+    """
+
+    # 批量操作时每个 pipeline 包含的字段数
+    batch_size = 500
+
+    # 可选功能, 见 DbClient.supports, 变更流和工作队列只有同步 client 实现
+    features = frozenset()
+
+    # 服务端是否支持 HRANDFIELD, 首次失败后退化为 HKEYS
+    _hrandfield_supported = True
+
+    def __init__(self, **kwargs):
+        """
+        init
+        :param host: host
+        :param port: port
+        :param password: password
+        :param db: db
+        :param codec: ValueCodec, 默认为 json
+        :param change_feed_tables: 写入时记录变更流的表
+        :param change_feed_maxlen: 变更流的最大长度
+        :return:
+        """
+        kwargs.pop("username", None)
+        self.codec = kwargs.pop("codec", None) or self.codec
+        self._init_change_feed(kwargs)
+        self.__conn = Redis(connection_pool=get_connection_pool(decode_responses=True,
+                                                                timeout=5,
+                                                                socket_timeout=5,
+                                                                **kwargs))
+        # 代理属性可能是二进制格式, 读取时使用不解码的连接
+        self.__raw = Redis(connection_pool=get_connection_pool(decode_responses=False,
+                                                               timeout=5,
+                                                               socket_timeout=5,
+                                                               **kwargs))
+        self.__record_check_results = self.__conn.register_script(RECORD_CHECK_RESULTS_SCRIPT)
+        self.__put_with_changes = self.__conn.register_script(PUT_WITH_CHANGES_SCRIPT)
+        self.__update_ewma = self.__conn.register_script(UPDATE_EWMA_SCRIPT)
+
+    async def get(self, key):
+        """
+        返回一个代理
+        :return: 代理属性字典, 不存在时为 None
+        """
+        return self._decode(key, await self.__raw.hget(self.name, key))
+
+    async def get_version(self):
+        """
+        返回表的版本号, 每次写入或删除后加一
+        :return:
+        """
+        return int(await self.__conn.get(self._version_key()) or 0)
+
+    async def get_many(self, keys, batch=None):
+        """
+        批量返回代理, 每 batch 个 key 一次 HMGET
+        :return: 与 keys 顺序一致的列表, 不存在的 key 为 None
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        ret = []
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            ret.extend(self._decode(k, v) for k, v in zip(chunk, await self.__raw.hmget(self.name, chunk)))
+        return ret
+
+    async def get_entry(self, key):
+        """
+        返回代理和过期时间, 与 RedisClient.get_entry 相同
+        :return: (代理属性字典, 过期的时间戳)
+        """
+        pipe = self.__raw.pipeline(transaction=False)
+        pipe.hget(self.name, key)
+        pipe.zscore(self._expire_key(), key)
+        val, expires_at = await pipe.execute()
+        return self._decode(key, val), expires_at
+
+    async def purge_expired(self, grace=0):
+        """
+        删除过期的代理及其状态和索引
+        :param grace: 过期超过 grace 秒后才删除
+        :return: 删除数量
+        """
+        keys = await self.__conn.zrangebyscore(self._expire_key(), '-inf', time.time() - grace)
+        if not keys:
+            return 0
+        return await self.delete_many(keys)
+
+    async def put(self, key, val, ttl=None):
+        """
+        将代理放入hash, 使用 change_table 指定 hash name
+        :param ttl: 有效期, 秒, 为 None 时保留原有的过期时间, 为 0 时不过期
+        :return:
+        """
+        pipe = self.__conn.pipeline(transaction=False)
+        await self._hset(pipe, {key: self._encode(val)})
+        self._set_expire(pipe, [key], ttl)
+        pipe.incr(self._version_key())
+        return (await pipe.execute())[0]
+
+    async def put_many(self, items, batch=None, ttl=None):
+        """
+        批量写入, 每 batch 个字段一次 HSET, 按批提交 pipeline
+        :return: 新增字段数
+        """
+        batch = batch or self.batch_size
+        items = [(k, self._encode(v)) for k, v in items.items()]
+        added = 0
+        for i in range(0, len(items), batch):
+            chunk = dict(items[i:i + batch])
+            pipe = self.__conn.pipeline(transaction=False)
+            await self._hset(pipe, chunk)
+            self._set_expire(pipe, chunk.keys(), ttl)
+            added += (await pipe.execute())[0]
+        if items:
+            await self.__conn.incr(self._version_key())
+        return added
+
+    async def delete(self, proxy_key):
+        """
+        移除指定代理及其状态和索引
+        :return:
+        """
+        return await self.delete_many([proxy_key])
+
+    async def delete_many(self, keys, batch=None):
+        """
+        批量移除, 每 batch 个 key 一次 HDEL
+        :return: 删除数量
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        deleted = 0
+        for i in range(0, len(keys), batch):
+            pipe = self.__conn.pipeline(transaction=False)
+            pipe.hdel(self.name, *keys[i:i + batch])
+            await self._remove_related(pipe, keys[i:i + batch])
+            self._log_changes(pipe, 'delete', keys[i:i + batch])
+            deleted += (await pipe.execute())[0]
+        if keys:
+            await self.__conn.incr(self._version_key())
+        return deleted
+
+    async def exists(self, proxy_str):
+        """
+        判断指定代理是否存在
+        :return:
+        """
+        return await self.__conn.hexists(self.name, proxy_str)
+
+    async def exists_many(self, keys, batch=None):
+        """
+        批量判断是否存在, 每 batch 个 HEXISTS 一次 pipeline
+        :return: 与 keys 顺序一致的 bool 列表
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        ret = []
+        for i in range(0, len(keys), batch):
+            pipe = self.__conn.pipeline(transaction=False)
+            for key in keys[i:i + batch]:
+                pipe.hexists(self.name, key)
+            ret.extend(bool(x) for x in await pipe.execute())
+        return ret
+
+    async def get_all(self):
+        """
+        字典形式返回所有代理
+        :return:
+        """
+        items = [self._decode(self.name, item) for item in await self.__raw.hvals(self.name)]
+        return [item for item in items if item is not None]
+
+    async def get_all_items(self):
+        """
+        返回所有代理
+        :return: {key: 代理属性字典}
+        """
+        items = {}
+        for key, val in (await self.__raw.hgetall(self.name)).items():
+            key = self._decode_key(key)
+            item = self._decode(key, val)
+            if item is not None:
+                items[key] = item
+        return items
+
+    async def iter_items(self, batch=None, with_status=False):
+        """
+        使用 HSCAN 遍历 hash, 逐个解析返回
+        :return: (key, 代理属性字典) 异步生成器
+        """
+        batch = batch or self.batch_size
+        fields = sorted(await self.__conn.smembers(self._status_fields_key())) if with_status else []
+        cursor = '0'
+        while True:
+            cursor, data = await self.__raw.hscan(self.name, cursor, count=batch)
+            data = {self._decode_key(key): val for key, val in data.items()}
+            status = await self.get_status_many(data.keys(), fields) if fields and data else {}
+            for key, val in data.items():
+                item = self._decode(key, val)
+                if item is None:
+                    continue
+                if key in status:
+                    item.update(status[key])
+                yield key, item
+            if int(cursor) == 0:
+                break
+
+    async def get_random(self, n=None):
+        """
+        随机返回代理, 与 RedisClient.get_random 相同
+        :param n: 返回数量, 为 None 时返回单个代理
+        """
+        count = n or 1
+        if self._hrandfield_supported:
+            try:
+                items = await self.__raw.hrandfield(self.name, count, withvalues=True) or []
+                values = [self._decode(k, v) for k, v in zip(items[::2], items[1::2])]
+                return values if n else (values[0] if values else None)
+            except ResponseError as e:
+                logger.warning(f'hrandfield unsupported, fallback to hkeys: {e}')
+                AsyncRedisClient._hrandfield_supported = False
+
+        proxies = await self.__conn.hkeys(self.name)
+        keys = random.sample(proxies, min(count, len(proxies)))
+        values = [self._decode(k, v) for k, v in zip(keys, await self.__raw.hmget(self.name, keys))] if keys else []
+        return values if n else (values[0] if values else None)
+
+    async def get_random_where(self, index, n=1):
+        """
+        从子集索引中随机返回代理, 与 RedisClient.get_random_where 相同
+        """
+        index_key = self._index_key(index)
+        keys = await self.__conn.srandmember(index_key, n)
+        if not keys:
+            return []
+
+        values = await self.__raw.hmget(self.name, keys)
+        stale = [k for k, v in zip(keys, values) if v is None]
+        if stale:
+            await self.__conn.srem(index_key, *stale)
+        values = [self._decode(k, v) for k, v in zip(keys, values) if v is not None]
+        return [v for v in values if v is not None]
+
+    async def get_status(self, key, fields=None):
+        return (await self.get_status_many([key], fields)).get(key, {})
+
+    async def get_status_many(self, keys, fields=None, batch=None):
+        """
+        批量返回状态记录
+        :return: {key: {field: val}}, 没有状态的 key 不返回
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        fields = list(fields) if fields else sorted(await self.__conn.smembers(self._status_fields_key()))
+        ret = {}
+        if not keys or not fields:
+            return ret
+
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            pipe = self.__conn.pipeline(transaction=False)
+            for field in fields:
+                pipe.hmget(self._status_key(field), chunk)
+            for field, values in zip(fields, await pipe.execute()):
+                for key, val in zip(chunk, values):
+                    if val is not None:
+                        ret.setdefault(key, {})[field] = self._decode_status(val)
+        return ret
+
+    async def status_incr_many(self, incrs, batch=None):
+        await self._write_status(incrs, lambda pipe, name, key, val: pipe.hincrby(name, key, val), batch)
+
+    async def status_set_many(self, values, batch=None):
+        await self._write_status(values, lambda pipe, name, key, val: pipe.hset(name, key, val), batch)
+
+    async def status_delete_many(self, keys, batch=None):
+        """
+        批量删除状态记录, 与 RedisClient.status_delete_many 相同
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        fields = await self.__conn.smembers(self._status_fields_key())
+        for i in range(0, len(keys), batch):
+            pipe = self.__conn.pipeline(transaction=False)
+            for field in fields:
+                pipe.hdel(self._status_key(field), *keys[i:i + batch])
+            await pipe.execute()
+
+    async def record_check_results(self, results, threshold, index=None, batch=None):
+        """
+        原子地批量记录检测结果, 与 RedisClient.record_check_results 相同
+        :return: 被删除的 key 列表
+        """
+        batch = batch or self.batch_size
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        index_key = self._index_key(index) if index else ''
+        items = list(results.items())
+        evicted = []
+        feed_maxlen = self.change_feed_maxlen if self._feed_enabled() else ''
+        for i in range(0, len(items), batch):
+            args = [threshold, now, index_key, feed_maxlen]
+            for key, ok in items[i:i + batch]:
+                args.extend([key, 1 if ok else 0])
+            evicted.extend(await self.__record_check_results(keys=[self.name], args=args))
+        return evicted
+
+    async def update_ewma(self, results, alpha=0.3, score=None, batch=None):
+        """
+        原子地批量更新延迟和成功率的指数加权平均, 与 RedisClient.update_ewma 相同
+        :return: 更新的 key 数
+        """
+        batch = batch or self.batch_size
+        score_key = self._score_key(score) if score else ''
+        items = list(results.items())
+        updated = 0
+        for i in range(0, len(items), batch):
+            args = [alpha, score_key]
+            for key, latency in items[i:i + batch]:
+                args.extend([key, 0 if latency is None else 1, '' if latency is None else latency])
+            updated += await self.__update_ewma(keys=[self.name], args=args)
+        return updated
+
+    async def _hset(self, pipe, mapping):
+        """
+        在 pipeline 中写入, 与 RedisClient._hset 相同
+        """
+        if not self._feed_enabled():
+            pipe.hset(self.name, mapping=mapping)
+            return
+        args = [self.change_feed_maxlen]
+        for key, val in mapping.items():
+            args.extend([key, val])
+        await self.__put_with_changes(keys=[self.name, self._changes_key()], args=args, client=pipe)
+
+    async def index_add(self, index, keys):
+        """
+        将 key 加入子集索引
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.sadd(self._indexes_key(), self._index_key(index))
+        pipe.sadd(self._index_key(index), *keys)
+        return (await pipe.execute())[-1]
+
+    async def index_remove(self, index, keys):
+        """
+        将 key 从子集索引移除
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        return await self.__conn.srem(self._index_key(index), *keys)
+
+    async def index_count(self, index):
+        """
+        返回子集索引中的 key 数量
+        """
+        return await self.__conn.scard(self._index_key(index))
+
+    async def index_update(self, adds=None, removes=None):
+        """
+        在一个 pipeline 中批量更新多个子集索引
+        """
+        pipe = self.__conn.pipeline(transaction=False)
+        for index, keys in (removes or {}).items():
+            if keys:
+                pipe.srem(self._index_key(index), *keys)
+        for index, keys in (adds or {}).items():
+            if keys:
+                pipe.sadd(self._indexes_key(), self._index_key(index))
+                pipe.sadd(self._index_key(index), *keys)
+        return await pipe.execute()
+
+    async def score_set_many(self, score, values, nx=False):
+        """
+        写入排序索引
+        """
+        if not values:
+            return 0
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.sadd(self._scores_key(), self._score_key(score))
+        pipe.zadd(self._score_key(score), values, nx=nx)
+        return (await pipe.execute())[-1]
+
+    async def score_range(self, score, min='-inf', max='+inf', limit=None):
+        """
+        按分值范围返回排序索引中的 key, 与 RedisClient.score_range 相同
+        :return: [(key, 分值)]
+        """
+        if limit is None:
+            return await self.__conn.zrangebyscore(self._score_key(score), min, max, withscores=True)
+        return await self.__conn.zrangebyscore(self._score_key(score), min, max, start=0, num=limit,
+                                               withscores=True)
+
+    async def score_backfill(self, score, value, batch=None):
+        """
+        将表中不在排序索引中的 key 以 value 为分值加入索引
+        :return: 加入的数量
+        """
+        if await self.__conn.zcard(self._score_key(score)) >= await self.__conn.hlen(self.name):
+            return 0
+
+        added, keys = 0, []
+        async for key, _ in self.__raw.hscan_iter(self.name, count=batch or self.batch_size):
+            keys.append(self._decode_key(key))
+            if len(keys) >= (batch or self.batch_size):
+                added += await self.score_set_many(score, dict.fromkeys(keys, value), nx=True)
+                keys = []
+        added += await self.score_set_many(score, dict.fromkeys(keys, value), nx=True)
+        return added
+
+    async def score_remove(self, score, keys):
+        """
+        将 key 从排序索引移除
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        return await self.__conn.zrem(self._score_key(score), *keys)
+
+    async def top_n(self, score, n=20, indexes=None, desc=False):
+        """
+        按排序索引返回前 n 个代理, 与 RedisClient.top_n 相同
+        :return: [(key, 代理属性字典)]
+        """
+        score_key = self._score_key(score)
+        if indexes:
+            tmp_key = f'{self.name}:tmp:{uuid.uuid4().hex}'
+            weights = {score_key: 1}
+            weights.update({self._index_key(index): 0 for index in indexes})
+            pipe = self.__conn.pipeline()
+            pipe.zinterstore(tmp_key, weights)
+            pipe.zrange(tmp_key, 0, n - 1, desc=desc)
+            pipe.delete(tmp_key)
+            keys = (await pipe.execute())[1]
+        else:
+            keys = await self.__conn.zrange(score_key, 0, n - 1, desc=desc)
+
+        if not keys:
+            return []
+
+        ret, stale = [], []
+        for key, val in zip(keys, await self.__raw.hmget(self.name, keys)):
+            if val is None:
+                stale.append(key)
+                continue
+            item = self._decode(key, val)
+            if item is not None:
+                ret.append((key, item))
+        # 主表中已不存在的 key, 从排序索引中清理
+        if stale:
+            await self.__conn.zrem(score_key, *stale)
+        return ret
+
+    async def _write_status(self, items, write, batch):
+        batch = batch or self.batch_size
+        items = list(items.items())
+        for i in range(0, len(items), batch):
+            fields = set()
+            pipe = self.__conn.pipeline(transaction=False)
+            for key, values in items[i:i + batch]:
+                for field, val in values.items():
+                    fields.add(field)
+                    write(pipe, self._status_key(field), key, val)
+            if fields:
+                pipe.sadd(self._status_fields_key(), *fields)
+            await pipe.execute()
+
+    async def _related_keys(self):
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.smembers(self._indexes_key())
+        pipe.smembers(self._scores_key())
+        pipe.smembers(self._status_fields_key())
+        index_keys, score_keys, fields = await pipe.execute()
+        return list(index_keys), list(score_keys), [self._status_key(field) for field in fields]
+
+    async def _remove_related(self, pipe, keys):
+        index_keys, score_keys, status_keys = await self._related_keys()
+        for index_key in index_keys:
+            pipe.srem(index_key, *keys)
+        for score_key in score_keys:
+            pipe.zrem(score_key, *keys)
+        for status_key in status_keys:
+            pipe.hdel(status_key, *keys)
+        pipe.zrem(self._expire_key(), *keys)
+
+    async def clear(self):
+        """
+        清空所有代理
+        :return:
+        """
+        index_keys, score_keys, status_keys = await self._related_keys()
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.delete(self.name, self._indexes_key(), self._scores_key(), self._status_fields_key(), self._expire_key(),
+                    *index_keys, *score_keys, *status_keys)
+        self._log_changes(pipe, 'clear', [''])
+        pipe.incr(self._version_key())
+        return (await pipe.execute())[0]
+
+    async def get_count(self):
+        """
+        返回代理数量
+        :return:
+        """
+        return {'total': await self.__conn.hlen(self.name)}
+
+    async def close(self):
+        """
+        连接池由同一事件循环中的所有 client 共享, 这里只释放 client 本身
+        """
+        await self.__conn.aclose(close_connection_pool=False)
+        await self.__raw.aclose(close_connection_pool=False)
+
+    async def test(self):
+        try:
+            return await self.get_count()
+        except TimeoutError as e:
+            logger.error('redis connection time out: %s' % str(e), exc_info=True)
+            return e
+        except ConnectionError as e:
+            logger.error('redis connection error: %s' % str(e), exc_info=True)
+            return e
+        except ResponseError as e:
+            logger.error('redis connection error: %s' % str(e), exc_info=True)
+            return e
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ReadCache(object):
+    """
+    DbClient 的进程内读缓存, 每张表一个 LRU, 条目超过 ttl 后失效
+
+    写入时表的版本号 (redis 中的 {table}:version) 加一
+    读取前最多每 check_interval 秒检查一次版本号, 版本号不是自己写入造成的变化时清空该表的缓存
+    其他进程写入后, 本进程最多 check_interval 秒后读到新数据
+    不存在的 key 也会被缓存, 值为 None
+    """
+
+    def __init__(self, maxsize=10000, ttl=300, check_interval=1):
+        """
+        init
+        :param maxsize: 每张表最多缓存的 key 数
+        :param ttl: 条目有效期, 秒
+        :param check_interval: 检查版本号的间隔, 秒
+        :return:
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self._tables = {}
+        # {table: (version, checked_at)}
+        self._versions = {}
+        # 已加载整张表的过期时间, 期间不在缓存中的 key 视为不存在
+        self._complete = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def sync(self, table, get_version, force=False):
+        """
+        检查表的版本号, 被其他进程修改过时清空该表的缓存
+        :param table: 表名
+        :param get_version: 返回当前版本号的函数
+        :param force: 忽略 check_interval 立即检查
+        :return: 当前已知的版本号
+        """
+        now = time.monotonic()
+        with self._lock:
+            known = self._versions.get(table)
+            if not force and known is not None and now - known[1] < self.check_interval:
+                return known[0]
+
+        version = get_version()
+        with self._lock:
+            known = self._versions.get(table)
+            if known is not None and known[0] != version:
+                self._invalidate(table)
+            self._versions[table] = (version, now)
+        return version
+
+    def written(self, table, version):
+        """
+        本进程写入后调用, 版本号只比已知版本大 1 时说明期间没有其他写入, 缓存仍然有效
+        :param table: 表名
+        :param version: 写入后的版本号, 未知时为 None
+        """
+        with self._lock:
+            known = self._versions.get(table)
+            if version is None or known is None or version != known[0] + 1:
+                self._invalidate(table)
+            if version is not None:
+                self._versions[table] = (version, time.monotonic())
+
+    def get(self, table, key):
+        """
+        :return: (是否命中, 值), 值为 None 表示 key 不存在
+        """
+        now = time.monotonic()
+        with self._lock:
+            entries = self._tables.get(table)
+            entry = entries.get(key) if entries is not None else None
+            if entry is not None and entry[0] > now:
+                entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            if entry is not None:
+                del entries[key]
+                self._complete.pop(table, None)
+            elif self._complete.get(table, 0) > now:
+                self.hits += 1
+                return True, None
+
+            self.misses += 1
+            return False, None
+
+    def set(self, table, key, value):
+        with self._lock:
+            entries = self._tables.setdefault(table, OrderedDict())
+            entries[key] = (time.monotonic() + self.ttl, value)
+            entries.move_to_end(key)
+            if len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self._complete.pop(table, None)
+
+    def mark_complete(self, table, version):
+        """
+        标记整张表已加载到缓存中, 之后不在缓存中的 key 视为不存在
+        :param version: 开始加载时的版本号, 加载期间有写入时不标记
+        :return: 是否标记成功
+        """
+        with self._lock:
+            known = self._versions.get(table)
+            if known is None or known[0] != version:
+                return False
+            self._complete[table] = time.monotonic() + self.ttl
+            return True
+
+    def invalidate(self, table=None):
+        with self._lock:
+            for name in [table] if table is not None else set(self._tables) | set(self._complete):
+                self._invalidate(name)
+
+    def _invalidate(self, table):
+        entries = self._tables.pop(table, None)
+        complete = self._complete.pop(table, None)
+        if entries or complete:
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        :return: 命中和未命中次数
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0,
+                'size': sum(len(entries) for entries in self._tables.values()),
+                'invalidations': self.invalidations,
+            }
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+表的变更流消费, 下游任务只处理上次之后的变更
+
+表名在 REDIS_CHANGE_FEED_TABLES 中时, 写入和删除会记录到 {table}:changes, 事件为 {'op': op, 'key': key}
+op: add / update / delete / clear, 以及检测结果产生的 evict (失败次数达到阈值被删除) 和 status (在成功和失败之间变化)
+
+    consumer = ChangeConsumer('sub_proxy', 'uploader')
+    changes = consumer.poll()
+    if changes.resync:
+        全量处理
+    else:
+        处理 changes.upserts / changes.deletes / changes.status
+    consumer.ack(changes)
+
+处理失败时不调用 ack, 下次 poll 会再次返回这些事件
+表没有启用变更流或数据库不支持 (sqlite) 时 consumer.enabled 为 False, 调用方应当全量处理
+"""
+
+from config import redis_conn
+from proxy_db.db_client import DbClient
+
+
+class ChangeSet(object):
+    """
+    一次 poll 读取的事件, 同一个 key 的多个事件合并为最后的状态
+    """
+
+    def __init__(self):
+        self.upserts = set()
+        self.deletes = set()
+        self.status = set()
+        # 新建的消费者组, 变更流被清空或有事件未读就被删除, 需要全量处理
+        self.resync = False
+        self.ids = []
+
+    def add(self, entry_id, event):
+        self.ids.append(entry_id)
+        op, key = event.get('op'), event.get('key')
+        if op in ('add', 'update'):
+            self.upserts.add(key)
+            self.deletes.discard(key)
+        elif op in ('delete', 'evict'):
+            self.deletes.add(key)
+            self.upserts.discard(key)
+            self.status.discard(key)
+        elif op == 'status':
+            self.status.add(key)
+        elif op == 'clear':
+            self.resync = True
+
+    def __bool__(self):
+        return bool(self.resync or self.upserts or self.deletes or self.status)
+
+    def __repr__(self):
+        return (f'ChangeSet(resync={self.resync}, upserts={len(self.upserts)}, '
+                f'deletes={len(self.deletes)}, status={len(self.status)}, events={len(self.ids)})')
+
+
+class ChangeConsumer(object):
+    """
+    变更流的消费者组, 每个下游任务使用一个组名, 多个组互不影响
+    """
+
+    def __init__(self, table, group, consumer='default', count=1000, db_conn=redis_conn):
+        """
+        init
+        :param table: 表名
+        :param group: 消费者组名
+        :param consumer: 组内的消费者名
+        :param count: 每次读取的事件数
+        :return:
+        """
+        self.group = group
+        self.consumer = consumer
+        self.count = count
+        self.db = DbClient(db_conn)
+        self.db.change_table(table)
+
+    @property
+    def enabled(self):
+        return self.db.change_feed_enabled()
+
+    def poll(self):
+        """
+        读取上次确认之后的所有事件, 包括之前读取但未确认的事件
+        :return: ChangeSet
+        """
+        changes = ChangeSet()
+        changes.resync = self.db.change_group_create(self.group) or self.db.change_lost(self.group)
+
+        # 先读取已分配但未确认的事件, 再读取新事件
+        start = '0'
+        while True:
+            entries = self.db.change_read(self.group, self.consumer, count=self.count, start=start)
+            if not entries:
+                break
+            for entry_id, event in entries:
+                changes.add(entry_id, event)
+            start = entries[-1][0]
+
+        while True:
+            entries = self.db.change_read(self.group, self.consumer, count=self.count)
+            if not entries:
+                break
+            for entry_id, event in entries:
+                changes.add(entry_id, event)
+        return changes
+
+    def ack(self, changes):
+        """
+        确认 changes 中的事件已处理
+        """
+        return self.db.change_ack(self.group, changes.ids)
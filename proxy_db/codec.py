@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+代理属性的序列化格式
+
+json: 旧版本格式, 无头部, 与之前写入的数据完全相同
+msgpack: 头部 \\x00M, 体积更小, 解析更快, 需要安装 msgpack
+zstd: 头部 \\x00Z, 使用训练好的字典压缩 msgpack (未安装时为 json), 需要安装 zstandard
+
+读取时根据头部自动识别格式, 所以切换格式后旧数据仍然可以读取, 可以用 migrate.py 重新编码
+"""
+
+import json
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'\x00'
+MSGPACK_HEADER = MAGIC + b'M'
+ZSTD_HEADER = MAGIC + b'Z'
+
+FORMATS = ('json', 'msgpack', 'zstd')
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+
+
+class ValueCodec(object):
+    """
+    编码和解码代理属性, encode 返回 bytes, decode 兼容所有格式和旧版本的 json 字符串
+    """
+
+    def __init__(self, fmt='json', zstd_dict=None, level=3):
+        """
+        init
+        :param fmt: 写入格式, json / msgpack / zstd
+        :param zstd_dict: zstd 字典文件路径, 读写 zstd 格式时必须与写入时相同
+        :param level: zstd 压缩级别
+        :return:
+        """
+        if fmt not in FORMATS:
+            raise ValueError(f'unsupported codec: {fmt}, choices: {", ".join(FORMATS)}')
+        if fmt == 'msgpack' and msgpack is None:
+            raise ImportError('codec msgpack requires the msgpack package')
+        if fmt == 'zstd' and zstandard is None:
+            raise ImportError('codec zstd requires the zstandard package')
+
+        self.fmt = fmt
+        self.level = level
+        self.zstd_dict = None
+        if zstd_dict and zstandard is not None:
+            with open(zstd_dict, 'rb') as f:
+                self.zstd_dict = zstandard.ZstdCompressionDict(f.read())
+
+        # zstd 压缩和解压对象不是线程安全的, 每个线程一个
+        self._local = threading.local()
+
+    def _compressor(self):
+        if getattr(self._local, 'compressor', None) is None:
+            self._local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.zstd_dict)
+        return self._local.compressor
+
+    def _decompressor(self):
+        if zstandard is None:
+            raise ImportError('value is zstd compressed, install the zstandard package to read it')
+        if getattr(self._local, 'decompressor', None) is None:
+            self._local.decompressor = zstandard.ZstdDecompressor(dict_data=self.zstd_dict)
+        return self._local.decompressor
+
+    @staticmethod
+    def _encode_plain(val):
+        if msgpack is not None:
+            return MSGPACK_HEADER + msgpack.packb(val, use_bin_type=True)
+        return json.dumps(val, ensure_ascii=False).encode('utf-8')
+
+    def encode(self, val):
+        """
+        编码代理属性, 字符串视为已编码的 json
+        :param val: 代理属性字典
+        :return: bytes
+        """
+        if self.fmt == 'json':
+            if isinstance(val, bytes):
+                return val
+            if isinstance(val, str):
+                return val.encode('utf-8')
+            return json.dumps(val, ensure_ascii=False).encode('utf-8')
+
+        if isinstance(val, (str, bytes)):
+            try:
+                val = self.decode(val)
+            except ValueError:
+                pass
+
+        if self.fmt == 'msgpack':
+            return MSGPACK_HEADER + msgpack.packb(val, use_bin_type=True)
+        return ZSTD_HEADER + self._compressor().compress(self._encode_plain(val))
+
+    def decode(self, data):
+        """
+        解码代理属性, 根据头部识别格式, 没有头部的为 json
+        :param data: bytes 或 str
+        :return: 代理属性字典
+        """
+        if isinstance(data, str):
+            return json.loads(data)
+
+        if data[:1] != MAGIC:
+            return json.loads(data)
+        if data[:2] == MSGPACK_HEADER:
+            if msgpack is None:
+                raise ImportError('value is msgpack encoded, install the msgpack package to read it')
+            return msgpack.unpackb(data[2:], raw=False)
+        if data[:2] == ZSTD_HEADER:
+            return self.decode(self._decompressor().decompress(data[2:]))
+        raise ValueError(f'unknown codec header: {data[:2]!r}')
+
+
+def get_codec(fmt='json', zstd_dict=None):
+    """
+    返回共享的 codec, 字典只加载一次
+    :param fmt: 写入格式
+    :param zstd_dict: zstd 字典文件路径
+    :return: ValueCodec
+    """
+    key = (fmt or 'json', zstd_dict or None)
+    with _codecs_lock:
+        codec = _codecs.get(key)
+        if codec is None:
+            codec = ValueCodec(*key)
+            _codecs[key] = codec
+        return codec
+
+
+def train_zstd_dict(samples, dict_size=64 * 1024):
+    """
+    用样本训练 zstd 字典, 代理属性中大量重复的字段名和取值会被放入字典
+    :param samples: 代理属性字典列表
+    :param dict_size: 字典大小
+    :return: 字典内容, 写入文件后通过 REDIS_ZSTD_DICT 指定
+    """
+    if zstandard is None:
+        raise ImportError('training a zstd dict requires the zstandard package')
+    samples = [ValueCodec._encode_plain(sample) for sample in samples]
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
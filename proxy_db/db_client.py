@@ -1,11 +1,16 @@
+import copy
 import json
 import os
 import sys
 from urllib.parse import urlparse
-from config import redis_conn
+from config import redis_conn, redis_max_connections, redis_codec, redis_zstd_dict
+from config import redis_change_feed_tables, redis_change_feed_maxlen
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from cache import ReadCache
+from codec import get_codec
+
 
 class Singleton:
     _instances = {}
@@ -17,9 +22,24 @@ class Singleton:
 
 
 class DbClient:
+    # 写入时维护的子集索引, {字段名: 从代理属性中取值的函数}, 由子类设置
+    # 索引名为 {字段名}:{值}, 例如 country:美国, type:vmess
+    indexers = {}
+
+    # client 模块前缀, AsyncDbClient 为 async_
+    client_prefix = ''
+
+    # 读缓存最多缓存的 key 数, 为 0 时不缓存, 由子类设置
+    # 缓存 get / get_many / exists / exists_many, 其他读取方法直接查询数据库
+    cache_size = 0
+
+    # 缓存条目有效期, 秒
+    cache_ttl = 300
+
     def __init__(self, db_conn):
         self.parseDbConn(db_conn)
         self.__initDbClient()
+        self.cache = ReadCache(self.cache_size, self.cache_ttl) if self.cache_size else None
 
     @classmethod
     def parseDbConn(cls, db_conn):
@@ -37,28 +57,235 @@ class DbClient:
 
         if self.db_type == "REDIS":
             __type = "redis_client"
+        elif self.db_type == "SQLITE":
+            # sqlite:///相对路径 或 sqlite:////绝对路径, 不需要 redis 服务
+            __type = "sqlite_client"
         else:
             raise Exception("Unsupported database type")
 
-        module = __import__(__type)
-        client_class = getattr(module, f"{self.db_type.title()}Client")
+        module = __import__(f"{self.client_prefix}{__type}")
+        client_class = getattr(module, f"{self.client_prefix.title().replace('_', '')}{self.db_type.title()}Client")
         self.client = client_class(host=self.db_host,
                                    port=self.db_port,
                                    username=self.db_user,
                                    password=self.db_pwd,
-                                   db=self.db_name)
+                                   db=self.db_name,
+                                   max_connections=redis_max_connections,
+                                   codec=get_codec(redis_codec, redis_zstd_dict),
+                                   change_feed_tables=redis_change_feed_tables,
+                                   change_feed_maxlen=redis_change_feed_maxlen)
+
+    def supports(self, feature):
+        """
+        当前数据库是否支持 feature, 例如 change_feed (变更流) / work_queue (工作队列), 只有 redis 支持
+        """
+        return feature in self.client.features
+
+    def change_feed_enabled(self):
+        """
+        当前表的写入是否记录变更流, 需要数据库支持并且表名在 REDIS_CHANGE_FEED_TABLES 中
+        """
+        return self.supports('change_feed') and self.client.name in self.client.change_feed_tables
 
     def get(self, key):
-        return self.client.get(key)
+        if self.cache is None:
+            return self.client.get(key)
+        return self._cached_get_many([key])[0]
+
+    def get_entry(self, key):
+        return self.client.get_entry(key)
+
+    def purge_expired(self, grace=0):
+        purged = self.client.purge_expired(grace)
+        if purged and self.cache is not None:
+            self.cache.invalidate(self.client.name)
+        return purged
+
+    def get_many(self, keys, cached=True, **kwargs):
+        """
+        :param cached: 是否经过读缓存, 遍历整张表的批量读取应该传 False, 否则每个 key 都写入缓存却不会命中
+        """
+        if self.cache is None or not cached:
+            return self.client.get_many(keys, **kwargs)
+        return self._cached_get_many(keys, **kwargs)
 
     def put(self, key, val, **kwargs):
-        return self.client.put(key, val, **kwargs)
+        if self.indexers:
+            return self.put_many({key: val}, **kwargs)
+        ret = self.client.put(key, val, **kwargs)
+        self._cache_written(items={key: val})
+        return ret
+
+    def put_many(self, items, **kwargs):
+        if self.indexers:
+            self.update_indexes(items)
+        ret = self.client.put_many(items, **kwargs)
+        self._cache_written(items=items)
+        return ret
+
+    def _cached_get_many(self, keys, detach=True, **kwargs):
+        """
+        先读缓存, 未命中的 key 批量查询后写入缓存, 不存在的 key 也会被缓存
+        :param detach: 是否返回副本, 调用方修改返回值不影响缓存
+        """
+        table = self.client.name
+        self.cache.sync(table, self.client.get_version)
+        found, missing = {}, []
+        for key in keys:
+            hit, val = self.cache.get(table, key)
+            if hit:
+                found[key] = val
+            else:
+                missing.append(key)
+
+        if missing:
+            for key, val in zip(missing, self.client.get_many(missing, **kwargs)):
+                self.cache.set(table, key, val)
+                found[key] = val
+        if detach:
+            return [copy.deepcopy(found[key]) for key in keys]
+        return [found[key] for key in keys]
+
+    def _cache_written(self, items=None, keys=None):
+        """
+        本进程写入或删除后更新缓存
+        :param items: 写入的 {key: val}
+        :param keys: 删除的 key 列表
+        """
+        if self.cache is None:
+            return
+        table = self.client.name
+        self.cache.written(table, self.client.last_version)
+        for key, val in (items or {}).items():
+            if isinstance(val, (str, bytes)):
+                val = self.client.codec.decode(val)
+            self.cache.set(table, key, copy.deepcopy(val))
+        for key in keys or []:
+            self.cache.set(table, key, None)
+
+    def warm_cache(self):
+        """
+        将整张表加载到读缓存中, 之后表中不存在的 key 也不需要查询数据库
+        表中的 key 数超过 cache_size 时只作为普通缓存
+        :return: 加载数量
+        """
+        if self.cache is None:
+            return 0
+        table = self.client.name
+        version = self.cache.sync(table, self.client.get_version, force=True)
+        keys = set()
+        for key, item in self.client.iter_items():
+            keys.add(key)
+            self.cache.set(table, key, item)
+        if len(keys) <= self.cache.maxsize:
+            # 加载期间有写入时版本号变化, 不标记为完整
+            self.cache.sync(table, self.client.get_version, force=True)
+            self.cache.mark_complete(table, version)
+        return len(keys)
+
+    def cache_stats(self):
+        """
+        返回读缓存的命中统计, 未启用缓存时为空
+        """
+        return self.cache.stats() if self.cache is not None else {}
+
+    def get_index_values(self, val):
+        """
+        根据 indexers 计算代理所属的子集索引
+        """
+        if isinstance(val, str):
+            try:
+                val = json.loads(val)
+            except Exception:
+                return set()
+
+        ret = set()
+        for field, func in self.indexers.items():
+            try:
+                value = func(val)
+            except Exception:
+                value = None
+            if value not in (None, ''):
+                ret.add(f'{field}:{value}')
+        return ret
+
+    def update_indexes(self, items, check_old=True):
+        """
+        更新子集索引, 代理属性变化时从旧索引中移除
+        :param items: {key: val}
+        :param check_old: 是否读取旧值比较
+        """
+        keys = list(items.keys())
+        olds = self.client.get_many(keys) if check_old else [None] * len(keys)
+        adds, removes = {}, {}
+        for key, old in zip(keys, olds):
+            new_indexes = self.get_index_values(items[key])
+            old_indexes = self.get_index_values(old) if old is not None else set()
+            for index in new_indexes - old_indexes:
+                adds.setdefault(index, []).append(key)
+            for index in old_indexes - new_indexes:
+                removes.setdefault(index, []).append(key)
+        self.client.index_update(adds, removes)
+
+    def reindex(self):
+        """
+        为表中已有数据重建子集索引
+        """
+        chunk = {}
+        for key, item in self.iter_items():
+            chunk[key] = item
+            if len(chunk) >= self.client.batch_size:
+                self.update_indexes(chunk, check_old=False)
+                chunk = {}
+        if chunk:
+            self.update_indexes(chunk, check_old=False)
+
+    def top_n(self, score, n=20, desc=False, **filters):
+        """
+        按排序索引返回前 n 个代理, 例如 top_n('delay', 20, country='美国', type='vmess')
+        """
+        indexes = [f'{field}:{value}' for field, value in filters.items() if value is not None]
+        return self.client.top_n(score, n, indexes=indexes, desc=desc)
+
+    def update_ewma(self, results, alpha=0.3, score=None, **kwargs):
+        """
+        更新延迟和成功率的指数加权平均, 见 RedisClient.update_ewma
+        :param results: {key: 延迟毫秒}, None 表示检测失败
+        """
+        return self.client.update_ewma(results, alpha=alpha, score=score, **kwargs)
+
+    def score_set_many(self, score, values, **kwargs):
+        return self.client.score_set_many(score, values, **kwargs)
+
+    def score_range(self, score, min='-inf', max='+inf', limit=None):
+        return self.client.score_range(score, min, max, limit)
+
+    def score_backfill(self, score, value, **kwargs):
+        return self.client.score_backfill(score, value, **kwargs)
+
+    def score_remove(self, score, keys):
+        return self.client.score_remove(score, keys)
 
     def delete(self, key, **kwargs):
-        return self.client.delete(key, **kwargs)
+        ret = self.client.delete(key, **kwargs)
+        self._cache_written(keys=[key])
+        return ret
+
+    def delete_many(self, keys, **kwargs):
+        keys = list(keys)
+        ret = self.client.delete_many(keys, **kwargs)
+        self._cache_written(keys=keys)
+        return ret
 
     def exists(self, key, **kwargs):
-        return self.client.exists(key, **kwargs)
+        if self.cache is None:
+            return self.client.exists(key, **kwargs)
+        return self._cached_get_many([key], detach=False)[0] is not None
+
+    def exists_many(self, keys, **kwargs):
+        if self.cache is None:
+            return self.client.exists_many(keys, **kwargs)
+        return [val is not None for val in self._cached_get_many(keys, detach=False, **kwargs)]
 
     def get_all(self):
         return self.client.get_all()
@@ -66,8 +293,86 @@ class DbClient:
     def get_all_items(self):
         return self.client.get_all_items()
 
+    def iter_items(self, **kwargs):
+        return self.client.iter_items(**kwargs)
+
+    def get_random(self, n=None):
+        return self.client.get_random(n)
+
+    def get_random_where(self, index, n=1):
+        return self.client.get_random_where(index, n)
+
+    def index_add(self, index, keys):
+        return self.client.index_add(index, keys)
+
+    def index_remove(self, index, keys):
+        return self.client.index_remove(index, keys)
+
+    def index_count(self, index):
+        return self.client.index_count(index)
+
+    def index_update(self, adds=None, removes=None):
+        return self.client.index_update(adds, removes)
+
+    def get_status(self, key, **kwargs):
+        return self.client.get_status(key, **kwargs)
+
+    def get_status_many(self, keys, **kwargs):
+        return self.client.get_status_many(keys, **kwargs)
+
+    def status_incr_many(self, incrs, **kwargs):
+        return self.client.status_incr_many(incrs, **kwargs)
+
+    def status_set_many(self, values, **kwargs):
+        return self.client.status_set_many(values, **kwargs)
+
+    def status_delete_many(self, keys, **kwargs):
+        return self.client.status_delete_many(keys, **kwargs)
+
+    def record_check_results(self, results, threshold, **kwargs):
+        evicted = self.client.record_check_results(results, threshold, **kwargs)
+        if evicted and self.cache is not None:
+            self.cache.invalidate(self.client.name)
+        return evicted
+
+    def change_group_create(self, group, **kwargs):
+        return self.client.change_group_create(group, **kwargs)
+
+    def change_read(self, group, consumer, **kwargs):
+        return self.client.change_read(group, consumer, **kwargs)
+
+    def change_ack(self, group, ids):
+        return self.client.change_ack(group, ids)
+
+    def change_lost(self, group):
+        return self.client.change_lost(group)
+
+    def queue_push(self, queue, keys):
+        return self.client.queue_push(queue, keys)
+
+    def queue_claim(self, queue, worker, **kwargs):
+        return self.client.queue_claim(queue, worker, **kwargs)
+
+    def queue_ack(self, queue, worker, keys):
+        return self.client.queue_ack(queue, worker, keys)
+
+    def queue_dead(self, queue):
+        return self.client.queue_dead(queue)
+
+    def queue_retry_dead(self, queue):
+        return self.client.queue_retry_dead(queue)
+
+    def queue_reclaim(self, queue):
+        return self.client.queue_reclaim(queue)
+
+    def queue_length(self, queue):
+        return self.client.queue_length(queue)
+
     def clear(self):
-        return self.client.clear()
+        ret = self.client.clear()
+        if self.cache is not None:
+            self.cache.invalidate(self.client.name)
+        return ret
 
     def change_table(self, name):
         self.client.change_table(name)
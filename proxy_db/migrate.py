@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+将表中的代理属性重新编码为指定格式, 也可以先用表中的数据训练 zstd 字典
+
+    python -m proxy_db.migrate --table sub_proxy --train-dict data/proxy.zdict
+    python -m proxy_db.migrate --table sub_proxy --codec zstd --zstd-dict data/proxy.zdict
+
+迁移完成后在 .env 中设置 REDIS_CODEC 和 REDIS_ZSTD_DICT, 迁移过程中新旧格式可以同时读取
+"""
+
+import argparse
+import os
+import sys
+from itertools import islice
+
+from loguru import logger
+
+from config import redis_conn
+from proxy_db.db_client import DbClient
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from codec import FORMATS, get_codec, train_zstd_dict
+
+
+def train(db, tables, path, samples=5000, dict_size=64 * 1024):
+    """
+    用表中的代理训练 zstd 字典并写入文件
+    :param tables: 表名列表
+    :param path: 字典文件路径
+    :param samples: 每张表最多使用的代理数
+    :return: 字典大小
+    """
+    items = []
+    for table in tables:
+        db.change_table(table)
+        items.extend(item for _, item in islice(db.iter_items(), samples))
+    data = train_zstd_dict(items, dict_size)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    logger.info(f'trained zstd dict from {len(items)} items, size: {len(data)}, saved to {path}')
+    return len(data)
+
+
+def migrate(db, codec, batch=500, dry_run=False):
+    """
+    用 codec 重新编码整张表, 分批读写, 不一次性加载整张表
+    :param codec: 目标格式的 ValueCodec
+    :return: 重新编码的数量
+    """
+    db.client.codec = codec
+    pending, count, seen = {}, 0, set()
+    for key, item in db.iter_items(batch=batch):
+        # HSCAN 可能返回重复的 key
+        if key in seen:
+            continue
+        seen.add(key)
+        pending[key] = item
+        if len(pending) >= batch:
+            count += len(pending)
+            if not dry_run:
+                db.put_many(pending)
+            pending = {}
+
+    count += len(pending)
+    if pending and not dry_run:
+        db.put_many(pending)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='re-encode stored proxies with another codec')
+    parser.add_argument('--conn', default=redis_conn, help='database url, default REDIS_CONN')
+    parser.add_argument('--table', action='append', required=True, help='table name, can be repeated')
+    parser.add_argument('--codec', choices=FORMATS, default='json', help='target codec')
+    parser.add_argument('--zstd-dict', help='zstd dict file used by the zstd codec')
+    parser.add_argument('--train-dict', metavar='PATH', help='train a zstd dict from the tables and save it, no migration')
+    parser.add_argument('--samples', type=int, default=5000, help='max items per table used for training')
+    parser.add_argument('--dict-size', type=int, default=64 * 1024, help='zstd dict size in bytes')
+    parser.add_argument('--batch', type=int, default=500, help='items per write')
+    parser.add_argument('--dry-run', action='store_true', help='read and count only')
+    args = parser.parse_args()
+
+    db = DbClient(args.conn)
+    if args.train_dict:
+        train(db, args.table, args.train_dict, args.samples, args.dict_size)
+        return
+
+    codec = get_codec(args.codec, args.zstd_dict)
+    for table in args.table:
+        db.change_table(table)
+        count = migrate(db, codec, args.batch, args.dry_run)
+        logger.info(f'{table}: {count} items re-encoded as {args.codec}{" (dry run)" if args.dry_run else ""}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,403 @@
 # -*- coding: utf-8 -*-
 
-import json
 import random
+import threading
+import time
+import uuid
+from datetime import datetime
 
 from redis.exceptions import TimeoutError, ConnectionError, ResponseError
 from redis.connection import BlockingConnectionPool
 from redis import Redis
 from loguru import logger
 
+from codec import get_codec
 
-class RedisClient(object):
+
+# 进程内共享的连接池, 以连接参数为 key, 所有表和 DbClient 实例共用
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(**kwargs):
+    """
+    返回连接参数对应的共享连接池, 不存在时创建
+    :param kwargs: BlockingConnectionPool 参数
+    :return: BlockingConnectionPool
+    """
+    key = tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+    with _connection_pools_lock:
+        pool = _connection_pools.get(key)
+        if pool is None:
+            pool = BlockingConnectionPool(**kwargs)
+            _connection_pools[key] = pool
+        return pool
+
+
+# 批量记录检测结果: 成功则重置失败次数, 失败则累加, 达到阈值后删除代理及其状态和索引
+# 启用变更流时, 删除记录为 evict 事件, 检测结果在成功和失败之间变化记录为 status 事件
+# KEYS[1]: 表名
+# ARGV: threshold, last_check_time, healthy 索引名(可为空), 变更流长度(为空时不记录), 之后为 key, ok(1/0) 对
+RECORD_CHECK_RESULTS_SCRIPT = """
+local name = KEYS[1]
+local threshold = tonumber(ARGV[1])
+local now = ARGV[2]
+local healthy = ARGV[3]
+local feed_maxlen = ARGV[4]
+local indexes_key = name .. ':indexes'
+local scores_key = name .. ':scores'
+local fields_key = name .. ':status_fields'
+
+redis.call('SADD', fields_key, 'success_count', 'fail_count', 'last_check_time')
+if healthy ~= '' then
+    redis.call('SADD', indexes_key, healthy)
+end
+local index_keys = redis.call('SMEMBERS', indexes_key)
+local score_keys = redis.call('SMEMBERS', scores_key)
+local status_fields = redis.call('SMEMBERS', fields_key)
+
+-- 状态记录不存在时, 使用旧版本写在代理定义中的计数
+local function seed(field, key)
+    local status_key = name .. ':status:' .. field
+    if redis.call('HEXISTS', status_key, key) == 0 then
+        local ok, item = pcall(cjson.decode, redis.call('HGET', name, key))
+        if ok and type(item) == 'table' and tonumber(item[field]) then
+            redis.call('HSET', status_key, key, tonumber(item[field]))
+        end
+    end
+    return status_key
+end
+
+local function change(op, key)
+    if feed_maxlen ~= '' then
+        redis.call('XADD', name .. ':changes', 'MAXLEN', '~', feed_maxlen, '*', 'op', op, 'key', key)
+    end
+end
+
+local evicted = {}
+for i = 5, #ARGV, 2 do
+    local key = ARGV[i]
+    if redis.call('HEXISTS', name, key) == 1 then
+        if ARGV[i + 1] == '1' then
+            redis.call('HINCRBY', seed('success_count', key), key, 1)
+            if (tonumber(redis.call('HGET', seed('fail_count', key), key)) or 0) > 0 then
+                change('status', key)
+            end
+            redis.call('HSET', name .. ':status:fail_count', key, 0)
+            redis.call('HSET', name .. ':status:last_check_time', key, now)
+            if healthy ~= '' then
+                redis.call('SADD', healthy, key)
+            end
+        else
+            local fail_count = redis.call('HINCRBY', seed('fail_count', key), key, 1)
+            if fail_count >= threshold then
+                redis.call('HDEL', name, key)
+                for _, index_key in ipairs(index_keys) do
+                    redis.call('SREM', index_key, key)
+                end
+                for _, score_key in ipairs(score_keys) do
+                    redis.call('ZREM', score_key, key)
+                end
+                for _, field in ipairs(status_fields) do
+                    redis.call('HDEL', name .. ':status:' .. field, key)
+                end
+                redis.call('ZREM', name .. ':expire', key)
+                change('evict', key)
+                table.insert(evicted, key)
+            else
+                if fail_count == 1 then
+                    change('status', key)
+                end
+                redis.call('HSET', name .. ':status:last_check_time', key, now)
+                if healthy ~= '' then
+                    redis.call('SREM', healthy, key)
+                end
+            end
+        end
+    end
+end
+if #evicted > 0 then
+    redis.call('INCR', name .. ':version')
+end
+return evicted
+"""
+
+
+# 批量更新延迟和成功率的指数加权平均 (EWMA), 并按 延迟 / 成功率 写入排序索引
+# 只在检测成功时更新延迟, 从未成功的代理没有延迟, 不参与排序
+# KEYS[1]: 表名
+# ARGV: alpha, 排序索引名(可为空), 之后为 key, ok(1/0), 延迟(毫秒, 失败时为空) 三元组
+UPDATE_EWMA_SCRIPT = """
+local name = KEYS[1]
+local alpha = tonumber(ARGV[1])
+local rank = ARGV[2]
+local latency_key = name .. ':status:ewma_latency'
+local success_key = name .. ':status:ewma_success'
+
+redis.call('SADD', name .. ':status_fields', 'ewma_latency', 'ewma_success')
+if rank ~= '' then
+    redis.call('SADD', name .. ':scores', rank)
+end
+
+local updated = 0
+for i = 3, #ARGV, 3 do
+    local key = ARGV[i]
+    if redis.call('HEXISTS', name, key) == 1 then
+        local ok = tonumber(ARGV[i + 1])
+        local success = tonumber(redis.call('HGET', success_key, key))
+        if success then
+            success = alpha * ok + (1 - alpha) * success
+        else
+            success = ok
+        end
+        redis.call('HSET', success_key, key, string.format('%.4f', success))
+
+        local latency = tonumber(redis.call('HGET', latency_key, key))
+        local sample = tonumber(ARGV[i + 2])
+        if ok == 1 and sample then
+            if latency then
+                latency = alpha * sample + (1 - alpha) * latency
+            else
+                latency = sample
+            end
+            redis.call('HSET', latency_key, key, string.format('%.1f', latency))
+        end
+
+        if rank ~= '' then
+            if latency then
+                redis.call('ZADD', rank, string.format('%.1f', latency / math.max(success, 0.01)), key)
+            else
+                redis.call('ZREM', rank, key)
+            end
+        end
+        updated = updated + 1
+    end
+end
+return updated
+"""
+
+# 启用变更流时批量写入, 按 HSET 的返回值记录 add 或 update 事件
+# KEYS[1]: 表名, KEYS[2]: 变更流
+# ARGV: 变更流长度, 之后为 key, val 对
+PUT_WITH_CHANGES_SCRIPT = """
+local added = 0
+for i = 2, #ARGV, 2 do
+    local new = redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    added = added + new
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[1], '*', 'op', new == 1 and 'add' or 'update', 'key', ARGV[i])
+end
+return added
+"""
+
+
+# 入队, 已在队列中或正在检测的 key 不重复入队
+# KEYS[1]: 队列, KEYS[2]: 队列中的 key 集合
+# ARGV: key 列表
+QUEUE_PUSH_SCRIPT = """
+local pushed = 0
+for _, key in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[2], key) == 1 then
+        redis.call('LPUSH', KEYS[1], key)
+        pushed = pushed + 1
+    end
+end
+return pushed
+"""
+
+
+# 领取后累加每个 key 的领取次数, 超过 max_attempts 的 key 移到死信列表, 不再返回
+# 死信中的 key 仍在队列的 key 集合中, 不会被协调者重新入队, 需要 queue_retry_dead 放回队列
+# KEYS[1]: worker 的处理中列表, KEYS[2]: 领取次数, KEYS[3]: 死信列表
+# ARGV: max_attempts, 之后为领取的 key
+QUEUE_ATTEMPT_SCRIPT = """
+local max_attempts = tonumber(ARGV[1])
+local claimed = {}
+for i = 2, #ARGV do
+    local key = ARGV[i]
+    if redis.call('HINCRBY', KEYS[2], key, 1) > max_attempts then
+        redis.call('LREM', KEYS[1], 1, key)
+        redis.call('HDEL', KEYS[2], key)
+        redis.call('LPUSH', KEYS[3], key)
+    else
+        table.insert(claimed, key)
+    end
+end
+return claimed
+"""
+
+
+# 确认处理完成, 只有仍在本 worker 处理中列表的 key 才移出队列的 key 集合
+# 租约过期被回收的 key 已回到队列, 保留在集合中, 避免协调者重复入队
+# KEYS[1]: worker 的处理中列表, KEYS[2]: 队列中的 key 集合, KEYS[3]: 领取次数
+# ARGV: key 列表
+QUEUE_ACK_SCRIPT = """
+local acked = 0
+for _, key in ipairs(ARGV) do
+    if redis.call('LREM', KEYS[1], 1, key) > 0 then
+        redis.call('SREM', KEYS[2], key)
+        redis.call('HDEL', KEYS[3], key)
+        acked = acked + 1
+    end
+end
+return acked
+"""
+
+
+# 死信放回队列的出队端, 领取次数清零
+# KEYS[1]: 死信列表, KEYS[2]: 队列, KEYS[3]: 领取次数
+QUEUE_RETRY_DEAD_SCRIPT = """
+local moved = 0
+local key = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'RIGHT')
+while key do
+    redis.call('HDEL', KEYS[3], key)
+    moved = moved + 1
+    key = redis.call('LMOVE', KEYS[1], KEYS[2], 'RIGHT', 'RIGHT')
+end
+return moved
+"""
+
+
+# 租约过期的 worker 正在处理的 key 放回队列的出队端, 优先被其他 worker 领取
+# KEYS[1]: 队列, KEYS[2]: 租约
+# ARGV: 当前时间戳, worker 处理中列表的前缀
+QUEUE_RECLAIM_SCRIPT = """
+local moved = 0
+for _, worker in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    local processing = ARGV[2] .. worker
+    while redis.call('LMOVE', processing, KEYS[1], 'RIGHT', 'RIGHT') do
+        moved = moved + 1
+    end
+    redis.call('ZREM', KEYS[2], worker)
+end
+return moved
+"""
+
+class RedisTableMixin(object):
+    """
+    表相关的 redis key 命名和代理属性的编解码, 同步和异步 client 共用
+    """
+
+    # 代理属性的序列化格式, 默认为 json
+    codec = get_codec()
+
+    # 写入时记录变更流的表, 变更流为 stream, 名称为 {table}:changes
+    change_feed_tables = ()
+
+    # 变更流的最大长度, 超出后删除最早的事件
+    change_feed_maxlen = 100000
+
+    def change_table(self, name):
+        """
+        切换操作对象
+        :param name:
+        :return:
+        """
+        self.name = name
+
+    def _index_key(self, index):
+        return f'{self.name}:index:{index}'
+
+    def _indexes_key(self):
+        return f'{self.name}:indexes'
+
+    def _score_key(self, score):
+        return f'{self.name}:score:{score}'
+
+    def _scores_key(self):
+        return f'{self.name}:scores'
+
+    def _status_key(self, field):
+        return f'{self.name}:status:{field}'
+
+    def _status_fields_key(self):
+        return f'{self.name}:status_fields'
+
+    def _version_key(self):
+        return f'{self.name}:version'
+
+    def _changes_key(self):
+        return f'{self.name}:changes'
+
+    def _queue_key(self, queue):
+        return f'{self.name}:queue:{queue}'
+
+    def _expire_key(self):
+        return f'{self.name}:expire'
+
+    def _set_expire(self, pipe, keys, ttl):
+        """
+        在 pipeline 中设置过期时间, 过期时间为 sorted set, 名称为 {table}:expire, 分值为过期的时间戳
+        ttl 为 None 时保留原有的过期时间, 为 0 时清除过期时间 (不再过期)
+        """
+        if ttl is None or not keys:
+            return
+        if ttl:
+            expires_at = time.time() + ttl
+            pipe.zadd(self._expire_key(), {key: expires_at for key in keys})
+        else:
+            pipe.zrem(self._expire_key(), *keys)
+
+    def _feed_enabled(self):
+        return self.name in self.change_feed_tables
+
+    def _log_changes(self, pipe, op, keys):
+        """
+        在 pipeline 中记录变更事件, 未启用变更流时不记录
+        :param op: add / update / delete / evict / status / clear
+        """
+        if not self._feed_enabled():
+            return
+        for key in keys:
+            pipe.xadd(self._changes_key(), {'op': op, 'key': key}, maxlen=self.change_feed_maxlen, approximate=True)
+
+    def _init_change_feed(self, kwargs):
+        self.change_feed_tables = set(kwargs.pop('change_feed_tables', None) or ())
+        self.change_feed_maxlen = kwargs.pop('change_feed_maxlen', None) or self.change_feed_maxlen
+
+    @staticmethod
+    def _parse_changes(resp):
+        """
+        XREADGROUP 的返回值转换为 [(id, {'op': op, 'key': key})]
+        """
+        return [(entry_id, fields) for _, entries in resp or [] for entry_id, fields in entries]
+
+    @staticmethod
+    def _stream_id(entry_id):
+        ms, seq = entry_id.split('-')
+        return int(ms), int(seq)
+
+    @staticmethod
+    def _decode_status(val):
+        try:
+            return int(val)
+        except ValueError:
+            pass
+        try:
+            return float(val)
+        except ValueError:
+            return val
+
+    @staticmethod
+    def _decode_key(key):
+        return key.decode('utf-8') if isinstance(key, bytes) else key
+
+    def _encode(self, val):
+        return self.codec.encode(val)
+
+    def _decode(self, key, val):
+        """
+        解码代理属性, 值不存在或无法解码时返回 None
+        """
+        if val is None:
+            return None
+        try:
+            return self.codec.decode(val)
+        except Exception as e:
+            logger.error(f'decode failed. key: {key}, val: {val!r}, err: {e}')
+            return None
+
+
+class RedisClient(RedisTableMixin):
     """
     Redis client
 
@@ -17,6 +405,15 @@ class RedisClient(object):
     key为ip:port, value为代理属性的字典
     """
 
+    # 批量操作时每个 pipeline 包含的字段数
+    batch_size = 500
+
+    # 可选功能, 见 DbClient.supports
+    features = frozenset({'change_feed', 'work_queue'})
+
+    # 服务端是否支持 HRANDFIELD, 首次失败后退化为 HKEYS
+    _hrandfield_supported = True
+
     def __init__(self, **kwargs):
         """
         init
@@ -24,40 +421,464 @@ class RedisClient(object):
         :param port: port
         :param password: password
         :param db: db
+        :param codec: ValueCodec, 默认为 json
+        :param change_feed_tables: 写入时记录变更流的表
+        :param change_feed_maxlen: 变更流的最大长度
         :return:
         """
         kwargs.pop("username", None)
-        self.__conn = Redis(connection_pool=BlockingConnectionPool(decode_responses=True,
-                                                                   timeout=5,
-                                                                   socket_timeout=5,
+        self.codec = kwargs.pop("codec", None) or self.codec
+        self._init_change_feed(kwargs)
+        self.__conn = Redis(connection_pool=get_connection_pool(decode_responses=True,
+                                                                timeout=5,
+                                                                socket_timeout=5,
+                                                                **kwargs))
+        # 代理属性可能是二进制格式, 读取时使用不解码的连接
+        self.__raw = Redis(connection_pool=get_connection_pool(decode_responses=False,
+                                                               timeout=5,
+                                                               socket_timeout=5,
+                                                               **kwargs))
+        self.__record_check_results = self.__conn.register_script(RECORD_CHECK_RESULTS_SCRIPT)
+        self.__put_with_changes = self.__conn.register_script(PUT_WITH_CHANGES_SCRIPT)
+        self.__update_ewma = self.__conn.register_script(UPDATE_EWMA_SCRIPT)
+        self.__queue_push = self.__conn.register_script(QUEUE_PUSH_SCRIPT)
+        self.__queue_reclaim = self.__conn.register_script(QUEUE_RECLAIM_SCRIPT)
+        self.__queue_attempt = self.__conn.register_script(QUEUE_ATTEMPT_SCRIPT)
+        self.__queue_ack = self.__conn.register_script(QUEUE_ACK_SCRIPT)
+        self.__queue_retry_dead = self.__conn.register_script(QUEUE_RETRY_DEAD_SCRIPT)
+        # 最近一次写入后表的版本号, 供 DbClient 的读缓存判断期间是否有其他写入
+        self.last_version = None
 
-                                                                   **kwargs))
     def get(self, key):
         """
         返回一个代理
-        :return:
+        :return: 代理属性字典, 不存在时为 None
         """
-        return self.__conn.hget(self.name, key)
+        return self._decode(key, self.__raw.hget(self.name, key))
 
-    def get_random(self):
+    def get_entry(self, key):
         """
-        返回一个代理
+        返回代理和过期时间, 过期的代理在 purge_expired 之前仍然可以读取
+        :return: (代理属性字典, 过期的时间戳), 不存在时为 (None, None), 不过期时过期时间为 None
+        """
+        pipe = self.__raw.pipeline(transaction=False)
+        pipe.hget(self.name, key)
+        pipe.zscore(self._expire_key(), key)
+        val, expires_at = pipe.execute()
+        return self._decode(key, val), expires_at
+
+    def purge_expired(self, grace=0):
+        """
+        删除过期的代理及其状态和索引
+        :param grace: 过期超过 grace 秒后才删除
+        :return: 删除数量
+        """
+        keys = self.__conn.zrangebyscore(self._expire_key(), '-inf', time.time() - grace)
+        if not keys:
+            return 0
+        return self.delete_many(keys)
+
+    def get_version(self):
+        """
+        返回表的版本号, 每次写入或删除后加一
         :return:
         """
+        return int(self.__conn.get(self._version_key()) or 0)
+
+    def get_many(self, keys, batch=None):
+        """
+        批量返回代理, 每 batch 个 key 一次 HMGET
+        :param keys: key 列表
+        :param batch: 每批 key 数, 默认 batch_size
+        :return: 与 keys 顺序一致的列表, 不存在的 key 为 None
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        ret = []
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            ret.extend(self._decode(k, v) for k, v in zip(chunk, self.__raw.hmget(self.name, chunk)))
+        return ret
+
+    def get_random(self, n=None):
+        """
+        随机返回代理, 优先使用 HRANDFIELD, 旧版本 redis 退化为 HKEYS
+        :param n: 返回数量, 为 None 时返回单个代理
+        :return: 单个代理或代理列表
+        """
+        count = n or 1
+        if self._hrandfield_supported:
+            try:
+                items = self.__raw.hrandfield(self.name, count, withvalues=True) or []
+                values = [self._decode(k, v) for k, v in zip(items[::2], items[1::2])]
+                return values if n else (values[0] if values else None)
+            except ResponseError as e:
+                # HRANDFIELD 需要 redis >= 6.2
+                logger.warning(f'hrandfield unsupported, fallback to hkeys: {e}')
+                RedisClient._hrandfield_supported = False
+
         proxies = self.__conn.hkeys(self.name)
-        proxy = random.choice(proxies) if proxies else None
-        return self.__conn.hget(self.name, proxy) if proxy else None
+        keys = random.sample(proxies, min(count, len(proxies)))
+        values = [self._decode(k, v) for k, v in zip(keys, self.__raw.hmget(self.name, keys))] if keys else []
+        return values if n else (values[0] if values else None)
+
+    def get_random_where(self, index, n=1):
+        """
+        从子集索引中随机返回代理, 例如 get_random_where('healthy')
+        索引中已被删除的 key 会被顺便清理
+        :param index: 索引名
+        :param n: 返回数量
+        :return: 代理列表
+        """
+        index_key = self._index_key(index)
+        keys = self.__conn.srandmember(index_key, n)
+        if not keys:
+            return []
+
+        values = self.__raw.hmget(self.name, keys)
+        stale = [k for k, v in zip(keys, values) if v is None]
+        if stale:
+            self.__conn.srem(index_key, *stale)
+        values = [self._decode(k, v) for k, v in zip(keys, values) if v is not None]
+        return [v for v in values if v is not None]
+
+    def index_add(self, index, keys):
+        """
+        将 key 加入子集索引, 索引为 set, 名称为 {table}:index:{index}
+        :param index: 索引名
+        :param keys: key 列表
+        :return:
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.sadd(self._indexes_key(), self._index_key(index))
+        pipe.sadd(self._index_key(index), *keys)
+        return pipe.execute()[-1]
+
+    def index_remove(self, index, keys):
+        """
+        将 key 从子集索引移除
+        :param index: 索引名
+        :param keys: key 列表
+        :return:
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        return self.__conn.srem(self._index_key(index), *keys)
+
+    def index_count(self, index):
+        """
+        返回子集索引中的 key 数量
+        """
+        return self.__conn.scard(self._index_key(index))
+
+    def index_update(self, adds=None, removes=None):
+        """
+        在一个 pipeline 中批量更新多个子集索引
+        :param adds: {index: [key]}
+        :param removes: {index: [key]}
+        :return:
+        """
+        pipe = self.__conn.pipeline(transaction=False)
+        for index, keys in (removes or {}).items():
+            if keys:
+                pipe.srem(self._index_key(index), *keys)
+        for index, keys in (adds or {}).items():
+            if keys:
+                pipe.sadd(self._indexes_key(), self._index_key(index))
+                pipe.sadd(self._index_key(index), *keys)
+        return pipe.execute()
 
-    def put(self, key, val):
+    def score_set_many(self, score, values, nx=False):
+        """
+        写入排序索引, 索引为 sorted set, 名称为 {table}:score:{score}
+        :param score: 排序索引名, 例如 'delay'
+        :param values: {key: 分值}
+        :param nx: 只写入索引中不存在的 key
+        :return:
+        """
+        if not values:
+            return 0
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.sadd(self._scores_key(), self._score_key(score))
+        pipe.zadd(self._score_key(score), values, nx=nx)
+        return pipe.execute()[-1]
+
+    def score_range(self, score, min='-inf', max='+inf', limit=None):
+        """
+        按分值范围返回排序索引中的 key, 从小到大
+        :param min: 最小分值
+        :param max: 最大分值
+        :param limit: 最多返回的数量
+        :return: [(key, 分值)]
+        """
+        if limit is None:
+            return self.__conn.zrangebyscore(self._score_key(score), min, max, withscores=True)
+        return self.__conn.zrangebyscore(self._score_key(score), min, max, start=0, num=limit, withscores=True)
+
+    def score_backfill(self, score, value, batch=None):
+        """
+        将表中不在排序索引中的 key 以 value 为分值加入索引, 索引数量与表相同时直接返回
+        :return: 加入的数量
+        """
+        if self.__conn.zcard(self._score_key(score)) >= self.__conn.hlen(self.name):
+            return 0
+
+        added, keys = 0, []
+        for key, _ in self.__raw.hscan_iter(self.name, count=batch or self.batch_size):
+            keys.append(self._decode_key(key))
+            if len(keys) >= (batch or self.batch_size):
+                added += self.score_set_many(score, dict.fromkeys(keys, value), nx=True)
+                keys = []
+        added += self.score_set_many(score, dict.fromkeys(keys, value), nx=True)
+        return added
+
+    def score_remove(self, score, keys):
+        """
+        将 key 从排序索引移除
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        return self.__conn.zrem(self._score_key(score), *keys)
+
+    def top_n(self, score, n=20, indexes=None, desc=False):
+        """
+        按排序索引返回前 n 个代理, 可以用子集索引过滤, 不需要扫描整张表
+        :param score: 排序索引名
+        :param n: 返回数量
+        :param indexes: 子集索引名列表, 结果为这些索引的交集
+        :param desc: 是否从大到小排序, 默认从小到大 (延迟越小越靠前)
+        :return: [(key, 代理属性字典)]
+        """
+        score_key = self._score_key(score)
+        if indexes:
+            # 子集索引的权重为 0, 交集结果的分值即为排序分值
+            tmp_key = f'{self.name}:tmp:{uuid.uuid4().hex}'
+            weights = {score_key: 1}
+            weights.update({self._index_key(index): 0 for index in indexes})
+            pipe = self.__conn.pipeline()
+            pipe.zinterstore(tmp_key, weights)
+            pipe.zrange(tmp_key, 0, n - 1, desc=desc)
+            pipe.delete(tmp_key)
+            keys = pipe.execute()[1]
+        else:
+            keys = self.__conn.zrange(score_key, 0, n - 1, desc=desc)
+
+        if not keys:
+            return []
+
+        ret = []
+        for key, val in zip(keys, self.__raw.hmget(self.name, keys)):
+            if val is None:
+                self.__conn.zrem(score_key, key)
+                continue
+            item = self._decode(key, val)
+            if item is not None:
+                ret.append((key, item))
+        return ret
+
+    def get_status(self, key, fields=None):
+        """
+        返回单个代理的状态记录
+        :param key: key
+        :param fields: 状态字段列表, 默认为该表所有状态字段
+        :return: {field: val}
+        """
+        return self.get_status_many([key], fields).get(key, {})
+
+    def get_status_many(self, keys, fields=None, batch=None):
+        """
+        批量返回状态记录, 状态与代理定义分开存放
+        每个状态字段一个 hash, 名称为 {table}:status:{field}, key 与代理 key 相同
+        :param keys: key 列表
+        :param fields: 状态字段列表, 默认为该表所有状态字段
+        :param batch: 每批 key 数, 默认 batch_size
+        :return: {key: {field: val}}, 没有状态的 key 不返回
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        fields = list(fields) if fields else sorted(self.__conn.smembers(self._status_fields_key()))
+        ret = {}
+        if not keys or not fields:
+            return ret
+
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            pipe = self.__conn.pipeline(transaction=False)
+            for field in fields:
+                pipe.hmget(self._status_key(field), chunk)
+            for field, values in zip(fields, pipe.execute()):
+                for key, val in zip(chunk, values):
+                    if val is not None:
+                        ret.setdefault(key, {})[field] = self._decode_status(val)
+        return ret
+
+    def status_incr_many(self, incrs, batch=None):
+        """
+        批量 HINCRBY 状态计数
+        :param incrs: {key: {field: amount}}
+        :param batch: 每批 key 数, 默认 batch_size
+        :return:
+        """
+        self._write_status(incrs, lambda pipe, name, key, val: pipe.hincrby(name, key, val), batch)
+
+    def status_set_many(self, values, batch=None):
+        """
+        批量 HSET 状态字段
+        :param values: {key: {field: val}}
+        :param batch: 每批 key 数, 默认 batch_size
+        :return:
+        """
+        self._write_status(values, lambda pipe, name, key, val: pipe.hset(name, key, val), batch)
+
+    def status_delete_many(self, keys, batch=None):
+        """
+        批量删除状态记录, 用于 key 不在主表中的状态 (例如订阅内的单个节点)
+        :param keys: key 列表
+        :param batch: 每批 key 数, 默认 batch_size
+        :return:
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        fields = self.__conn.smembers(self._status_fields_key())
+        for i in range(0, len(keys), batch):
+            pipe = self.__conn.pipeline(transaction=False)
+            for field in fields:
+                pipe.hdel(self._status_key(field), *keys[i:i + batch])
+            pipe.execute()
+
+    def record_check_results(self, results, threshold, index=None, batch=None):
+        """
+        原子地批量记录检测结果, 在 redis 端执行, 多个检测任务并发时不会丢失更新
+        成功: success_count + 1, fail_count 置 0, 加入 index
+        失败: fail_count + 1, 移出 index, 达到 threshold 后删除代理
+        已被删除的 key 会被忽略
+        :param results: {key: bool}
+        :param threshold: 删除代理的失败次数
+        :param index: 检测通过的子集索引名, 例如 'healthy'
+        :param batch: 每次脚本调用处理的 key 数, 默认 batch_size
+        :return: 被删除的 key 列表
+        """
+        batch = batch or self.batch_size
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        index_key = self._index_key(index) if index else ''
+        items = list(results.items())
+        evicted = []
+        feed_maxlen = self.change_feed_maxlen if self._feed_enabled() else ''
+        for i in range(0, len(items), batch):
+            args = [threshold, now, index_key, feed_maxlen]
+            for key, ok in items[i:i + batch]:
+                args.extend([key, 1 if ok else 0])
+            evicted.extend(self.__record_check_results(keys=[self.name], args=args))
+        return evicted
+
+    def update_ewma(self, results, alpha=0.3, score=None, batch=None):
+        """
+        原子地批量更新延迟和成功率的指数加权平均, 状态字段为 ewma_latency (毫秒) 和 ewma_success (0~1)
+        第一次检测的结果直接作为初始值, 延迟只在检测成功时更新
+        已被删除的 key 会被忽略
+        :param results: {key: 延迟毫秒}, None 表示检测失败
+        :param alpha: 新结果的权重, 越大越偏向最近的检测
+        :param score: 排序索引名, 分值为 ewma_latency / ewma_success, 越小越好
+        :param batch: 每次脚本调用处理的 key 数, 默认 batch_size
+        :return: 更新的 key 数
+        """
+        batch = batch or self.batch_size
+        score_key = self._score_key(score) if score else ''
+        items = list(results.items())
+        updated = 0
+        for i in range(0, len(items), batch):
+            args = [alpha, score_key]
+            for key, latency in items[i:i + batch]:
+                args.extend([key, 0 if latency is None else 1, '' if latency is None else latency])
+            updated += self.__update_ewma(keys=[self.name], args=args)
+        return updated
+
+    def _hset(self, pipe, mapping):
+        """
+        在 pipeline 中写入, 启用变更流时同时记录 add / update 事件, 结果为新增字段数
+        """
+        if not self._feed_enabled():
+            pipe.hset(self.name, mapping=mapping)
+            return
+        args = [self.change_feed_maxlen]
+        for key, val in mapping.items():
+            args.extend([key, val])
+        self.__put_with_changes(keys=[self.name, self._changes_key()], args=args, client=pipe)
+
+    def _write_status(self, items, write, batch):
+        batch = batch or self.batch_size
+        items = list(items.items())
+        for i in range(0, len(items), batch):
+            fields = set()
+            pipe = self.__conn.pipeline(transaction=False)
+            for key, values in items[i:i + batch]:
+                for field, val in values.items():
+                    fields.add(field)
+                    write(pipe, self._status_key(field), key, val)
+            if fields:
+                pipe.sadd(self._status_fields_key(), *fields)
+            pipe.execute()
+
+    def _related_keys(self):
+        """
+        返回该表的所有索引和状态 hash 名称
+        """
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.smembers(self._indexes_key())
+        pipe.smembers(self._scores_key())
+        pipe.smembers(self._status_fields_key())
+        index_keys, score_keys, fields = pipe.execute()
+        return list(index_keys), list(score_keys), [self._status_key(field) for field in fields]
+
+    def _remove_related(self, pipe, keys):
+        index_keys, score_keys, status_keys = self._related_keys()
+        for index_key in index_keys:
+            pipe.srem(index_key, *keys)
+        for score_key in score_keys:
+            pipe.zrem(score_key, *keys)
+        for status_key in status_keys:
+            pipe.hdel(status_key, *keys)
+        pipe.zrem(self._expire_key(), *keys)
+
+    def put(self, key, val, ttl=None):
         """
         将代理放入hash, 使用 change_table 指定 hash name
-        :param proxy_dict: proxy_dict obj
+        :param ttl: 有效期, 秒, 为 None 时保留原有的过期时间, 为 0 时不过期
         :return:
         """
-        if not isinstance(val, str):
-            val = json.dumps(val, ensure_ascii=False)
-        data = self.__conn.hset(self.name, key, val)
-        return data
+        pipe = self.__conn.pipeline(transaction=False)
+        self._hset(pipe, {key: self._encode(val)})
+        self._set_expire(pipe, [key], ttl)
+        pipe.incr(self._version_key())
+        ret = pipe.execute()
+        self.last_version = ret[-1]
+        return ret[0]
+
+    def put_many(self, items, batch=None, ttl=None):
+        """
+        批量写入, 每 batch 个字段一次 HSET, 按批提交 pipeline
+        :param items: {key: val} 字典
+        :param batch: 每批字段数, 默认 batch_size
+        :param ttl: 有效期, 秒, 为 None 时保留原有的过期时间, 为 0 时不过期
+        :return: 新增字段数
+        """
+        batch = batch or self.batch_size
+        items = [(k, self._encode(v)) for k, v in items.items()]
+        added = 0
+        for i in range(0, len(items), batch):
+            chunk = dict(items[i:i + batch])
+            pipe = self.__conn.pipeline(transaction=False)
+            self._hset(pipe, chunk)
+            self._set_expire(pipe, chunk.keys(), ttl)
+            added += pipe.execute()[0]
+        if items:
+            self.last_version = self.__conn.incr(self._version_key())
+        return added
 
     def delete(self, proxy_key):
         """
@@ -65,7 +886,34 @@ class RedisClient(object):
         :param proxy_str: proxy str
         :return:
         """
-        return self.__conn.hdel(self.name, proxy_key)
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.hdel(self.name, proxy_key)
+        self._remove_related(pipe, [proxy_key])
+        self._log_changes(pipe, 'delete', [proxy_key])
+        pipe.incr(self._version_key())
+        ret = pipe.execute()
+        self.last_version = ret[-1]
+        return ret[0]
+
+    def delete_many(self, keys, batch=None):
+        """
+        批量移除, 每 batch 个 key 一次 HDEL
+        :param keys: key 列表
+        :param batch: 每批 key 数, 默认 batch_size
+        :return: 删除数量
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        deleted = 0
+        for i in range(0, len(keys), batch):
+            pipe = self.__conn.pipeline(transaction=False)
+            pipe.hdel(self.name, *keys[i:i + batch])
+            self._remove_related(pipe, keys[i:i + batch])
+            self._log_changes(pipe, 'delete', keys[i:i + batch])
+            deleted += pipe.execute()[0]
+        if keys:
+            self.last_version = self.__conn.incr(self._version_key())
+        return deleted
 
     def exists(self, proxy_str):
         """
@@ -75,41 +923,232 @@ class RedisClient(object):
         """
         return self.__conn.hexists(self.name, proxy_str)
 
+    def exists_many(self, keys, batch=None):
+        """
+        批量判断是否存在, 每 batch 个 HEXISTS 一次 pipeline
+        :param keys: key 列表
+        :param batch: 每批 key 数, 默认 batch_size
+        :return: 与 keys 顺序一致的 bool 列表
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        ret = []
+        for i in range(0, len(keys), batch):
+            pipe = self.__conn.pipeline(transaction=False)
+            for key in keys[i:i + batch]:
+                pipe.hexists(self.name, key)
+            ret.extend(bool(x) for x in pipe.execute())
+        return ret
+
     def get_all(self):
         """
         字典形式返回所有代理, 使用changeTable指定hash name
         :return:
         """
-        items = self.__conn.hvals(self.name)
-        items = [json.loads(item) for item in items if isinstance(item, str)]
-        return items
+        items = [self._decode(self.name, item) for item in self.__raw.hvals(self.name)]
+        return [item for item in items if item is not None]
 
     def get_all_items(self):
-        items = self.__conn.hgetall(self.name)
+        """
+        返回所有代理
+        :return: {key: 代理属性字典}
+        """
+        items = {}
+        for key, val in self.__raw.hgetall(self.name).items():
+            key = self._decode_key(key)
+            item = self._decode(key, val)
+            if item is not None:
+                items[key] = item
         return items
 
+    def iter_items(self, batch=None, with_status=False):
+        """
+        使用 HSCAN 遍历 hash, 逐个解析返回, 不一次性加载整张表
+        HSCAN 期间表被修改时可能返回重复的 key, 需要调用方自行去重
+        :param batch: 每次 HSCAN 的 COUNT, 默认 batch_size
+        :param with_status: 是否将状态记录合并到代理属性中
+        :return: (key, 代理属性字典) 生成器
+        """
+        batch = batch or self.batch_size
+        fields = sorted(self.__conn.smembers(self._status_fields_key())) if with_status else []
+        cursor = '0'
+        while True:
+            cursor, data = self.__raw.hscan(self.name, cursor, count=batch)
+            data = {self._decode_key(key): val for key, val in data.items()}
+            status = self.get_status_many(data.keys(), fields) if fields and data else {}
+            for key, val in data.items():
+                item = self._decode(key, val)
+                if item is None:
+                    continue
+                if key in status:
+                    item.update(status[key])
+                yield key, item
+            if int(cursor) == 0:
+                break
+
     def clear(self):
         """
         清空所有代理
         :return:
         """
-        return self.__conn.delete(self.name)
+        index_keys, score_keys, status_keys = self._related_keys()
+        pipe = self.__conn.pipeline(transaction=False)
+        pipe.delete(self.name, self._indexes_key(), self._scores_key(), self._status_fields_key(), self._expire_key(),
+                    *index_keys, *score_keys, *status_keys)
+        self._log_changes(pipe, 'clear', [''])
+        pipe.incr(self._version_key())
+        ret = pipe.execute()
+        self.last_version = ret[-1]
+        return ret[0]
 
-    def get_count(self):
+    def change_group_create(self, group, start='$'):
         """
-        返回代理数量
-        :return:
+        创建变更流的消费者组, 变更流不存在时一并创建
+        :param group: 消费者组名
+        :param start: 从哪个事件之后开始消费, 默认只消费之后的新事件
+        :return: 是否新建
         """
-        proxies = self.get_all()
-        return {'total': len(proxies)}
+        try:
+            self.__conn.xgroup_create(self._changes_key(), group, id=start, mkstream=True)
+            return True
+        except ResponseError as e:
+            if 'BUSYGROUP' in str(e):
+                return False
+            raise
 
-    def change_table(self, name):
+    def change_read(self, group, consumer, count=1000, start='>', block=None):
         """
-        切换操作对象
-        :param name:
+        读取变更事件
+        :param start: '>' 读取未分配的新事件, 事件 id 则读取该 id 之后已分配但未确认的事件
+        :param block: 没有事件时阻塞的毫秒数, None 不阻塞
+        :return: [(id, {'op': op, 'key': key})]
+        """
+        resp = self.__conn.xreadgroup(group, consumer, {self._changes_key(): start}, count=count, block=block)
+        return self._parse_changes(resp)
+
+    def change_ack(self, group, ids):
+        """
+        确认事件已处理
+        """
+        ids = list(ids)
+        acked = 0
+        for i in range(0, len(ids), self.batch_size):
+            acked += self.__conn.xack(self._changes_key(), group, *ids[i:i + self.batch_size])
+        return acked
+
+    def change_lost(self, group):
+        """
+        消费者组读取之前, 是否有事件因超出变更流长度被删除, 需要 redis >= 7.0, 低版本返回 False
+        """
+        info = self.__conn.xinfo_stream(self._changes_key())
+        max_deleted = info.get('max-deleted-entry-id')
+        if not max_deleted or max_deleted == '0-0':
+            return False
+        for item in self.__conn.xinfo_groups(self._changes_key()):
+            if item['name'] == group:
+                return self._stream_id(max_deleted) > self._stream_id(item['last-delivered-id'])
+        return False
+
+    def queue_push(self, queue, keys):
+        """
+        将 key 放入工作队列, 已在队列中或正在处理的 key 会被忽略
+        队列为 list {table}:queue:{queue}, worker 领取后移到各自的处理中列表, 确认后才算完成
+        :param queue: 队列名
+        :param keys: key 列表
+        :return: 入队数量
+        """
+        keys = list(keys)
+        queue_key = self._queue_key(queue)
+        pushed = 0
+        for i in range(0, len(keys), self.batch_size):
+            pushed += self.__queue_push(keys=[queue_key, f'{queue_key}:queued'], args=keys[i:i + self.batch_size])
+        return pushed
+
+    def queue_claim(self, queue, worker, count=50, lease=600, block=None, max_attempts=3):
+        """
+        领取最多 count 个 key, 并把 worker 的租约延长到 lease 秒之后
+        worker 还有未确认的 key 时 (上次处理出错, 或同名 worker 重启) 先返回这些 key, 此时不延长租约,
+        一直处理失败的 key 在租约过期后会被回收给其他 worker
+        每个 key 最多被领取 max_attempts 次, 之后移到死信列表 {table}:queue:{queue}:dead
+        :param worker: worker 名, 多个 worker 不能同名
+        :param lease: 租约时长, 秒, 过期后 queue_reclaim 会把未确认的 key 放回队列
+        :param block: 队列为空时阻塞等待的秒数, 需要小于连接的 socket_timeout, None 不阻塞
+        :param max_attempts: 最多领取次数
+        :return: key 列表
+        """
+        queue_key = self._queue_key(queue)
+        processing = f'{queue_key}:processing:{worker}'
+        attempt_keys = [processing, f'{queue_key}:attempts', f'{queue_key}:dead']
+
+        keys = self.__conn.lrange(processing, 0, -1)
+        if keys:
+            keys = self.__queue_attempt(keys=attempt_keys, args=[max_attempts, *keys])
+            # 全部进入死信时领取新的一批
+            if keys:
+                return keys
+
+        # 先写租约再领取, 领取后崩溃的 worker 也能被回收
+        self.__conn.zadd(f'{queue_key}:leases', {worker: time.time() + lease})
+        if block:
+            first = self.__conn.blmove(queue_key, processing, block, 'RIGHT', 'LEFT')
+        else:
+            first = self.__conn.lmove(queue_key, processing, 'RIGHT', 'LEFT')
+        if first is None:
+            return []
+
+        pipe = self.__conn.pipeline()
+        for _ in range(count - 1):
+            pipe.lmove(queue_key, processing, 'RIGHT', 'LEFT')
+        keys = [first] + [key for key in pipe.execute() if key is not None]
+        return self.__queue_attempt(keys=attempt_keys, args=[max_attempts, *keys])
+
+    def queue_ack(self, queue, worker, keys):
+        """
+        确认 key 已处理完成, 从 worker 的处理中列表移除
+        :return: 确认数量, 租约已过期被回收的 key 不计入
+        """
+        keys = list(keys)
+        if not keys:
+            return 0
+        queue_key = self._queue_key(queue)
+        return self.__queue_ack(keys=[f'{queue_key}:processing:{worker}', f'{queue_key}:queued',
+                                      f'{queue_key}:attempts'], args=keys)
+
+    def queue_dead(self, queue):
+        """
+        返回超过最多领取次数的 key
+        """
+        return self.__conn.lrange(f'{self._queue_key(queue)}:dead', 0, -1)
+
+    def queue_retry_dead(self, queue):
+        """
+        把死信中的 key 放回队列重新领取
+        :return: 放回数量
+        """
+        queue_key = self._queue_key(queue)
+        return self.__queue_retry_dead(keys=[f'{queue_key}:dead', queue_key, f'{queue_key}:attempts'])
+
+    def queue_reclaim(self, queue):
+        """
+        回收租约过期的 worker 未确认的 key, 放回队列
+        :return: 回收数量
+        """
+        queue_key = self._queue_key(queue)
+        return self.__queue_reclaim(keys=[queue_key, f'{queue_key}:leases'],
+                                    args=[time.time(), f'{queue_key}:processing:'])
+
+    def queue_length(self, queue):
+        """
+        返回等待领取的 key 数量
+        """
+        return self.__conn.llen(self._queue_key(queue))
+
+    def get_count(self):
+        """
+        返回代理数量
         :return:
         """
-        self.name = name
+        return {'total': self.__conn.hlen(self.name)}
 
     def test(self):
 
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from loguru import logger
+
+from codec import get_codec
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (tbl TEXT, key TEXT, val BLOB, PRIMARY KEY (tbl, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS status (tbl TEXT, field TEXT, key TEXT, val, PRIMARY KEY (tbl, field, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS indexes (tbl TEXT, idx TEXT, key TEXT, PRIMARY KEY (tbl, idx, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scores (tbl TEXT, score TEXT, key TEXT, val REAL, PRIMARY KEY (tbl, score, key)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scores_rank ON scores (tbl, score, val);
+CREATE TABLE IF NOT EXISTS versions (tbl TEXT PRIMARY KEY, version INTEGER);
+CREATE TABLE IF NOT EXISTS expires (tbl TEXT, key TEXT, at REAL, PRIMARY KEY (tbl, key)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS expires_at ON expires (tbl, at);
+"""
+
+# 每个线程每个数据库文件一个连接, sqlite 连接不能跨线程使用
+_local = threading.local()
+
+
+def get_connection(path):
+    """
+    返回当前线程中数据库文件对应的连接, 不存在时创建并初始化表结构
+    :param path: 数据库文件路径
+    :return: sqlite3.Connection
+    """
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get(path)
+    if conn is None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(SCHEMA)
+        conns[path] = conn
+    return conn
+
+
+class SqliteClient(object):
+    """
+    SQLite client, 用于单机部署和本地测试, 不需要 redis 服务
+
+    连接串为 sqlite:///相对路径 或 sqlite:////绝对路径
+    接口与 RedisClient 相同, 所有表保存在同一个数据库文件中
+    """
+
+    # 批量操作时每个事务包含的 key 数
+    batch_size = 500
+
+    # 不支持变更流和工作队列, 见 DbClient.supports
+    features = frozenset()
+
+    # 代理属性的序列化格式, 默认为 json
+    codec = get_codec()
+
+    def __init__(self, **kwargs):
+        """
+        init
+        :param db: 数据库文件路径
+        :param codec: ValueCodec, 默认为 json
+        :return:
+        """
+        self.path = kwargs.get('db') or 'proxy_pool.db'
+        self.codec = kwargs.get('codec') or self.codec
+        # 最近一次写入后表的版本号, 供 DbClient 的读缓存判断期间是否有其他写入
+        self.last_version = None
+
+    @property
+    def __conn(self):
+        return get_connection(self.path)
+
+    @contextmanager
+    def _transaction(self):
+        conn = self.__conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _decode(self, key, val):
+        """
+        解码代理属性, 值不存在或无法解码时返回 None
+        """
+        if val is None:
+            return None
+        try:
+            return self.codec.decode(val)
+        except Exception as e:
+            logger.error(f'decode failed. key: {key}, val: {val!r}, err: {e}')
+            return None
+
+    @staticmethod
+    def _placeholders(items):
+        return ','.join('?' * len(items))
+
+    def get(self, key):
+        """
+        返回一个代理
+        :return:
+        """
+        row = self.__conn.execute('SELECT val FROM items WHERE tbl = ? AND key = ?', (self.name, key)).fetchone()
+        return self._decode(key, row[0]) if row else None
+
+    def get_version(self):
+        """
+        返回表的版本号, 每次写入或删除后加一
+        :return:
+        """
+        row = self.__conn.execute('SELECT version FROM versions WHERE tbl = ?', (self.name,)).fetchone()
+        return row[0] if row else 0
+
+    def _bump_version(self, conn):
+        conn.execute('INSERT INTO versions VALUES (?, 1) '
+                     'ON CONFLICT (tbl) DO UPDATE SET version = version + 1', (self.name,))
+        self.last_version = conn.execute('SELECT version FROM versions WHERE tbl = ?', (self.name,)).fetchone()[0]
+
+    def get_many(self, keys, batch=None):
+        """
+        批量返回代理
+        :return: 与 keys 顺序一致的列表, 不存在的 key 为 None
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            sql = f'SELECT key, val FROM items WHERE tbl = ? AND key IN ({self._placeholders(chunk)})'
+            found.update(self.__conn.execute(sql, (self.name, *chunk)).fetchall())
+        return [self._decode(key, found.get(key)) for key in keys]
+
+    def get_random(self, n=None):
+        """
+        随机返回代理
+        :param n: 返回数量, 为 None 时返回单个代理
+        :return: 单个代理或代理列表
+        """
+        rows = self.__conn.execute('SELECT key, val FROM items WHERE tbl = ? ORDER BY RANDOM() LIMIT ?',
+                                   (self.name, n or 1)).fetchall()
+        values = [self._decode(key, val) for key, val in rows]
+        return values if n else (values[0] if values else None)
+
+    def get_random_where(self, index, n=1):
+        """
+        从子集索引中随机返回代理
+        :return: 代理列表
+        """
+        sql = '''SELECT i.key, i.val FROM indexes x JOIN items i ON i.tbl = x.tbl AND i.key = x.key
+                 WHERE x.tbl = ? AND x.idx = ? ORDER BY RANDOM() LIMIT ?'''
+        values = [self._decode(key, val) for key, val in self.__conn.execute(sql, (self.name, index, n)).fetchall()]
+        return [v for v in values if v is not None]
+
+    def index_add(self, index, keys):
+        return self.index_update(adds={index: keys})
+
+    def index_remove(self, index, keys):
+        return self.index_update(removes={index: keys})
+
+    def index_count(self, index):
+        sql = 'SELECT COUNT(*) FROM indexes WHERE tbl = ? AND idx = ?'
+        return self.__conn.execute(sql, (self.name, index)).fetchone()[0]
+
+    def index_update(self, adds=None, removes=None):
+        """
+        批量更新多个子集索引
+        :param adds: {index: [key]}
+        :param removes: {index: [key]}
+        :return:
+        """
+        with self._transaction() as conn:
+            for index, keys in (removes or {}).items():
+                conn.executemany('DELETE FROM indexes WHERE tbl = ? AND idx = ? AND key = ?',
+                                 [(self.name, index, key) for key in keys])
+            for index, keys in (adds or {}).items():
+                conn.executemany('INSERT OR IGNORE INTO indexes VALUES (?, ?, ?)',
+                                 [(self.name, index, key) for key in keys])
+
+    def score_set_many(self, score, values, nx=False):
+        """
+        写入排序索引
+        :param values: {key: 分值}
+        :param nx: 只写入索引中不存在的 key
+        """
+        with self._transaction() as conn:
+            cur = conn.executemany(f'INSERT OR {"IGNORE" if nx else "REPLACE"} INTO scores VALUES (?, ?, ?, ?)',
+                                   [(self.name, score, key, val) for key, val in values.items()])
+        return cur.rowcount if nx else len(values)
+
+    def score_range(self, score, min='-inf', max='+inf', limit=None):
+        """
+        按分值范围返回排序索引中的 key, 从小到大
+        :return: [(key, 分值)]
+        """
+        sql = 'SELECT key, val FROM scores WHERE tbl = ? AND score = ? AND val >= ? AND val <= ? ORDER BY val'
+        params = [self.name, score, float(min), float(max)]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [(key, val) for key, val in self.__conn.execute(sql, params).fetchall()]
+
+    def score_backfill(self, score, value, batch=None):
+        """
+        将表中不在排序索引中的 key 以 value 为分值加入索引
+        :return: 加入的数量
+        """
+        with self._transaction() as conn:
+            cur = conn.execute('INSERT OR IGNORE INTO scores SELECT tbl, ?, key, ? FROM items WHERE tbl = ?',
+                               (score, value, self.name))
+        return cur.rowcount
+
+    def score_remove(self, score, keys):
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM scores WHERE tbl = ? AND score = ? AND key = ?',
+                             [(self.name, score, key) for key in keys])
+
+    def top_n(self, score, n=20, indexes=None, desc=False):
+        """
+        按排序索引返回前 n 个代理, 可以用子集索引过滤
+        :return: [(key, 代理属性字典)]
+        """
+        sql = 'SELECT s.key, i.val FROM scores s JOIN items i ON i.tbl = s.tbl AND i.key = s.key ' \
+              'WHERE s.tbl = ? AND s.score = ?'
+        params = [self.name, score]
+        for index in indexes or []:
+            sql += ' AND s.key IN (SELECT key FROM indexes WHERE tbl = ? AND idx = ?)'
+            params.extend([self.name, index])
+        sql += f' ORDER BY s.val {"DESC" if desc else "ASC"} LIMIT ?'
+        params.append(n)
+
+        ret = []
+        for key, val in self.__conn.execute(sql, params).fetchall():
+            item = self._decode(key, val)
+            if item is not None:
+                ret.append((key, item))
+        return ret
+
+    def get_status(self, key, fields=None):
+        return self.get_status_many([key], fields).get(key, {})
+
+    def get_status_many(self, keys, fields=None, batch=None):
+        """
+        批量返回状态记录
+        :return: {key: {field: val}}, 没有状态的 key 不返回
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        ret = {}
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            sql = f'SELECT key, field, val FROM status WHERE tbl = ? AND key IN ({self._placeholders(chunk)})'
+            params = [self.name, *chunk]
+            if fields:
+                sql += f' AND field IN ({self._placeholders(fields)})'
+                params.extend(fields)
+            for key, field, val in self.__conn.execute(sql, params).fetchall():
+                ret.setdefault(key, {})[field] = self._decode_status(val)
+        return ret
+
+    def status_incr_many(self, incrs, batch=None):
+        rows = [(self.name, field, key, val) for key, values in incrs.items() for field, val in values.items()]
+        with self._transaction() as conn:
+            conn.executemany('INSERT INTO status VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (tbl, field, key) DO UPDATE SET val = val + excluded.val', rows)
+
+    def status_set_many(self, values, batch=None):
+        rows = [(self.name, field, key, val) for key, items in values.items() for field, val in items.items()]
+        with self._transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)', rows)
+
+    def status_delete_many(self, keys, batch=None):
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM status WHERE tbl = ? AND key = ?', [(self.name, key) for key in keys])
+
+    def record_check_results(self, results, threshold, index=None, batch=None):
+        """
+        在一个事务中批量记录检测结果, 逻辑与 RedisClient.record_check_results 相同
+        :return: 被删除的 key 列表
+        """
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        evicted = []
+        with self._transaction() as conn:
+            for key, ok in results.items():
+                row = conn.execute('SELECT val FROM items WHERE tbl = ? AND key = ?', (self.name, key)).fetchone()
+                if not row:
+                    continue
+
+                status = dict(conn.execute('SELECT field, val FROM status WHERE tbl = ? AND key = ?',
+                                           (self.name, key)).fetchall())
+                # 状态记录不存在时, 使用旧版本写在代理定义中的计数
+                legacy = self._decode(key, row[0])
+                legacy = legacy if isinstance(legacy, dict) else {}
+
+                if ok:
+                    success_count = int(status.get('success_count', legacy.get('success_count', 0))) + 1
+                    self._set_status(conn, key, {'success_count': success_count, 'fail_count': 0,
+                                                 'last_check_time': now})
+                    if index:
+                        conn.execute('INSERT OR IGNORE INTO indexes VALUES (?, ?, ?)', (self.name, index, key))
+                    continue
+
+                fail_count = int(status.get('fail_count', legacy.get('fail_count', 0))) + 1
+                if fail_count >= threshold:
+                    self._delete_keys(conn, [key])
+                    evicted.append(key)
+                    continue
+
+                self._set_status(conn, key, {'fail_count': fail_count, 'last_check_time': now})
+                if index:
+                    conn.execute('DELETE FROM indexes WHERE tbl = ? AND idx = ? AND key = ?', (self.name, index, key))
+            if evicted:
+                self._bump_version(conn)
+        return evicted
+
+    def update_ewma(self, results, alpha=0.3, score=None, batch=None):
+        """
+        在一个事务中批量更新延迟和成功率的指数加权平均, 逻辑与 RedisClient.update_ewma 相同
+        :return: 更新的 key 数
+        """
+        updated = 0
+        with self._transaction() as conn:
+            for key, sample in results.items():
+                if not conn.execute('SELECT 1 FROM items WHERE tbl = ? AND key = ?', (self.name, key)).fetchone():
+                    continue
+
+                status = dict(conn.execute("SELECT field, val FROM status WHERE tbl = ? AND key = ? "
+                                           "AND field IN ('ewma_latency', 'ewma_success')",
+                                           (self.name, key)).fetchall())
+                ok = 0 if sample is None else 1
+                success = status.get('ewma_success')
+                success = ok if success is None else alpha * ok + (1 - alpha) * success
+                values = {'ewma_success': round(float(success), 4)}
+
+                latency = status.get('ewma_latency')
+                if ok:
+                    latency = sample if latency is None else alpha * sample + (1 - alpha) * latency
+                    values['ewma_latency'] = round(float(latency), 1)
+                self._set_status(conn, key, values)
+
+                if score:
+                    if latency is None:
+                        conn.execute('DELETE FROM scores WHERE tbl = ? AND score = ? AND key = ?',
+                                     (self.name, score, key))
+                    else:
+                        conn.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)',
+                                     (self.name, score, key, round(latency / max(success, 0.01), 1)))
+                updated += 1
+        return updated
+
+    def _set_status(self, conn, key, values):
+        conn.executemany('INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)',
+                         [(self.name, field, key, val) for field, val in values.items()])
+
+    def _delete_keys(self, conn, keys):
+        rows = [(self.name, key) for key in keys]
+        deleted = conn.executemany('DELETE FROM items WHERE tbl = ? AND key = ?', rows).rowcount
+        for table in ('status', 'indexes', 'scores', 'expires'):
+            conn.executemany(f'DELETE FROM {table} WHERE tbl = ? AND key = ?', rows)
+        return deleted
+
+    @staticmethod
+    def _decode_status(val):
+        if isinstance(val, float):
+            return val
+        try:
+            return int(val)
+        except (TypeError, ValueError):
+            return val
+
+    def put(self, key, val, ttl=None):
+        """
+        将代理放入表中, 使用 change_table 指定表名
+        :param ttl: 有效期, 秒, 为 None 时保留原有的过期时间, 为 0 时不过期
+        :return: 新增数量
+        """
+        return self.put_many({key: val}, ttl=ttl)
+
+    def put_many(self, items, batch=None, ttl=None):
+        """
+        批量写入
+        :param ttl: 有效期, 秒, 为 None 时保留原有的过期时间, 为 0 时不过期
+        :return: 新增数量
+        """
+        keys = list(items.keys())
+        batch = batch or self.batch_size
+        with self._transaction() as conn:
+            # 在事务中统计已存在的 key, 避免并发写入时新增数量不准
+            existed = 0
+            for i in range(0, len(keys), batch):
+                chunk = keys[i:i + batch]
+                sql = f'SELECT COUNT(*) FROM items WHERE tbl = ? AND key IN ({self._placeholders(chunk)})'
+                existed += conn.execute(sql, (self.name, *chunk)).fetchone()[0]
+            added = len(keys) - existed
+            conn.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?)',
+                             [(self.name, key, self.codec.encode(val)) for key, val in items.items()])
+            if ttl:
+                expires_at = time.time() + ttl
+                conn.executemany('INSERT OR REPLACE INTO expires VALUES (?, ?, ?)',
+                                 [(self.name, key, expires_at) for key in keys])
+            elif ttl is not None:
+                conn.executemany('DELETE FROM expires WHERE tbl = ? AND key = ?', [(self.name, key) for key in keys])
+            if keys:
+                self._bump_version(conn)
+        return added
+
+    def get_entry(self, key):
+        """
+        返回代理和过期时间, 与 RedisClient.get_entry 相同
+        :return: (代理属性字典, 过期的时间戳)
+        """
+        sql = 'SELECT i.val, e.at FROM items i LEFT JOIN expires e ON e.tbl = i.tbl AND e.key = i.key ' \
+              'WHERE i.tbl = ? AND i.key = ?'
+        row = self.__conn.execute(sql, (self.name, key)).fetchone()
+        return (self._decode(key, row[0]), row[1]) if row else (None, None)
+
+    def purge_expired(self, grace=0):
+        """
+        删除过期的代理及其状态和索引
+        :param grace: 过期超过 grace 秒后才删除
+        :return: 删除数量
+        """
+        rows = self.__conn.execute('SELECT key FROM expires WHERE tbl = ? AND at <= ?',
+                                   (self.name, time.time() - grace)).fetchall()
+        if not rows:
+            return 0
+        return self.delete_many([row[0] for row in rows])
+
+    def delete(self, proxy_key):
+        """
+        移除指定代理及其状态和索引
+        :return:
+        """
+        return self.delete_many([proxy_key])
+
+    def delete_many(self, keys, batch=None):
+        """
+        批量移除
+        :return: 删除数量
+        """
+        keys = list(keys)
+        with self._transaction() as conn:
+            deleted = self._delete_keys(conn, keys)
+            if keys:
+                self._bump_version(conn)
+        return deleted
+
+    def exists(self, proxy_str):
+        """
+        判断指定代理是否存在
+        :return:
+        """
+        return self.get(proxy_str) is not None
+
+    def exists_many(self, keys, batch=None):
+        """
+        批量判断是否存在
+        :return: 与 keys 顺序一致的 bool 列表
+        """
+        batch = batch or self.batch_size
+        keys = list(keys)
+        found = set()
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            sql = f'SELECT key FROM items WHERE tbl = ? AND key IN ({self._placeholders(chunk)})'
+            found.update(row[0] for row in self.__conn.execute(sql, (self.name, *chunk)).fetchall())
+        return [key in found for key in keys]
+
+    def get_all(self):
+        """
+        字典形式返回所有代理
+        :return:
+        """
+        return list(self.get_all_items().values())
+
+    def get_all_items(self):
+        """
+        返回所有代理
+        :return: {key: 代理属性字典}
+        """
+        items = {}
+        for key, val in self.__conn.execute('SELECT key, val FROM items WHERE tbl = ?', (self.name,)).fetchall():
+            item = self._decode(key, val)
+            if item is not None:
+                items[key] = item
+        return items
+
+    def iter_items(self, batch=None, with_status=False):
+        """
+        按 key 分页遍历表, 逐个解析返回, 不一次性加载整张表
+        :return: (key, 代理属性字典) 生成器
+        """
+        batch = batch or self.batch_size
+        last_key = ''
+        while True:
+            rows = self.__conn.execute('SELECT key, val FROM items WHERE tbl = ? AND key > ? ORDER BY key LIMIT ?',
+                                       (self.name, last_key, batch)).fetchall()
+            if not rows:
+                break
+
+            status = self.get_status_many([row[0] for row in rows]) if with_status else {}
+            for key, val in rows:
+                item = self._decode(key, val)
+                if item is None:
+                    continue
+                if key in status:
+                    item.update(status[key])
+                yield key, item
+            last_key = rows[-1][0]
+
+    def clear(self):
+        """
+        清空表
+        :return:
+        """
+        with self._transaction() as conn:
+            for table in ('items', 'status', 'indexes', 'scores', 'expires'):
+                conn.execute(f'DELETE FROM {table} WHERE tbl = ?', (self.name,))
+            self._bump_version(conn)
+
+    def get_count(self):
+        """
+        返回代理数量
+        :return:
+        """
+        return {'total': self.__conn.execute('SELECT COUNT(*) FROM items WHERE tbl = ?', (self.name,)).fetchone()[0]}
+
+    def change_table(self, name):
+        """
+        切换操作对象
+        :param name:
+        :return:
+        """
+        self.name = name
+
+    def test(self):
+        try:
+            return self.get_count()
+        except sqlite3.Error as e:
+            logger.error('sqlite error: %s' % str(e), exc_info=True)
+            return e
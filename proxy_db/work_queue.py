@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+表的工作队列, 协调者把 key 放入队列, 多个 worker 进程 (可以在不同的机器上) 按批领取处理
+
+    queue = WorkQueue('sub_proxy', 'check')
+    queue.push(keys)                     # 协调者
+
+    keys = queue.claim(50, block=3)       # worker
+    处理 keys
+    queue.ack(keys)
+
+领取时 key 从队列移到 worker 自己的处理中列表, 同时写入租约 {table}:queue:{name}:leases
+worker 崩溃或处理超过 lease 秒后, reclaim 把未确认的 key 放回队列, 由其他 worker 重新领取
+处理失败时不调用 ack, 同名 worker 下次 claim 会先返回这些 key, 但不延长租约
+每个 key 最多领取 max_attempts 次, 之后进入死信列表, 用 retry_dead 放回队列
+需要 redis >= 6.2 (BLMOVE), 使用前用 DbClient.supports('work_queue') 判断
+"""
+
+import os
+import socket
+
+from config import redis_conn
+from proxy_db.db_client import DbClient
+
+
+class WorkQueue(object):
+
+    def __init__(self, table, name, worker=None, lease=600, max_attempts=3, db_conn=redis_conn):
+        """
+        init
+        :param table: 表名
+        :param name: 队列名
+        :param worker: worker 名, 默认为 主机名-进程号
+        :param lease: 租约时长, 秒, 需要大于处理一批 key 的时间
+        :param max_attempts: 每个 key 最多领取的次数
+        :return:
+        """
+        self.name = name
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.db = DbClient(db_conn)
+        self.db.change_table(table)
+
+    def push(self, keys):
+        """
+        入队, 已在队列中或正在处理的 key 会被忽略
+        :return: 入队数量
+        """
+        return self.db.queue_push(self.name, keys)
+
+    def claim(self, count=50, block=None):
+        """
+        领取最多 count 个 key
+        :param block: 队列为空时阻塞等待的秒数, None 不阻塞
+        :return: key 列表
+        """
+        return self.db.queue_claim(self.name, self.worker, count=count, lease=self.lease, block=block,
+                                   max_attempts=self.max_attempts)
+
+    def ack(self, keys):
+        """
+        确认 keys 已处理完成
+        """
+        return self.db.queue_ack(self.name, self.worker, keys)
+
+    def reclaim(self):
+        """
+        回收租约过期的 worker 未确认的 key
+        :return: 回收数量
+        """
+        return self.db.queue_reclaim(self.name)
+
+    def dead(self):
+        """
+        超过最多领取次数的 key
+        """
+        return self.db.queue_dead(self.name)
+
+    def retry_dead(self):
+        """
+        把死信中的 key 放回队列
+        :return: 放回数量
+        """
+        return self.db.queue_retry_dead(self.name)
+
+    def __len__(self):
+        return self.db.queue_length(self.name)
@@ -0,0 +1,159 @@
+import argparse
+import signal
+import time
+
+from loguru import logger
+
+from submanager.proxydb import CHECK_QUEUE
+from submanager.subproxy_checker import SubProxyChecker
+from proxy_db.work_queue import WorkQueue
+
+"""
+分布式检测的 worker, 从工作队列领取到期的代理, 用 mihomo 检测后写回结果
+协调者 (main.py 中 CHECK_WORKERS=true 时) 定时把到期的代理放入队列, 可以在多台机器上各启动若干个 worker:
+
+    python -m submanager.check_worker
+    python -m submanager.check_worker --enqueue   # 手动执行一次协调者
+    python -m submanager.check_worker --retry-dead   # 反复失败进入死信的代理放回队列
+"""
+
+
+class CheckWorker:
+    def __init__(self, name=None, lease=600, block=3, max_attempts=3):
+        """
+        init
+        :param name: worker 名, 默认为 主机名-进程号, 固定名字时重启后会先处理上次未确认的代理
+        :param lease: 租约时长, 秒, 超过后未确认的代理会被其他 worker 重新领取
+        :param block: 队列为空时每次阻塞等待的秒数, 需要小于 redis 连接的 socket_timeout
+        :param max_attempts: 每个代理最多领取的次数, 之后进入死信列表
+        :return:
+        """
+        self.checker = SubProxyChecker()
+        self.queue = WorkQueue('sub_proxy', CHECK_QUEUE, worker=name, lease=lease, max_attempts=max_attempts)
+        self.block = block
+        self.stopped = False
+
+    def run_once(self):
+        """
+        领取并检测一批代理
+        :return: 领取的代理数
+        """
+        self.queue.reclaim()
+        # 批次大小由检测器的并发控制调整
+        keys = self.queue.claim(self.checker.chunk, block=self.block)
+        if not keys:
+            return 0
+
+        proxy_dict = self.checker.load_proxy_chunk(keys)
+        if proxy_dict:
+            self.checker.check_chunk(proxy_dict)
+            self.checker.flush_results()
+        self.queue.ack(keys)
+        return len(keys)
+
+    def run(self, once=False):
+        """
+        循环领取检测, 出错时不确认, 租约过期后由其他 worker 重新检测
+        :param once: 队列为空时退出
+        """
+        if not self.queue.db.supports('work_queue'):
+            logger.error('work queue requires the redis backend')
+            return
+
+        logger.info(f'check worker {self.queue.worker} started')
+        while not self.stopped:
+            try:
+                count = self.run_once()
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(self.block)
+                continue
+            if not count and once:
+                break
+        logger.info(f'check worker {self.queue.worker} stopped')
+
+    def stop(self, *args):
+        # 处理完当前一批后退出
+        self.stopped = True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-n",
+        "--name",
+        type=str,
+        required=False,
+        default=None,
+        help="Worker name, defaults to hostname-pid",
+    )
+
+    parser.add_argument(
+        "-l",
+        "--lease",
+        type=int,
+        required=False,
+        default=600,
+        help="Seconds before an unacknowledged batch is handed to another worker",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--max-attempts",
+        dest="max_attempts",
+        type=int,
+        required=False,
+        default=3,
+        help="Claims per proxy before it is moved to the dead letter list",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--once",
+        dest="once",
+        action="store_true",
+        default=False,
+        help="Exit when the queue is empty",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--enqueue",
+        dest="enqueue",
+        action="store_true",
+        default=False,
+        help="Enqueue due proxies and exit",
+    )
+
+    parser.add_argument(
+        "-r",
+        "--retry-dead",
+        dest="retry_dead",
+        action="store_true",
+        default=False,
+        help="Move dead letter proxies back to the queue and exit",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.enqueue:
+        SubProxyChecker().enqueue_due_checks()
+        return
+
+    if args.retry_dead:
+        count = WorkQueue('sub_proxy', CHECK_QUEUE).retry_dead()
+        logger.info(f'{count} dead letter proxies requeued')
+        return
+
+    worker = CheckWorker(name=args.name, lease=args.lease, max_attempts=args.max_attempts)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run(once=args.once)
+
+
+if __name__ == '__main__':
+    main()
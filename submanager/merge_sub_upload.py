@@ -1,5 +1,6 @@
 import os
 import re
+import hashlib
 
 import yaml
 import time
@@ -13,9 +14,10 @@ from submanager import b64plus
 from submanager.util import parse_link_host_port
 from tools.ip_location import load_mmdb
 from proxy_db.db_client import DbClient
+from submanager.proxydb import RANK_SCORE, sort_by_rank
 from submanager.xui_scan.xui_db import XuiLinkDb
 from tools.ping0cc import get_ip_risk_score
-from config import redis_conn, github_token, clash_yaml_gist_id
+from config import redis_conn, github_token, clash_yaml_gist_id, rank_top_n
 from urllib.parse import unquote
 
 """
@@ -64,7 +66,12 @@ def domain_to_ip(domain):
 
 
 class SubUploader:
-    def __init__(self):
+    def __init__(self, rank_top_n=rank_top_n):
+        """
+        init
+        :param rank_top_n: 上传的配置中, xui 链接连接耗时加权平均最小的 n 个代理排在最前面
+        :return:
+        """
         self.current_path = os.path.abspath(os.path.dirname(__file__))
         self.base_path = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
         self.data_path = os.path.join(self.current_path, "data")
@@ -80,8 +87,11 @@ class SubUploader:
         self.resource_dir = os.path.join(self.current_path, "resource")
         self.mmdb_reader = load_mmdb(self.resource_dir, "GeoLite2-City.mmdb")
 
-        self.db_client = DbClient(redis_conn)
-        self.db_client.change_table('sub_proxy')
+        self.rank_top_n = rank_top_n
+
+        # 上次上传的配置内容的哈希, 按 gist id 保存
+        self.upload_db = DbClient(redis_conn)
+        self.upload_db.change_table('sub_upload')
 
         # 清理旧的配置文件
         self.cleanup_generate_conf()
@@ -100,6 +110,25 @@ class SubUploader:
     def load_node_links_from_db(self):
         self.node_links = self.xui_link_db.get_all_links()
 
+    def rank_proxies(self, proxies):
+        """
+        把 XuiSubLinkChecker 检测的连接耗时最小的 n 个节点排到最前面, 按链接的 server:port 对应节点
+        """
+        if not self.rank_top_n:
+            return proxies
+
+        ranked = self.xui_link_db.score_range(RANK_SCORE, limit=self.rank_top_n)
+        items = self.xui_link_db.get_many([key for key, _ in ranked])
+        ranks = {}
+        for (_, score), item in zip(ranked, items):
+            for link in (item or {}).get('link', '').split():
+                try:
+                    server, port = self.get_link_server_port(link)
+                except Exception:
+                    continue
+                ranks.setdefault(f'{server}:{port}', score)
+        return sort_by_rank(proxies, ranks)
+
     def get_proxy(self):
         pass
 
@@ -178,6 +207,8 @@ class SubUploader:
 
         # 按ip纯净度排序
         proxies = sorted(proxies, key=lambda x: self.get_proxy_name_iprisk(x.get('name', '')))
+        # 检测过的最快的代理排在最前面
+        proxies = self.rank_proxies(proxies)
         data['proxies'] = proxies
 
         src = f'{filepath}.bak'
@@ -228,6 +259,8 @@ class SubUploader:
             response = requests.patch(url, headers=headers, json=data)
             ret = response.json()
             logger.info(f"gist url: {ret.get('html_url')}")
+            if response.ok:
+                return ret
         except requests.RequestException as e:
             logger.info(f"Error updating Gist: {e}")
 
@@ -247,10 +280,23 @@ class SubUploader:
 
         return self.update_to_gist(content)
 
-    def merge_and_upload(self):
+    def merge_and_upload(self, force=False):
+        """
+        生成配置并上传, 内容与上次上传的相同时跳过
+        xui 链接, ip 纯净度和代理排序的变化都会反映在生成的配置中, 所以按内容判断而不是按变更流
+        """
         self.load_node_links_from_db()
         filepath = self.merge_proxies()
-        self.upload_clash_to_gist(filepath)
+        with open(filepath, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        last = self.upload_db.get(self.gist_id) or {}
+        if not force and last.get('sha256') == digest:
+            logger.info('clash config unchanged since last upload, skip')
+            return
+
+        if self.upload_clash_to_gist(filepath):
+            self.upload_db.put(self.gist_id, {'sha256': digest})
 
 
 def main():
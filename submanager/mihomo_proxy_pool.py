@@ -1,4 +1,3 @@
-import json
 import time
 import os
 import copy
@@ -11,11 +10,13 @@ from pathlib import Path
 from urllib.parse import urlparse
 from loguru import logger
 
-from config import redis_conn, proxy_pool_start_port
+from config import redis_conn, proxy_pool_start_port, rank_top_n
 from proxy_db.db_client import DbClient
+from proxy_db.change_feed import ChangeConsumer
 from urllib.parse import unquote
 
 from submanager.mihomo_speedtest import MihomoSpeedTest
+from submanager.proxydb import SubLinkDb, STATUS_FIELDS
 from submanager.util import get_http_proxies
 
 operating_system = platform.system().lower()
@@ -140,21 +141,29 @@ class MiHoMoProxyPool:
 
 
 class SublinkProxyPool:
-    def __init__(self, start_port):
+    def __init__(self, start_port, rank_top_n=rank_top_n):
+        """
+        init
+        :param start_port: 第一个代理的本地端口
+        :param rank_top_n: 综合延迟最小的 n 个代理排在最前面, 使用最小的端口
+        :return:
+        """
         self.start_port = start_port
+        self.rank_top_n = rank_top_n
         self.chunk_size = 100
         self.loss_fail_threshold = 0.5
         self.fail_to_delete_threshold = 3
 
-        self.db_client = DbClient(redis_conn)
-        self.db_client.change_table('sub_proxy')
+        self.db_client = SubLinkDb()
         self.proxies = self.get_proxies_from_db()
+        # 改名后的代理名 -> 表中的 key, 排序时按 key 查综合延迟
+        self.proxy_keys = {}
 
         self.mihomo_config_dir = os.path.join(current_dir, 'mihomo/configs')
         self.docker_compose_file_path = os.path.join(current_dir, 'mihomo', 'docker-compose-mihomo.yml')
 
     def pre_process_proxies(self):
-        unused_keys = ['fail_count', 'success_count', 'last_check_time']
+        unused_keys = STATUS_FIELDS
         new_proxies = []
         name_set = set()
 
@@ -165,7 +174,7 @@ class SublinkProxyPool:
                 i += 1
             return name
 
-        for proxy in self.proxies:
+        for db_key, proxy in self.proxies:
             # 最新 mihomo 只支持 xtls-rprx-vision 流控算法
             if proxy.get('type') == 'vless' and proxy.get('flow') and proxy.get('flow') != "xtls-rprx-vision":
                 proxy['flow'] = 'xtls-rprx-vision'
@@ -191,6 +200,7 @@ class SublinkProxyPool:
             new_name = get_new_name(p['name'], name_set)
             p['name'] = new_name
             name_set.add(new_name)
+            self.proxy_keys[new_name] = db_key
             new_proxies.append(p)
 
         self.proxies = new_proxies
@@ -198,8 +208,11 @@ class SublinkProxyPool:
         return new_proxies
 
     def get_proxies_from_db(self):
-        proxies = self.db_client.get_all()
-        return proxies
+        """
+        惰性读取数据库中的代理, 由 pre_process_proxies 消费
+        :return: (key, 代理) 生成器
+        """
+        return self.db_client.iter_items(with_status=True)
 
     def get_mihomo_config(self, proxies):
         config = copy.deepcopy(mihomo_config_base)
@@ -224,7 +237,8 @@ class SublinkProxyPool:
             yaml.dump(config, f, Dumper=CustomDumper, allow_unicode=True, width=1024)
 
     def generate_mihomo_configs(self):
-        proxies = self.pre_process_proxies()
+        proxies = self.db_client.rank_proxies(self.pre_process_proxies(), self.rank_top_n,
+                                              key=lambda p: self.proxy_keys.get(p['name']))
         total_proxies = len(proxies)
         chunk_size = self.chunk_size
 
@@ -243,7 +257,8 @@ class SublinkProxyPool:
         self.generate_mihomo_configs()
         services = {}
 
-        for file in Path(self.mihomo_config_dir).iterdir():
+        # 按文件名中的端口顺序生成, 最快的代理在最前面
+        for file in sorted(Path(self.mihomo_config_dir).iterdir(), key=lambda f: f.name):
             if not file.name.endswith('.yml'):
                 continue
             container_name = file.name.split('.')[0]
@@ -321,8 +336,16 @@ class SubscriptionPool:
             logger.info(f'url: {url} no available')
             return
 
+        # 节点改名或下线后, 旧节点的失败次数不再需要
+        old = self.subscription_db.get(key) or {}
+        names = {proxy['name'] for proxy in sub_info['proxies']}
+        stale = [self.get_proxy_status_key(key, proxy['name']) for proxy in old.get('proxies', [])
+                 if proxy['name'] not in names]
+
+        sub_info['proxies'] = self.strip_legacy_failure(sub_info['proxies'])
         logger.info(f'putting subscription: {key} {sub_info}')
         self.subscription_db.put(key, sub_info)
+        self.subscription_db.status_delete_many(stale)
 
     def check_sub_available(self, key, sub_info):
         now = time.time()
@@ -354,9 +377,8 @@ class SubscriptionPool:
         logger.info(f'sublink proxy num: {len(s.proxies)}')
         start_port += len(s.proxies)
 
-        for k, v in self.get_all_sub_dict().items():
+        for k, item in self.get_all_sub_dict().items():
             try:
-                item = json.loads(v)
                 url = item.get('url', '')
                 proxies = item.get('proxies', [])
                 m = MiHoMoProxyPool(url, proxies=proxies, start_port=start_port)
@@ -380,11 +402,30 @@ class SubscriptionPool:
         start_ret = subprocess.getoutput(start_cmd)
         print(f'start cmd:{start_cmd} ret: {start_ret}')
 
-    def run_generate_task(self):
+    def poll_changes(self):
+        """
+        读取订阅和代理表的变更, 未启用变更流时返回 None
+        """
+        consumers = [ChangeConsumer(table, 'mihomo_proxy_pool') for table in ('subscription', 'sub_proxy')]
+        if not all(consumer.enabled for consumer in consumers):
+            logger.info('change feed disabled for subscription / sub_proxy, always regenerate')
+            return None
+        return [(consumer, consumer.poll()) for consumer in consumers]
+
+    def run_generate_task(self, force=False):
+        changes = self.poll_changes()
+        if not force and changes is not None and not any(change for _, change in changes):
+            logger.info('subscription and sub_proxy unchanged since last generation, skip')
+            return
+
+        logger.info(f'regenerating proxy pool, changes: {[change for _, change in changes or []]}')
         self.stop_mihomo_docker()
         self.generate_docker_compose_config()
         self.start_mihomo_docker()
 
+        for consumer, change in changes or []:
+            consumer.ack(change)
+
     def filter_available_proxies(self, proxies):
         m = MihomoSpeedTest(proxies=proxies)
         avail_proxie_names = m.filter_available_proxies()
@@ -396,43 +437,74 @@ class SubscriptionPool:
             ret.append(proxy)
         return ret
 
+    @staticmethod
+    def get_proxy_status_key(sub_key, proxy_name):
+        return f'{sub_key}#{proxy_name}'
+
+    @staticmethod
+    def strip_legacy_failure(proxies):
+        """
+        去掉旧版本记录在节点属性中的失败次数, 现在保存在状态记录 {订阅 key}#{节点名} 中
+        """
+        return [{k: v for k, v in proxy.items() if k != 'failure'} for proxy in proxies]
+
     def run_check_task(self):
         d = self.get_all_sub_dict()
+        updates, deletes = {}, []
+        incrs, sets, removed = {}, {}, []
 
-        for k, v in d.items():
+        for k, item in d.items():
             try:
-                item = json.loads(v)
                 proxies = item.get('proxies', [])
                 m = MihomoSpeedTest(proxies=proxies)
                 avail_proxies = m.filter_available_proxies()
+
+                # 失败次数单独存放在状态记录中, 节点没有变化时不重写整个订阅
+                status_keys = [self.get_proxy_status_key(k, proxy['name']) for proxy in proxies]
+                status = self.subscription_db.get_status_many(status_keys, fields=['failure'])
                 new_proxies = []
-                for proxy in proxies:
-                    failure_count = proxy.get('failure', 0)
+                for proxy, status_key in zip(proxies, status_keys):
+                    # 旧版本的失败次数记录在订阅的节点属性中, 还没有状态记录时以它为初始值
+                    seeded = 'failure' in status.get(status_key, {})
+                    failure_count = status[status_key]['failure'] if seeded else proxy.get('failure', 0)
 
                     if proxy['name'] not in avail_proxies:
                         failure_count += 1
+                        if seeded:
+                            incrs[status_key] = {'failure': 1}
+                        else:
+                            sets[status_key] = {'failure': failure_count}
                     else:
                         failure_count = 0
+                        sets[status_key] = {'failure': 0}
 
                     if failure_count >= 3:
                         logger.info(f'deleting proxy: {k}, url: {item["url"]}')
+                        removed.append(status_key)
                     else:
                         new_proxies.append(proxy)
 
-                    proxy["failure"] = failure_count
-                    item['proxies'] = new_proxies
                     logger.info(f'proxy: {proxy["name"]} failure count: {failure_count}')
 
                 if not new_proxies:
                     logger.info(f'{k}, suburl: {item["url"]} have no proxy now deleting it')
-                    self.subscription_db.delete(k)
-                else:
+                    deletes.append(k)
+                    removed.extend(status_keys)
+                elif len(new_proxies) < len(proxies) or any('failure' in proxy for proxy in proxies):
+                    # 旧版本的失败次数已写入状态记录, 重写时一并去掉
                     logger.info(f'updating subscription: {k}')
-                    self.subscription_db.put(k, item)
+                    item['proxies'] = self.strip_legacy_failure(new_proxies)
+                    updates[k] = item
 
             except Exception as e:
                 logger.error(f'failed to parse {k}, err: {e}')
 
+        self.subscription_db.status_incr_many(incrs)
+        self.subscription_db.status_set_many(sets)
+        self.subscription_db.put_many(updates)
+        self.subscription_db.delete_many(deletes)
+        self.subscription_db.status_delete_many(removed)
+
 
 def generate_proxy_pool_run_task():
     s = SubscriptionPool()
@@ -12,24 +12,33 @@ from pathlib import Path
 from urllib.parse import urlparse
 from loguru import logger
 
-from config import redis_conn, proxy_pool_start_port
+from config import redis_conn, proxy_pool_start_port, tcp_prefilter, tcp_prefilter_concurrency
 from proxy_db.db_client import DbClient
 from urllib.parse import unquote
 
 from submanager.util import get_http_proxies, get_http_proxy
 from subscribe.utils import cmd as run_cmd
+from proxy_check.ping import sync_filter_reachable_proxies
 
 operating_system = platform.system().lower()
 current_dir = os.path.abspath(os.path.dirname(__file__))
 
 
 class MihomoSpeedTest:
-    def __init__(self, sub_url='', proxies=None):
+    def __init__(self, sub_url='', proxies=None, prefilter=tcp_prefilter):
+        """
+        init
+        :param sub_url: 订阅链接, 没有 proxies 时使用
+        :param proxies: 代理列表
+        :param prefilter: 测试前先用 tcp 连接过滤端口不通的代理, 被过滤的代理不会出现在结果中
+        :return:
+        """
         filename = f"mihomo-speedtest"
         if operating_system == 'windows':
             filename += '.exe'
 
         self.proxies = proxies
+        self.prefilter = prefilter
         self.bin_path = os.path.join(current_dir, "mihomo", filename)
         self.tmp_dir = os.path.join(current_dir, "tmp")
 
@@ -60,11 +69,14 @@ class MihomoSpeedTest:
         return data
 
     def filter_available_proxies(self):
-        ret = []
+        return list(self.get_available_delays())
+
+    def get_available_delays(self):
+        ret = {}
         result = self.run_test()
         for item in result:
             if item.get('delay') != 9999:
-                ret.append(item['name'])
+                ret[item['name']] = item.get('delay')
         return ret
 
     def clear_resource(self):
@@ -74,6 +86,11 @@ class MihomoSpeedTest:
             os.remove(self.result_path)
 
     def run_test(self):
+        if self.prefilter and self.proxies:
+            self.proxies, _ = sync_filter_reachable_proxies(self.proxies, concurrency=tcp_prefilter_concurrency)
+            if not self.proxies:
+                return []
+
         self.generate_mihomo_config()
         success, content = run_cmd(self._test_cmd)
         if not success:
@@ -1,8 +1,133 @@
+from loguru import logger
+
 from config import redis_conn
 from proxy_db.db_client import DbClient
+from submanager.util import get_country_by_ip
+from proxy_check.ping import PROBE_PHASES
+
+# 最近一次检测通过的代理索引
+HEALTHY_INDEX = 'healthy'
+
+# 按检测延迟排序的索引
+DELAY_SCORE = 'delay'
+
+# 下次检测时间的索引, 分值为时间戳, 检测任务只处理到期的代理
+DUE_SCORE = 'due'
+
+# 按综合延迟排序的索引, 分值为 延迟 / 成功率 的指数加权平均, 越小越好
+RANK_SCORE = 'rank'
+
+# 按首字节时间排序的索引, 分值为最近一次分阶段测试的 ttfb, 毫秒, 只在开启 PHASE_PROBE 时更新
+TTFB_SCORE = 'ttfb'
+
+# 分阶段测试保存在状态记录中的字段, 阶段名见 proxy_check.ping.PROBE_PHASES
+PHASE_FIELDS = tuple(f'phase_{phase}' for phase in PROBE_PHASES)
+
+# 检测写入的状态字段, iter_items(with_status=True) 会合并到代理属性中, 生成配置时需要去掉
+STATUS_FIELDS = ('fail_count', 'success_count', 'last_check_time', 'streak', 'ewma_latency',
+                 'ewma_success') + PHASE_FIELDS
+
+# 指数加权平均中新检测结果的权重
+EWMA_ALPHA = 0.3
+
+# 分布式检测的工作队列名, 协调者放入到期的代理, check_worker 领取检测
+CHECK_QUEUE = 'check'
+
+# 记录各表已经按哪些 indexers 建立过子集索引
+INDEX_META_TABLE = 'index_meta'
+
+
+def proxy_endpoint(proxy):
+    """
+    代理的 server:port, 与 SubMerger 保存代理时使用的 key 相同
+    """
+    return f"{proxy.get('server')}:{proxy.get('port')}"
+
+
+def sort_by_rank(proxies, ranks, key=proxy_endpoint):
+    """
+    把 ranks 中的代理按分值排到最前面, 其余代理保持原来的顺序
+    :param ranks: {key: 综合延迟}
+    :param key: 从代理取 ranks 中 key 的函数
+    :return: 新的代理列表
+    """
+    return sorted(proxies, key=lambda p: ranks.get(key(p), float('inf')))
 
 
 class SubLinkDb(DbClient):
+    indexers = {
+        'country': lambda proxy: proxy.get('country') or get_country_by_ip(proxy['server']),
+        'type': lambda proxy: proxy.get('type'),
+    }
+
+    # SubMerger 每次合并时批量判断代理是否已存在, 缓存一次合并的 key 数量即可
+    cache_size = 5000
+
     def __init__(self):
         super().__init__(redis_conn)
         self.change_table('sub_proxy')
+
+    def ensure_indexes(self):
+        """
+        表中加入 indexers 之前写入的代理没有子集索引, indexers 变化后第一次调用时为整张表重建一次
+        :return: 是否重建
+        """
+        meta = DbClient(redis_conn)
+        meta.change_table(INDEX_META_TABLE)
+        table = self.client.name
+        indexers = sorted(self.indexers)
+        if (meta.get(table) or {}).get('indexers') == indexers:
+            return False
+
+        logger.info(f'reindexing {table} by {indexers}')
+        self.reindex()
+        meta.put(table, {'indexers': indexers})
+        return True
+
+    def get_random_healthy(self, n=1):
+        return self.get_random_where(HEALTHY_INDEX, n)
+
+    def get_fastest(self, n=20, country=None, type=None):
+        return self.top_n(DELAY_SCORE, n, country=country, type=type)
+
+    def record_latency(self, results):
+        """
+        更新延迟和成功率的指数加权平均以及综合延迟排序
+        :param results: {key: 延迟毫秒}, None 表示检测失败
+        """
+        return self.update_ewma(results, alpha=EWMA_ALPHA, score=RANK_SCORE)
+
+    def get_ranked(self, n=20, country=None, type=None):
+        return self.top_n(RANK_SCORE, n, country=country, type=type)
+
+    def record_phases(self, results):
+        """
+        保存分阶段测试的各阶段耗时, 并更新首字节时间排序
+        :param results: {key: phase_ping 的结果}, None 表示检测失败, 从排序中移除
+        """
+        values, ttfbs, failed = {}, {}, []
+        for key, phases in results.items():
+            if not phases or not phases.get('success'):
+                failed.append(key)
+                continue
+            values[key] = {f'phase_{phase}': phases[phase] for phase in PROBE_PHASES if phase in phases}
+            ttfbs[key] = phases['ttfb']
+        self.status_set_many(values)
+        self.score_set_many(TTFB_SCORE, ttfbs)
+        self.score_remove(TTFB_SCORE, failed)
+
+    def get_fastest_ttfb(self, n=20, country=None, type=None):
+        return self.top_n(TTFB_SCORE, n, country=country, type=type)
+
+    def rank_proxies(self, proxies, n=20, key=proxy_endpoint, score=RANK_SCORE):
+        """
+        把综合延迟最小的 n 个代理排到最前面, 其余代理保持原来的顺序
+        :param proxies: 代理列表
+        :param n: 排到前面的代理数, 0 时不排序
+        :param key: 返回代理在表中的 key 的函数, 表中的 key 有 server:port (SubMerger) 和代理名 (SubscribeFetcher) 两种
+        :param score: 排序索引, 默认综合延迟, 开启 PHASE_PROBE 时也可以用 TTFB_SCORE
+        :return: 新的代理列表
+        """
+        if not n:
+            return list(proxies)
+        return sort_by_rank(proxies, dict(self.score_range(score, limit=n)), key)
@@ -10,9 +10,8 @@ from loguru import logger
 from subscribe import subconverter
 from submanager import b64plus
 from tools.ip_location import load_mmdb
-from proxy_db.db_client import DbClient
+from submanager.proxydb import SubLinkDb
 from submanager.xui_scan.xui_db import XuiLinkDb
-from config import redis_conn
 
 """
 将订阅转换统一为clash配置
@@ -44,8 +43,7 @@ class SubMerger:
         self.resource_dir = os.path.join(self.current_path, "resource")
         self.mmdb_reader = load_mmdb(self.resource_dir, "GeoLite2-City.mmdb")
 
-        self.db_client = DbClient(redis_conn)
-        self.db_client.change_table('sub_proxy')
+        self.db_client = SubLinkDb()
 
         self.clash_proxies = []
 
@@ -180,15 +178,23 @@ class SubMerger:
         return self.db_client.exists(key)
 
     def save_proxy_to_db(self):
+        proxies = {}
         for proxy in self.clash_proxies:
             key = f'{proxy["server"]}:{proxy["port"]}'
+            proxies.setdefault(key, proxy)
 
-            if self.check_key_exist(key):
+        keys = list(proxies.keys())
+        new_proxies = {}
+        for key, exist in zip(keys, self.db_client.exists_many(keys)):
+            if exist:
                 logger.info(f'key: {key} exist, skip...')
                 continue
 
-            logger.info(f'putting {key}, proxy: {proxy}')
-            self.db_client.put(key, proxy)
+            logger.info(f'putting {key}, proxy: {proxies[key]}')
+            new_proxies[key] = proxies[key]
+
+        self.db_client.put_many(new_proxies)
+        logger.info(f'sub proxy cache: {self.db_client.cache_stats()}')
 
     def run(self):
         for url in self.subscribes:
@@ -1,9 +1,15 @@
-import json
+import asyncio
+import random
+import time
+
 from loguru import logger
-from datetime import datetime
 from urllib.parse import unquote
-from submanager.proxydb import SubLinkDb
+from config import phase_probe
+from submanager.proxydb import SubLinkDb, HEALTHY_INDEX, DELAY_SCORE, DUE_SCORE, CHECK_QUEUE, STATUS_FIELDS
 from submanager.mihomo_speedtest import MihomoSpeedTest
+from proxy_check.concurrency import AimdController
+from proxy_check.proxy_checker import Checker
+from proxy_db.work_queue import WorkQueue
 
 """
 检查数据库中的代理
@@ -11,21 +17,116 @@ from submanager.mihomo_speedtest import MihomoSpeedTest
 
 
 class SubProxyChecker:
-    def __init__(self):
+    def __init__(self, phase_probe=phase_probe):
+        """
+        init
+        :param phase_probe: 对检测成功的代理再做分阶段测试, 保存各阶段耗时和首字节时间排序
+        :return:
+        """
         self.chunk = 50
+        # 根据延迟膨胀调整每批检测的代理数, 失败的代理不计入延迟也不算超时, 避免失效代理多时一直收窄
+        self.controller = AimdController(initial=self.chunk, min_limit=10, max_limit=200, window=self.chunk,
+                                         name='sub_proxy_check')
+        self.flush_size = 500
         self.proxies = []
         self.fail_to_delete_threshold = 3
         self.db_client = SubLinkDb()
-        self.proxy_dict = self.load_proxies_dict()
+        self.pending_results = {}
+        self.pending_delays = {}
+        self.pending_phases = {}
+        self.proxy_dict = {}
+        self.phase_probe = phase_probe
+
+        # 下次检测的间隔: 失败或新加入的代理按最小间隔检测, 连续成功 backoff_step 次间隔翻倍, 最大为 max_interval
+        self.min_interval = 10 * 60
+        self.max_interval = 12 * 3600
+        self.backoff_step = 3
+        # 间隔的随机浮动比例, 避免同一批代理总在同一轮到期
+        self.interval_jitter = 0.1
+
+    def iter_all_proxy_chunks(self):
+        """
+        流式读取数据库中的代理, 每 chunk 个一组返回
+        :return: {key: proxy} 生成器
+        """
+        seen = set()
+        chunk = {}
+        for key, proxy in self.db_client.iter_items(with_status=True):
+            # HSCAN 在 rehash 时可能重复返回同一个 key
+            if key in seen:
+                continue
+            seen.add(key)
+
+            chunk[key] = proxy
+            if len(chunk) >= self.chunk:
+                yield chunk
+                chunk = {}
+
+        if chunk:
+            yield chunk
+
+    def get_due_keys(self, now=None):
+        """
+        返回下次检测时间已到的代理 key, 表中还没有检测时间的代理 (新加入的) 视为已到期
+        """
+        now = now or time.time()
+        self.db_client.score_backfill(DUE_SCORE, now)
+        due_keys = [key for key, _ in self.db_client.score_range(DUE_SCORE, max=now)]
+        logger.info(f'{len(due_keys)} proxies due for check')
+        return due_keys
+
+    def load_proxy_chunk(self, keys):
+        """
+        读取 keys 对应的代理并合并状态记录, 已被删除的代理不返回
+        :return: {key: proxy}
+        """
+        # 每轮检测读取所有到期的代理, 间隔大于缓存有效期, 不经过缓存
+        items = self.db_client.get_many(keys, cached=False)
+        status = self.db_client.get_status_many(keys)
+
+        chunk, missing = {}, []
+        for key, proxy in zip(keys, items):
+            if proxy is None:
+                missing.append(key)
+                continue
+            proxy.update(status.get(key, {}))
+            chunk[key] = proxy
 
-    def load_proxies_dict(self):
-        proxy_dict = self.db_client.get_all_items()
-        for k, v in proxy_dict.items():
-            try:
-                proxy_dict[k] = json.loads(v)
-            except Exception as e:
-                logger.error(f'convert to json failed. val: {v}')
-        return proxy_dict
+        # 代理已被删除, 检测时间不再需要
+        if missing:
+            self.db_client.score_remove(DUE_SCORE, missing)
+        return chunk
+
+    def iter_due_proxy_chunks(self, now=None):
+        """
+        读取下次检测时间已到的代理, 每 chunk 个一组返回
+        :return: {key: proxy} 生成器, proxy 中合并了状态记录
+        """
+        due_keys = self.get_due_keys(now)
+
+        i = 0
+        while i < len(due_keys):
+            keys = due_keys[i:i + self.chunk]
+            i += len(keys)
+            chunk = self.load_proxy_chunk(keys)
+            if chunk:
+                yield chunk
+
+    def iter_proxy_chunks(self, full=False):
+        return self.iter_all_proxy_chunks() if full else self.iter_due_proxy_chunks()
+
+    def next_interval(self, ok, streak):
+        """
+        根据检测结果计算下次检测的间隔
+        :param ok: 本次检测是否通过
+        :param streak: 包括本次在内的连续成功次数
+        :return: 秒
+        """
+        if not ok:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval, self.min_interval * 2 ** (streak // self.backoff_step))
+        return interval * random.uniform(1 - self.interval_jitter, 1 + self.interval_jitter)
 
     def filter_available_proxies(self, proxies):
         def chunks(lst, n):
@@ -49,13 +150,36 @@ class SubProxyChecker:
 
     def check_proxies(self, proxies):
         m = MihomoSpeedTest(proxies=proxies)
-        avail_proxies_names = m.filter_available_proxies()
+        delays = m.get_available_delays()
         for proxy in proxies:
-            if proxy["name"] in avail_proxies_names:
+            if proxy["name"] in delays:
                 proxy['valid'] = True
+                proxy['delay'] = delays[proxy["name"]]
             else:
                 proxy['valid'] = False
 
+    def probe_phases(self, proxies):
+        """
+        通过本地 listener 对检测成功的代理做分阶段测试, 结果缓存在 pending_phases 中
+        """
+        valid = [{k: v for k, v in proxy.items() if k not in STATUS_FIELDS + ('valid', 'delay')}
+                 for proxy in proxies if proxy['valid']]
+        for proxy in proxies:
+            self.pending_phases[proxy['name']] = None
+
+        async def run():
+            async with Checker(mode='listener', phase_probe=True) as checker:
+                return await checker.check(valid)
+
+        try:
+            results = asyncio.run(run()) if valid else []
+        except Exception as e:
+            logger.error(f'phase probe failed: {e}')
+            return
+        for res in results:
+            if res.get('valid') and res.get('phases'):
+                self.pending_phases[res['name']] = res['phases']
+
     def pre_process_proxies(self):
         for key, proxy in self.proxy_dict.items():
             # 最新 mihomo 只支持 xtls-rprx-vision 流控算法
@@ -77,38 +201,110 @@ class SubProxyChecker:
     def get_proxy_key(self):
         pass
 
-    def sub_proxy_check_task(self):
+    def sub_proxy_check_task(self, full=False):
+        """
+        检测代理并写回结果
+        :param full: 检测所有代理, 默认只检测到期的代理
+        """
+        self.db_client.ensure_indexes()
+        for proxy_dict in self.iter_proxy_chunks(full):
+            self.check_chunk(proxy_dict)
+            if len(self.pending_results) >= self.flush_size:
+                self.flush_results()
+
+        self.flush_results()
+
+    def check_chunk(self, proxy_dict):
+        """
+        检测一批代理, 结果缓存在 pending_results 中, 由 flush_results 写回
+        :param proxy_dict: {key: proxy}
+        """
+        self.proxy_dict = proxy_dict
         self.pre_process_proxies()
-        proxy_items = list(self.proxy_dict.values())
-        total_proxies = len(self.proxy_dict)
-        chunk_size = self.chunk
-
-        for i in range(0, total_proxies, chunk_size):
-            chunk_proxies = proxy_items[i:i + chunk_size]
-            self.check_proxies(chunk_proxies)
-
-            for proxy in chunk_proxies:
-                key = proxy["name"]
-                if proxy['valid']:
-                    logger.info(f"proxy: {key}, success.")
-                    proxy['success_count'] = proxy.get('success_count', 0) + 1
-                    proxy['fail_count'] = 0
-                else:
-                    logger.info(f"proxy: {key}, fail.")
-                    proxy['fail_count'] = proxy.get('fail_count', 0) + 1
-                    if proxy['fail_count'] >= self.fail_to_delete_threshold:
-                        self.delete_proxy(key)
-                        continue
-
-                self.update_proxy(key, proxy)
-
-    def update_proxy(self, key, proxy):
-        proxy['last_check_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.db_client.put(key, proxy)
-
-    def delete_proxy(self, key):
-        logger.info(f'deleting proxy: {key}')
-        return self.db_client.delete(key)
+        chunk_proxies = list(self.proxy_dict.values())
+        self.check_proxies(chunk_proxies)
+        if self.phase_probe:
+            self.probe_phases(chunk_proxies)
+
+        for proxy in chunk_proxies:
+            key = proxy["name"]
+            if proxy['valid']:
+                logger.info(f"proxy: {key}, success.")
+            else:
+                logger.info(f"proxy: {key}, fail.")
+            self.pending_results[key] = proxy['valid']
+            if proxy['valid'] and proxy.get('delay') is not None:
+                self.pending_delays[key] = proxy['delay']
+                self.controller.record(proxy['delay'] / 1000)
+            else:
+                self.controller.record()
+        # 按新的批次大小读取下一批
+        self.chunk = self.controller.limit
+
+    def enqueue_due_checks(self):
+        """
+        分布式检测的协调者: 回收崩溃 worker 的代理, 并把到期的代理放入工作队列, 由 check_worker 检测
+        """
+        if not self.db_client.supports('work_queue'):
+            logger.warning('work queue unavailable, check in this process')
+            return self.sub_proxy_check_task()
+
+        self.db_client.ensure_indexes()
+        queue = WorkQueue('sub_proxy', CHECK_QUEUE)
+        reclaimed = queue.reclaim()
+        pushed = queue.push(self.get_due_keys())
+        dead = queue.dead()
+        if dead:
+            # 反复处理失败的代理, 用 check_worker --retry-dead 放回队列
+            logger.warning(f'{len(dead)} proxies in dead letter: {dead[:10]}')
+        logger.info(f'{pushed} proxies enqueued, {reclaimed} reclaimed, {len(queue)} waiting')
+        return pushed
+
+    def flush_results(self):
+        """
+        将缓存的检测结果批量写回数据库, 计数和删除在 redis 端原子完成
+        """
+        evicted = self.db_client.record_check_results(self.pending_results, self.fail_to_delete_threshold,
+                                                      index=HEALTHY_INDEX)
+        for key in evicted:
+            logger.info(f'deleted proxy: {key}')
+
+        # 失败的代理不参与延迟排序
+        self.db_client.score_set_many(DELAY_SCORE, self.pending_delays)
+        failed = [k for k, ok in self.pending_results.items() if not ok]
+        self.db_client.score_remove(DELAY_SCORE, failed)
+        # 综合排序按多次检测的加权平均计算, 偶尔失败的代理只会排后, 不会移出排序
+        latencies = dict.fromkeys(failed)
+        latencies.update(self.pending_delays)
+        self.db_client.record_latency(latencies)
+        if self.pending_phases:
+            self.db_client.record_phases({k: v for k, v in self.pending_phases.items() if k not in evicted})
+        self.schedule_next_checks(set(evicted))
+
+        logger.info(f'flushed {len(self.pending_results)} results, {len(evicted)} deleted')
+        self.pending_results = {}
+        self.pending_delays = {}
+        self.pending_phases = {}
+
+    def schedule_next_checks(self, evicted):
+        """
+        更新连续成功次数, 并按检测结果写入下次检测时间
+        :param evicted: 已被删除的代理
+        """
+        results = {key: ok for key, ok in self.pending_results.items() if key not in evicted}
+        if not results:
+            return
+
+        status = self.db_client.get_status_many(results.keys(), fields=['streak'])
+        now = time.time()
+        streaks, dues = {}, {}
+        for key, ok in results.items():
+            streak = status.get(key, {}).get('streak', 0) + 1 if ok else 0
+            streaks[key] = {'streak': streak}
+            dues[key] = now + self.next_interval(ok, streak)
+
+        self.db_client.status_set_many(streaks)
+        self.db_client.score_set_many(DUE_SCORE, dues)
 
 
 def run_sub_proxy_check_task():
@@ -119,5 +315,13 @@ def run_sub_proxy_check_task():
         logger.exception(e)
 
 
+def run_enqueue_check_task():
+    try:
+        s = SubProxyChecker()
+        s.enqueue_due_checks()
+    except Exception as e:
+        logger.exception(e)
+
+
 if __name__ == '__main__':
     run_sub_proxy_check_task()
@@ -11,6 +11,7 @@ from submanager.util import get_http_proxies
 from submanager.proxydb import SubLinkDb
 from submanager.mihomo_speedtest import MihomoSpeedTest
 from submanager.mihomo_proxy_pool import SubscriptionPool
+from proxy_check.concurrency import AimdController
 
 current_dir = os.path.abspath(os.path.dirname(__file__))
 
@@ -62,23 +63,24 @@ class SubscribeFetcher:
     def save_proxies_to_db(self, proxies):
         for proxy in proxies:
             logger.info(f'save proxy {proxy["name"]} to db')
-            self.sublink_db.put(proxy["name"], proxy)
+        self.sublink_db.put_many({proxy["name"]: proxy for proxy in proxies})
 
     def filter_available_proxies(self, proxies):
-        def chunks(lst, n):
-            """Yield successive n-sized chunks from lst."""
-            for i in range(0, len(lst), n):
-                yield lst[i:i + n]
-
         ret = []
-        chunk_size = 100
-        for proxy_chunk in chunks(proxies, chunk_size):
+        # 每批检测的代理数根据成功代理的延迟调整
+        controller = AimdController(initial=100, min_limit=20, max_limit=300, window=100, name='subscribe_fetcher')
+        i = 0
+        while i < len(proxies):
+            proxy_chunk = proxies[i:i + controller.limit]
+            i += len(proxy_chunk)
             m = MihomoSpeedTest(proxies=proxy_chunk)
-            avail_proxie_names = m.filter_available_proxies()
+            delays = m.get_available_delays()
             for proxy in proxy_chunk:
-                if proxy["name"] not in avail_proxie_names:
+                if proxy["name"] not in delays:
                     logger.info(f'proxy: {proxy["name"]} is not available, skipping')
+                    controller.record()
                     continue
+                controller.record(delays[proxy["name"]] / 1000)
                 ret.append(proxy)
 
         self.proxies = ret
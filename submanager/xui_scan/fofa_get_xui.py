@@ -99,6 +99,8 @@ class FofaClient:
 
     def run(self, search_key, endcount=500):
         try:
+            # 预先加载已有站点, filter_url 中不需要逐个查询数据库
+            self.xui_site_db.warm_cache()
             result = fofa_api(search_key, endcount=endcount, proxy=self.proxies)
             for data in result:
                 urls = self.filter_url(data)
@@ -107,6 +109,8 @@ class FofaClient:
         except Exception as e:
             logger.exception(e)
 
+        logger.info(f'xui site cache: {self.xui_site_db.cache_stats()}')
+
 
 def main():
     f = FofaClient()
@@ -1,11 +1,13 @@
-import json
-
 from loguru import logger
 from proxy_db.db_client import DbClient
+from proxy_db.async_db_client import AsyncDbClient
 from config import redis_conn
 
 
 class XuiLinkDb(DbClient):
+    # 抓取链接时逐个判断站点是否已有链接, 同一轮抓取中重复的站点命中缓存
+    cache_size = 5000
+
     def __init__(self):
         super().__init__(redis_conn)
         self.table_name = 'xui_links'
@@ -23,9 +25,8 @@ class XuiLinkDb(DbClient):
         return self.exists(key)
 
     def get_all_links(self):
-        items = self.get_all()
         ret = []
-        for item in items:
+        for _, item in self.iter_items():
             links = item.get('link', '').split()
             ret.extend(links)
         return ret
@@ -35,7 +36,21 @@ class XuiLinkDb(DbClient):
         return items
 
 
+class AsyncXuiLinkDb(AsyncDbClient):
+    """
+    xui_links 表的 asyncio 版本, 只支持 redis, 需要在使用它的事件循环中创建并 close
+    """
+
+    def __init__(self):
+        super().__init__(redis_conn)
+        self.table_name = 'xui_links'
+        self.change_table(self.table_name)
+
+
 class XuiSiteDb(DbClient):
+    # FofaClient 逐个判断搜索结果是否已检测过, 多页结果中重复的站点命中缓存
+    cache_size = 5000
+
     def __init__(self):
         super().__init__(redis_conn)
         self.table_name = 'xui_sites'
@@ -59,8 +74,7 @@ class XuiSiteDb(DbClient):
         ret = {}
 
         items = self.get_all_items()
-        for k, v in items.items():
-            item = json.loads(v)
+        for k, item in items.items():
             item['url'] = k
             if item.get('status', '') != 'failure':
                 ret[k] = item
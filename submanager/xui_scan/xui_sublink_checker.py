@@ -1,51 +1,91 @@
-import json
+import asyncio
+
 from loguru import logger
-from datetime import datetime
 
-from submanager.xui_scan.xui_db import XuiLinkDb
+from submanager.xui_scan.xui_db import XuiLinkDb, AsyncXuiLinkDb
+from submanager.proxydb import RANK_SCORE, EWMA_ALPHA
 from submanager.util import parse_link_host_port
 
-from proxy_check.ping import sync_tcp_ping
+from proxy_check.ping import sync_tcp_ping, batch_tcp_ping
 
 
 class XuiSubLinkChecker:
     def __init__(self):
         self.loss_fail_threshold = 0.5
         self.fail_to_delete_threshold = 3
+        # 同时进行的 tcp 连接数
+        self.ping_concurrency = 500
         self.db = XuiLinkDb()
 
-    def process_xui_item(self, key, item):
-        link = item.get('link', '')
-        if not link:
-            return
+    def get_link_server_port(self, link):
+        try:
+            server, port = parse_link_host_port(link)
+        except Exception as e:
+            logger.debug(f'parse link failed: {link}, err: {e}')
+            return None, None
+        return server, port
 
-        server, port = self.get_link_server_port(item.get('link'))
-        result = sync_tcp_ping(server, port)
-        check_alive = result[0] > 0
+    def get_targets(self, items):
+        """
+        解析链接的地址和端口, 没有链接或无法解析的记为 None
+        一条记录有多个链接时 (以空白分隔, 见 XuiLinkDb.get_all_links) 检测第一个
+        :param items: (key, 链接属性) 可迭代对象
+        :return: {key: (server, port) 或 None}
+        """
+        targets = {}
+        for key, item in items:
+            links = item.get('link', '').split()
+            link = links[0] if links else ''
+            server, port = self.get_link_server_port(link) if link else (None, None)
+            targets[key] = (server, port) if server and port else None
+        return targets
 
-        if check_alive:
-            logger.info(f"xui site: {key}, check success.")
-            item['success_count'] = item.get('success_count', 0) + 1
-            item['fail_count'] = 0
-        else:
-            logger.info(f"xui site: {key}, check fail.")
-            item['fail_count'] = item.get('fail_count', 0) + 1
-            if item['fail_count'] >= self.fail_to_delete_threshold:
-                self.db.delete(key)
-                return
+    async def check_targets(self, targets):
+        """
+        tcp ping 所有地址, 无法解析的链接视为检测失败, 连续失败后和不通的链接一样被删除
+        :return: ({key: 是否可用}, {key: 平均连接耗时毫秒, 失败为 None})
+        """
+        results, latencies = {}, {}
+        for key, target in targets.items():
+            if target is None:
+                results[key] = False
+                latencies[key] = None
+                logger.info(f"xui site: {key}, unparsable link, check fail.")
+        targets = {key: target for key, target in targets.items() if target is not None}
 
-        item['last_check_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.db.put_xui_link(key, item)
+        stats = await batch_tcp_ping(list(targets.values()), concurrency=self.ping_concurrency)
+        for key, stat in zip(targets, stats):
+            results[key] = stat['success'] > 0
+            latencies[key] = stat['avg'] if results[key] else None
+            logger.info(f"xui site: {key}, check {'success' if results[key] else 'fail'}.")
+        return results, latencies
 
-    def get_link_server_port(self, link):
-        server, port = parse_link_host_port(link)
-        return server, port
+    async def async_run(self):
+        """
+        读取, 检测和写回都在同一个事件循环中进行, 不阻塞 tcp ping
+        """
+        db = AsyncXuiLinkDb()
+        try:
+            targets = self.get_targets([item async for item in db.iter_items()])
+            results, latencies = await self.check_targets(targets)
+            evicted = await db.record_check_results(results, self.fail_to_delete_threshold)
+            # 上传配置时按连接耗时的加权平均排序
+            await db.update_ewma(latencies, alpha=EWMA_ALPHA, score=RANK_SCORE)
+        finally:
+            await db.close()
+        logger.info(f'checked {len(results)} xui links, {len(evicted)} deleted')
 
     def run(self):
-        d = self.db.get_all_link_dict()
-        for key, item in d.items():
-            item = json.loads(item)
-            self.process_xui_item(key, item)
+        if self.db.db_type == 'REDIS':
+            asyncio.run(self.async_run())
+            return
+
+        # sqlite 没有 async client
+        targets = self.get_targets(self.db.iter_items())
+        results, latencies = asyncio.run(self.check_targets(targets))
+        evicted = self.db.record_check_results(results, self.fail_to_delete_threshold)
+        self.db.update_ewma(latencies, alpha=EWMA_ALPHA, score=RANK_SCORE)
+        logger.info(f'checked {len(results)} xui links, {len(evicted)} deleted')
 
     def check_link(self, link):
         server, port = self.get_link_server_port(link)
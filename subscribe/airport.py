@@ -178,11 +178,7 @@ class AirPort:
         return ret
 
     def get_item_from_db(self):
-        try:
-            item = json.loads(self.db_client.get(self.site))
-        except Exception as e:
-            item = {}
-        return item
+        return self.db_client.get(self.site) or {}
 
     def update_to_db(self):
         # item = self.get_item_from_db()
@@ -1,4 +1,3 @@
-import json
 from config import redis_conn
 from proxy_db.db_client import DbClient
 import time
@@ -23,10 +22,7 @@ class AirportDb(DbClient):
         return ret
 
     def update(self, key: str, val: dict):
-        try:
-            item = json.loads(self.get(key))
-        except Exception as e:
-            item = {}
+        item = self.get(key) or {}
 
         item.update(val)
         self.put(key, item)
@@ -43,13 +39,7 @@ class AirportDb(DbClient):
         return ret
 
     def get_all_airport_dict(self):
-        items = self.get_all_items()
-        ret = {}
-        for k, v in items.items():
-            if isinstance(v, str):
-                v = json.loads(v)
-            ret[k] = v
-        return ret
+        return self.get_all_items()
 
     def get_all_expired_airports(self):
         subscribes = self.get_all_subscribed_airports()
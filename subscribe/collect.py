@@ -31,6 +31,8 @@ from subscribe import clash
 from subscribe import subconverter
 from subscribe.airport_db import AirportDb
 
+from proxy_check.concurrency import AimdController
+
 
 DATA_BASE = os.path.join(current_dir, "data")
 
@@ -157,6 +159,7 @@ def aggregate(args: argparse.Namespace) -> None:
             tasks=params,
             num_threads=args.num,
             show_progress=display,
+            controller=AimdController(initial=args.num, max_limit=args.num * 4, name="clash.check"),
         )
 
         # 关闭clash
@@ -38,6 +38,8 @@ from workflow import TaskConfig
 from subscribe import clash
 from subscribe import subconverter
 
+from proxy_check.concurrency import AimdController
+
 PATH = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
 
@@ -610,6 +612,7 @@ def aggregate(args: argparse.Namespace) -> None:
                     tasks=params,
                     num_threads=args.num,
                     show_progress=display,
+                    controller=AimdController(initial=args.num, max_limit=args.num * 4, name="clash.check"),
                 )
 
                 # close clash client
@@ -473,6 +473,7 @@ def multi_thread_run(
         num_threads: int = None,
         show_progress: bool = False,
         description: str = "",
+        controller=None,
 ) -> list:
     if not func or not tasks or not isinstance(tasks, list):
         return []
@@ -482,6 +483,13 @@ def multi_thread_run(
 
     funcname = getattr(func, "__name__", repr(func))
 
+    # the controller (proxy_check.concurrency.AimdController) decides how many tasks run at once,
+    # the pool only needs enough threads for its upper limit. falsy results are dead proxies and
+    # never shrink the limit, only local errors and a rising success latency do
+    if controller is not None:
+        func = controller.wrap(func)
+        num_threads = min(len(tasks), controller.max_limit)
+
     results, starttime = [None] * len(tasks), time.time()
     with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
         if isinstance(tasks[0], (list, tuple)):
@@ -506,6 +514,7 @@ def multi_thread_run(
 
     logger.info(
         f"[Concurrent] multi-threaded execute [{funcname}] finished, count: {len(tasks)}, cost: {time.time() - starttime:.2f}s"
+        + (f", concurrency: {controller.stats()}" if controller is not None else "")
     )
 
     return results
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# proxy_db 中的模块以顶层模块互相导入, 与 DbClient 相同
+for path in (ROOT, os.path.join(ROOT, 'proxy_db')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,164 @@
+"""
+RedisClient (fakeredis) 与 SqliteClient 的行为一致性测试
+"""
+import threading
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+import redis_client
+from redis_client import RedisClient
+from sqlite_client import SqliteClient
+
+TABLE = 'parity'
+
+
+class _Pool:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+@pytest.fixture
+def clients(monkeypatch, tmp_path):
+    server = fakeredis.FakeServer()
+
+    def fake_redis(connection_pool=None, **kwargs):
+        kwargs = connection_pool.kwargs if connection_pool else kwargs
+        return fakeredis.FakeRedis(server=server, decode_responses=kwargs.get('decode_responses', False))
+
+    monkeypatch.setattr(redis_client, 'Redis', fake_redis)
+    monkeypatch.setattr(redis_client, 'BlockingConnectionPool', _Pool)
+    monkeypatch.setattr(redis_client, '_connection_pools', {})
+
+    redis = RedisClient(host='localhost', port=6379, db=0)
+    sqlite = SqliteClient(db=str(tmp_path / 'proxy_pool.db'))
+    for client in (redis, sqlite):
+        client.change_table(TABLE)
+    return redis, sqlite
+
+
+def both(clients, func):
+    """
+    对两个 client 执行同样的操作, 返回 (redis 结果, sqlite 结果)
+    """
+    return tuple(func(client) for client in clients)
+
+
+def test_put_many_counts_added(clients):
+    first = both(clients, lambda c: c.put_many({'a': {'v': 1}, 'b': {'v': 2}}))
+    assert first == (2, 2)
+
+    second = both(clients, lambda c: c.put_many({'b': {'v': 3}, 'c': {'v': 4}}))
+    assert second == (1, 1)
+
+    items = both(clients, lambda c: c.get_many(['a', 'b', 'c']))
+    assert items[0] == items[1] == [{'v': 1}, {'v': 3}, {'v': 4}]
+
+
+def test_put_many_ttl(clients):
+    now = time.time()
+    both(clients, lambda c: c.put_many({'a': {'v': 1}, 'b': {'v': 2}}, ttl=60))
+    for client in clients:
+        val, expires_at = client.get_entry('a')
+        assert val == {'v': 1}
+        assert now + 59 <= expires_at <= now + 62
+
+    # ttl 为 None 时保留原有的过期时间
+    both(clients, lambda c: c.put_many({'a': {'v': 2}}))
+    for client in clients:
+        assert client.get_entry('a')[1] is not None
+
+    # ttl 为 0 时不过期
+    both(clients, lambda c: c.put_many({'a': {'v': 3}}, ttl=0))
+    entries = both(clients, lambda c: c.get_entry('a'))
+    assert entries[0] == entries[1] == ({'v': 3}, None)
+
+
+def test_record_check_results(clients):
+    both(clients, lambda c: c.put_many({'a': {'v': 1}, 'b': {'v': 2}, 'c': {'v': 3, 'fail_count': 1}}))
+
+    evicted = both(clients, lambda c: c.record_check_results({'a': True, 'b': False, 'c': False, 'x': True},
+                                                            threshold=2, index='healthy'))
+    assert evicted[0] == evicted[1] == ['c']
+
+    status = both(clients, lambda c: c.get_status_many(['a', 'b', 'c'], ['success_count', 'fail_count']))
+    assert status[0] == status[1]
+    assert int(status[0]['a']['success_count']) == 1
+    assert int(status[0]['a']['fail_count']) == 0
+    assert int(status[0]['b']['fail_count']) == 1
+    assert not status[0].get('c')
+
+    assert both(clients, lambda c: c.index_count('healthy')) == (1, 1)
+    assert both(clients, lambda c: c.exists_many(['a', 'b', 'c', 'x'])) == ([True, True, False, False],) * 2
+
+    evicted = both(clients, lambda c: c.record_check_results({'a': False, 'b': False}, threshold=2,
+                                                            index='healthy'))
+    assert evicted[0] == evicted[1] == ['b']
+    assert both(clients, lambda c: c.index_count('healthy')) == (0, 0)
+
+
+def test_update_ewma(clients):
+    both(clients, lambda c: c.put_many({'a': {'v': 1}, 'b': {'v': 2}}))
+
+    both(clients, lambda c: c.update_ewma({'a': 100, 'b': None, 'x': 10}, alpha=0.5, score='rank'))
+    both(clients, lambda c: c.update_ewma({'a': 200, 'b': 50}, alpha=0.5, score='rank'))
+
+    fields = ['ewma_latency', 'ewma_success']
+    status = both(clients, lambda c: c.get_status_many(['a', 'b'], fields))
+    for result in status:
+        assert float(result['a']['ewma_latency']) == 150
+        assert float(result['a']['ewma_success']) == 1
+        assert float(result['b']['ewma_latency']) == 50
+        assert float(result['b']['ewma_success']) == 0.5
+
+    ranked = both(clients, lambda c: c.score_range('rank'))
+    assert ranked[0] == ranked[1]
+    assert [key for key, _ in ranked[0]] == ['b', 'a']
+
+    # 失败时保留延迟, 排名不变
+    both(clients, lambda c: c.update_ewma({'a': None}, alpha=0.5, score='rank'))
+    assert both(clients, lambda c: [key for key, _ in c.score_range('rank')]) == (['b', 'a'],) * 2
+
+
+def test_iter_items_with_status(clients):
+    both(clients, lambda c: c.put_many({'a': {'v': 1}, 'b': {'v': 2}}))
+    both(clients, lambda c: c.record_check_results({'a': True, 'b': False}, threshold=3))
+    both(clients, lambda c: c.update_ewma({'a': 80}))
+
+    plain = both(clients, lambda c: dict(c.iter_items()))
+    assert plain[0] == plain[1] == {'a': {'v': 1}, 'b': {'v': 2}}
+
+    merged = both(clients, lambda c: dict(c.iter_items(with_status=True)))
+    assert merged[0].keys() == merged[1].keys() == {'a', 'b'}
+    for key in ('a', 'b'):
+        redis_item, sqlite_item = merged[0][key], merged[1][key]
+        assert redis_item.keys() == sqlite_item.keys()
+        assert {k: str(v) for k, v in redis_item.items()} == {k: str(v) for k, v in sqlite_item.items()}
+    assert int(merged[0]['a']['success_count']) == 1
+    assert int(merged[0]['b']['fail_count']) == 1
+    assert float(merged[0]['a']['ewma_latency']) == 80
+
+
+def test_sqlite_put_many_concurrent_added(tmp_path):
+    path = str(tmp_path / 'proxy_pool.db')
+    keys = [f'k{i}' for i in range(200)]
+    added = []
+
+    def writer(offset):
+        client = SqliteClient(db=path)
+        client.change_table(TABLE)
+        for i in range(0, len(keys), 10):
+            chunk = keys[i:i + 10] if offset == 0 else keys[i + 5:i + 15]
+            added.append(client.put_many({key: {'v': offset} for key in chunk}))
+
+    threads = [threading.Thread(target=writer, args=(offset,)) for offset in (0, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    client = SqliteClient(db=path)
+    client.change_table(TABLE)
+    assert sum(added) == client.get_count()['total']
@@ -0,0 +1,56 @@
+from proxy_check.concurrency import AimdController
+
+
+def feed(controller, latency, count=None, timeout=False):
+    for _ in range(count or controller.window):
+        controller.record(latency, timeout)
+
+
+def test_increase_when_healthy():
+    controller = AimdController(initial=10, increase=2, window=10)
+    feed(controller, 0.1)
+    feed(controller, 0.1)
+    assert controller.limit == 14
+
+
+def test_decrease_on_timeouts():
+    controller = AimdController(initial=100, decrease=0.5, window=10)
+    feed(controller, None, timeout=True)
+    assert controller.limit == 50
+
+
+def test_decrease_on_latency_inflation():
+    controller = AimdController(initial=100, decrease=0.5, latency_inflation=2.0, window=10)
+    feed(controller, 0.1)
+    assert controller.limit == 102
+    feed(controller, 0.5)
+    assert controller.limit == 51
+
+
+def test_limit_bounds():
+    controller = AimdController(initial=10, min_limit=4, max_limit=12, decrease=0.1, window=5)
+    feed(controller, None, timeout=True)
+    assert controller.limit == 4
+    for _ in range(10):
+        feed(controller, 0.1)
+    assert controller.limit == 12
+
+
+def test_baseline_rolls():
+    controller = AimdController(initial=100, window=5, baseline_windows=3)
+    feed(controller, 0.01)
+    assert controller.stats()['baseline'] == 0.01
+    # 基线只看最近 baseline_windows 次评估, 延迟整体变高后会恢复增长
+    for _ in range(3):
+        feed(controller, 0.1)
+    assert controller.stats()['baseline'] == 0.1
+    limit = controller.limit
+    feed(controller, 0.1)
+    assert controller.limit > limit
+
+
+def test_slot_counts_inflight():
+    controller = AimdController(initial=2)
+    with controller.slot():
+        assert controller.inflight == 1
+    assert controller.inflight == 0
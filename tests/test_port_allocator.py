@@ -0,0 +1,44 @@
+import pytest
+
+from proxy_check import port_allocator
+from proxy_check.port_allocator import PortAllocator
+
+
+@pytest.fixture
+def allocator(monkeypatch):
+    used = set()
+    monkeypatch.setattr(port_allocator, 'scan_proc_ports', lambda: set(used))
+    allocator = PortAllocator(start=1000, end=1100)
+    allocator.used = used
+    return allocator
+
+
+def test_allocate_skips_used_ports(allocator):
+    allocator.used.update({1002, 1010})
+    block = allocator.allocate(5)
+    assert block.ports == [1003, 1004, 1005, 1006, 1007]
+
+
+def test_reserved_blocks_not_reused(allocator):
+    a = allocator.allocate(10)
+    b = allocator.allocate(10)
+    assert set(a.ports).isdisjoint(b.ports)
+    allocator.release(a)
+    assert allocator.reserved() == [b]
+    assert allocator.allocate(10).start == a.start
+
+
+def test_replace_reuses_ports(allocator):
+    block = allocator.allocate(10)
+    # 被替换的 listener 仍然占用端口
+    allocator.used.update(block.ports)
+    new = allocator.allocate(20, replace=block)
+    assert new.start == block.start
+    assert allocator.reserved() == [new]
+
+
+def test_replace_kept_on_failure(allocator):
+    block = allocator.allocate(10)
+    with pytest.raises(RuntimeError):
+        allocator.allocate(200, replace=block)
+    assert allocator.reserved() == [block]
@@ -1,6 +1,9 @@
-import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from playwright.sync_api import sync_playwright
-from config import redis_conn
+from config import redis_conn, ip_risk_ttl, ip_risk_negative_ttl, ip_risk_max_stale
 
 from loguru import logger
 from proxy_db.db_client import DbClient
@@ -11,15 +14,54 @@ class IpRiskDb(DbClient):
         super().__init__(redis_conn)
         self.change_table('ip_risk')
 
+    def get_risk(self, ip):
+        """
+        返回 ip 纯净度结果
+        :return: (结果, 是否过期), 没有记录或过期超过 ip_risk_max_stale 时为 (None, True), 查询失败的结果为 {}
+        """
+        val, expires_at = self.get_entry(ip)
+        now = time.time()
+        if expires_at is not None and expires_at + ip_risk_max_stale <= now:
+            return None, True
+        # 旧版本写入的记录没有过期时间, 视为过期
+        return val, expires_at is None or expires_at <= now
+
+    def put_risk(self, ip, val):
+        """
+        保存 ip 纯净度结果, 查询失败时保存 {}, 使用较短的有效期
+        """
+        ttl = ip_risk_ttl if val else ip_risk_negative_ttl
+        return self.put(ip, val or {}, ttl=ttl)
+
+    def purge_stale(self):
+        """
+        删除过期超过 ip_risk_max_stale 的结果
+        :return: 删除数量
+        """
+        return self.purge_expired(grace=ip_risk_max_stale)
+
+
+ip_risk_db = None
+
+# 后台刷新过期结果, 每个 ip 同时只有一个刷新任务, 浏览器占用资源较多, 只用一个线程
+_refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ip_risk_refresh')
+_refreshing = set()
+_refreshing_lock = threading.Lock()
 
-def get_ip_risk_score(ip=None, proxy=None):
-    ip_risk_db = IpRiskDb()
-    try:
-        if ip_risk_db.exists(ip):
-            val = ip_risk_db.get(ip)
-            logger.info(f'ip: {ip} exist, {val}')
-            return json.loads(val)
 
+def get_ip_risk_db():
+    global ip_risk_db
+    if ip_risk_db is None:
+        ip_risk_db = IpRiskDb()
+    return ip_risk_db
+
+
+def fetch_ip_risk_score(ip=None, proxy=None):
+    """
+    打开 ping0.cc 查询 ip 纯净度
+    :return: 查询结果, 失败时为 {}
+    """
+    try:
         with sync_playwright() as playwright:
             browser = playwright.chromium.launch(
                 headless=True,
@@ -48,14 +90,72 @@ def get_ip_risk_score(ip=None, proxy=None):
 
             ret = {'ip': ip_, 'location': location, 'ip_type': ip_type, 'native_ip': native_ip, 'risk_score': risk_score}
             print(ret)
-            ip_risk_db.put(ip, ret)
             return ret
     except Exception as e:
         logger.error(e)
         return {}
 
 
+def refresh_ip_risk_score(ip, proxy=None):
+    """
+    查询并保存 ip 纯净度, 失败的结果也会保存
+    """
+    ret = fetch_ip_risk_score(ip, proxy)
+    try:
+        get_ip_risk_db().put_risk(ip, ret)
+    except Exception as e:
+        logger.error(f'save ip risk failed, ip: {ip}, err: {e}')
+    return ret
+
+
+def _refresh_in_background(ip, proxy=None):
+    with _refreshing_lock:
+        if ip in _refreshing:
+            return
+        _refreshing.add(ip)
+
+    def run():
+        try:
+            refresh_ip_risk_score(ip, proxy)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(ip)
+
+    _refresh_executor.submit(run)
+
+
+def purge_stale_ip_risk_task():
+    try:
+        purged = get_ip_risk_db().purge_stale()
+        logger.info(f'purged {purged} stale ip risk results')
+    except Exception as e:
+        logger.exception(e)
+
+
+def get_ip_risk_score(ip=None, proxy=None):
+    """
+    返回 ip 纯净度, 有记录时立即返回, 记录过期时在后台刷新
+    :return: 查询结果, 失败时为 {}
+    """
+    if not ip:
+        return fetch_ip_risk_score(ip, proxy)
+
+    try:
+        val, expired = get_ip_risk_db().get_risk(ip)
+    except Exception as e:
+        logger.error(e)
+        return {}
+
+    if val is None:
+        return refresh_ip_risk_score(ip, proxy)
+
+    if expired:
+        logger.info(f'ip: {ip} expired, refreshing in background')
+        _refresh_in_background(ip, proxy)
+    return val
+
+
 if __name__ == '__main__':
     # get_ip_risk_score(proxy="http://192.168.50.88:42015")
     ip_risk_db = IpRiskDb()
-    print(ip_risk_db.get(''))
+    print(ip_risk_db.get_risk(''))